@@ -18,6 +18,8 @@ FEATURES = [
     'NETWORK_CONFIG_V1',
     # reporter supports 'webhook' type
     'REPORTING_EVENTS_WEBHOOK',
+    # reporter supports 'trace' type, subcommand 'trace-diff' is present
+    'REPORTING_EVENTS_TRACE',
     # has storage-config schema validation
     'STORAGE_CONFIG_SCHEMA',
     # install supports the 'storage' config version 1
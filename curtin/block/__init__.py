@@ -7,11 +7,14 @@ import os
 import stat
 import sys
 import tempfile
+import threading
 
 from curtin import util
 from curtin.block import lvm
 from curtin.block import multipath
+from curtin.block import wipe
 from curtin.log import LOG
+from curtin import udev
 from curtin.udev import udevadm_settle, udevadm_info
 from curtin.util import NotExclusiveError
 from curtin import storage_config
@@ -503,6 +506,8 @@ def rescan_block_devices(devices=None, warn_on_fail=True):
     run 'blockdev --rereadpt' for all block devices not currently mounted
     """
     if not devices:
+        # all disks are rescanned, new disks may show up
+        DISK_INDEX.invalidate()
         unused = get_unused_blockdev_info()
         devices = []
         for devname, data in unused.items():
@@ -558,6 +563,10 @@ def blkid(devs=None, cache=True):
     # blkid output is <device_path>: KEY=VALUE
     # where KEY is TYPE, UUID, PARTUUID, LABEL
     out, err = util.subp(cmd, capture=True)
+    return _blkid_output_to_dict(out)
+
+
+def _blkid_output_to_dict(out):
     data = {}
     for line in out.splitlines():
         curdev, curdata = line.split(":", 1)
@@ -566,6 +575,106 @@ def blkid(devs=None, cache=True):
     return data
 
 
+class ProbeCache(object):
+    """Cache of blkid and lsblk results for all block devices.
+
+    While caching, the first lookup runs blkid or lsblk once for all block
+    devices and later lookups are answered from those results.  A device
+    missing from them is probed on its own.  The results are dropped by
+    invalidate(), which curtin calls after it partitions, formats, wipes or
+    encrypts a device, and whenever udevadm_settle has run since they were
+    taken.  When not caching every lookup probes the device.
+
+    hits and misses count the lookups answered from the cache and those
+    that ran a command while caching.
+    """
+
+    def __init__(self):
+        self.caching = False
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._generation = None
+        self._blkid = None
+        self._lsblk = None
+
+    @contextmanager
+    def enabled(self):
+        """Cache lookups for the duration of the context."""
+        self.invalidate()
+        self.caching = True
+        try:
+            yield self
+        finally:
+            self.caching = False
+            self.invalidate()
+            LOG.debug('block probe cache: %s hits, %s misses',
+                      self.hits, self.misses)
+
+    def invalidate(self):
+        with self._lock:
+            self._blkid = None
+            self._lsblk = None
+
+    def _check_generation(self):
+        generation = udev.udev_db_generation()
+        if generation != self._generation:
+            self._generation = generation
+            self._blkid = None
+            self._lsblk = None
+
+    def blkid(self, devpath):
+        """Return blkid data for devpath, like blkid([devpath])."""
+        if not self.caching:
+            return blkid([devpath])
+        kname = path_to_kname(devpath)
+        with self._lock:
+            self._check_generation()
+            if self._blkid is None:
+                self.misses += 1
+                (out, _err) = util.subp(
+                    ['blkid', '-o', 'full', '-c', '/dev/null'], capture=True)
+                self._blkid = {path_to_kname(dev): info for (dev, info) in
+                               _blkid_output_to_dict(out).items()}
+            elif kname in self._blkid:
+                self.hits += 1
+            if kname in self._blkid:
+                return {devpath: dict(self._blkid[kname])}
+            self.misses += 1
+        # no signature found by the bulk probe, blkid raises as it did
+        info = blkid([devpath])
+        with self._lock:
+            if self._blkid is not None and devpath in info:
+                self._blkid[kname] = dict(info[devpath])
+        return info
+
+    def lsblk(self, devpath):
+        """Return lsblk data for devpath, like _lsblock([devpath]), but
+        without its children when cached."""
+        if not self.caching:
+            return _lsblock([devpath])
+        kname = path_to_kname(devpath)
+        with self._lock:
+            self._check_generation()
+            if self._lsblk is None:
+                self.misses += 1
+                self._lsblk = _lsblock()
+            elif kname in self._lsblk:
+                self.hits += 1
+            if kname in self._lsblk:
+                return {kname: dict(self._lsblk[kname])}
+            self.misses += 1
+        info = _lsblock([devpath])
+        with self._lock:
+            if self._lsblk is not None:
+                for (name, entry) in info.items():
+                    self._lsblk.setdefault(name, dict(entry))
+        return info
+
+
+PROBE_CACHE = ProbeCache()
+
+
 def _legacy_detect_multipath(target_mountpoint=None):
     """
     Detect if the operating system has been installed to a multipath device.
@@ -771,7 +880,7 @@ def get_blockdev_sector_size(devpath):
     """
     info = {}
     try:
-        info = _lsblock([devpath])
+        info = PROBE_CACHE.lsblk(devpath)
     except util.ProcessExecutionError as e:
         # raise on all errors except device missing error
         if str(e.exit_code) != "32":
@@ -816,7 +925,7 @@ def get_volume_id(path):
     Get identifier of device with given path. This address uniquely identifies
     the device and remains consistant across reboots.
     """
-    ids = blkid([path])[path]
+    ids = PROBE_CACHE.blkid(path)[path]
     for key in ("UUID", "PARTUUID", "PTUUID"):
         if key in ids:
             return (key, ids[key])
@@ -920,6 +1029,95 @@ def get_device_mapper_links(devpath, first=False):
     return devlinks
 
 
+class DiskIndex(object):
+    """Index of the disks on the system by their udev properties.
+
+    devices is a list of udev property dicts of all block devices, as
+    returned by udev_all_block_device_properties.
+    """
+
+    # keys disks can be found by with disks_matching
+    keys = ('DM_WWN', 'ID_WWN_WITH_EXTENSION', 'ID_WWN', 'DM_SERIAL',
+            'ID_SERIAL', 'ID_SERIAL_SHORT')
+
+    def __init__(self, devices):
+        self.disks = []
+        # DEVNAME and DEVLINKS of disks to the disk
+        self.by_link = {}
+        self.by_key = {key: {} for key in self.keys}
+        # names in /dev/disk/by-id of all devices to the device
+        self.by_id = {}
+        # s390x ccw bus ids to the disk
+        self.by_ccw = {}
+        for dev in devices:
+            links = dev.get('DEVLINKS', '').split()
+            for link in links:
+                if link.startswith('/dev/disk/by-id/'):
+                    self.by_id[os.path.basename(link)] = dev
+            if 'DM_PART' in dev or 'PARTN' in dev:
+                continue
+            for link in links:
+                self.by_link[link] = dev
+            self.by_link[dev['DEVNAME']] = dev
+            for key in self.keys:
+                if key in dev:
+                    self.by_key[key].setdefault(dev[key], []).append(dev)
+            if dev.get('ID_PATH', '').startswith('ccw-'):
+                self.by_ccw[dev['ID_PATH'][len('ccw-'):]] = dev
+            self.disks.append(dev)
+
+    def disks_matching(self, key, value):
+        return list(self.by_key[key].get(value, []))
+
+    def disk_by_path(self, path):
+        return self.by_link.get(path)
+
+
+class DiskIndexCache(object):
+    """Build the DiskIndex once and keep it while enabled.
+
+    The index is built again after rescan_block_devices has rescanned all
+    disks or a new iSCSI disk is connected.  When not enabled a new index
+    is built by every get().
+    """
+
+    def __init__(self):
+        self.caching = False
+        self._index = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def enabled(self):
+        """Keep the index for the duration of the context."""
+        self.invalidate()
+        self.caching = True
+        try:
+            yield self
+        finally:
+            self.caching = False
+            self.invalidate()
+
+    def invalidate(self):
+        self._index = None
+
+    def current(self):
+        """Return the kept index or None if not enabled."""
+        return self.get() if self.caching else None
+
+    def get(self):
+        with self._lock:
+            index = self._index
+            if index is None:
+                index = DiskIndex(udev.udev_all_block_device_properties())
+                LOG.debug('disk index: %d disks', len(index.disks))
+                if self.caching:
+                    self._index = index
+            return index
+
+
+DISK_INDEX = DiskIndexCache()
+
+
 def lookup_disk(serial):
     """
     Search for a disk by its serial number using /dev/disk/by-id/
@@ -930,8 +1128,9 @@ def lookup_disk(serial):
     serial_udev = serial.replace(' ', '_')
     LOG.info('Processing serial %s via udev to %s', serial, serial_udev)
 
-    disks = list(filter(lambda x: serial_udev in x,
-                        os.listdir("/dev/disk/by-id/")))
+    index = DISK_INDEX.current()
+    by_id = index.by_id if index else os.listdir("/dev/disk/by-id/")
+    disks = list(filter(lambda x: serial_udev in x, by_id))
     if not disks or len(disks) < 1:
         raise ValueError("no disk with serial '%s' found" % serial_udev)
 
@@ -940,13 +1139,18 @@ def lookup_disk(serial):
     # determine the path to the block device in /dev/
     disks.sort(key=lambda x: len(x))
     LOG.debug('lookup_disks found: %s', disks)
-    path = os.path.realpath("/dev/disk/by-id/%s" % disks[0])
+    info = None
+    if index:
+        info = index.by_id[disks[0]]
+        path = info['DEVNAME']
+    else:
+        path = os.path.realpath("/dev/disk/by-id/%s" % disks[0])
     # /dev/dm-X
-    if multipath.is_mpath_device(path):
-        info = udevadm_info(path)
+    if multipath.is_mpath_device(path, info):
+        info = info or udevadm_info(path)
         path = os.path.join('/dev/mapper', info['DM_NAME'])
     # /dev/sdX
-    elif multipath.is_mpath_member(path):
+    elif multipath.is_mpath_member(path, info):
         mp_name = multipath.find_mpath_id_by_path(path)
         path = os.path.join('/dev/mapper', mp_name)
 
@@ -966,6 +1170,9 @@ def lookup_dasd(bus_id):
     """
 
     LOG.info('Processing ccw bus_id %s', bus_id)
+    index = DISK_INDEX.current()
+    if index and bus_id in index.by_ccw:
+        return index.by_ccw[bus_id]['DEVNAME']
     sys_ccw_dev = '/sys/bus/ccw/devices/%s/block' % bus_id
     if not os.path.exists(sys_ccw_dev):
         raise ValueError('Failed to find a block device at %s' % sys_ccw_dev)
@@ -1316,7 +1523,8 @@ def wipe_volume(path, mode="superblock", exclusive=True):
     :param path: a path to a block device
     :param mode: how to wipe it.
        pvremove: wipe a lvm physical volume
-       zero: write zeros to the entire volume
+       zero: write zeros to the entire volume (offloaded to the device
+             with BLKZEROOUT when supported)
        random: write random data (/dev/urandom) to the entire volume
        superblock: zero the beginning and the end of the volume
        superblock-recursive: zero the beginning of the volume, the end of the
@@ -1324,6 +1532,14 @@ def wipe_volume(path, mode="superblock", exclusive=True):
                     known to be on this device.
     :param exclusive: boolean to control how path is opened
     """
+    try:
+        _wipe_volume(path, mode, exclusive)
+    finally:
+        # drop what was probed of the volume before and while it was wiped
+        PROBE_CACHE.invalidate()
+
+
+def _wipe_volume(path, mode, exclusive):
     if mode == "pvremove":
         # We need to use --force --force in case it's already in a volgroup and
         # pvremove doesn't want to remove it
@@ -1334,11 +1550,9 @@ def wipe_volume(path, mode="superblock", exclusive=True):
         util.subp(['pvremove', '--force', '--force', '--yes', path],
                   rcs=[0, 5], capture=True)
         lvm.lvm_scan()
-    elif mode == "zero":
-        wipe_file(path, exclusive=exclusive)
-    elif mode == "random":
-        with open("/dev/urandom", "rb") as reader:
-            wipe_file(path, reader=reader.read, exclusive=exclusive)
+    elif mode in ("zero", "random"):
+        with exclusive_open(path, exclusive=exclusive) as fp:
+            wipe.wipe_fd(fp.fileno(), path, mode=mode)
     elif mode == "superblock":
         quick_zero(path, partitions=False, exclusive=exclusive)
     elif mode == "superblock-recursive":
@@ -6,7 +6,7 @@ import time
 
 from curtin import util
 from curtin.log import LOG
-from curtin.udev import udevadm_settle
+from curtin.udev import wait_for_device
 from . import dev_path, sys_block_path
 
 # Wait up to 20 minutes (150 + 300 + 750 = 1200 seconds)
@@ -393,16 +393,14 @@ def ensure_bcache_is_registered(bcache_device, expected, retry=None):
         # backing device's holders directory.
         LOG.debug('check just created bcache %s if it is registered,'
                   ' try=%s', bcache_device, attempt + 1)
+        found = False
         try:
-            udevadm_settle()
-            if os.path.exists(expected):
-                LOG.debug('Found bcache dev %s at expected path %s',
-                          bcache_device, expected)
-                validate_bcache_ready(bcache_device, expected)
-            else:
-                msg = 'bcache device path not found: %s' % expected
-                LOG.debug(msg)
-                raise ValueError(msg)
+            # wait for udev to create this device rather than settling
+            wait_for_device(expected, timeout=wait, initialized=True)
+            found = True
+            LOG.debug('Found bcache dev %s at expected path %s',
+                      bcache_device, expected)
+            validate_bcache_ready(bcache_device, expected)
 
             # if bcache path exists and holders are > 0 we can return
             LOG.debug('bcache dev %s at path %s successfully registered'
@@ -413,7 +411,7 @@ def ensure_bcache_is_registered(bcache_device, expected, retry=None):
         except (OSError, IndexError, ValueError):
             # Some versions of bcache-tools will register the bcache device
             # as soon as we run make-bcache using udev rules, so wait for
-            # udev to settle, then try to locate the dev, on older versions
+            # udev to create it, then try to locate the dev, on older versions
             # we need to register it manually though
             LOG.debug('bcache device was not registered, registering %s '
                       'at /sys/fs/bcache/register', bcache_device)
@@ -426,9 +424,12 @@ def ensure_bcache_is_registered(bcache_device, expected, retry=None):
                 # check it all again
                 pass
 
-        LOG.debug("bcache dev %s not ready, waiting %ss",
-                  bcache_device, wait)
-        time.sleep(wait)
+        if found:
+            # the wait returned at once, give the kernel time to finish
+            # registering the device before checking again
+            LOG.debug("bcache dev %s not ready, waiting %ss",
+                      bcache_device, wait)
+            time.sleep(wait)
 
     # we've exhausted our retries
     LOG.warning('Repetitive error registering the bcache dev %s',
@@ -6,8 +6,11 @@ top of a block device, making it possible to reuse the block device without
 having to reboot the system
 """
 
+from concurrent import futures
+import errno
 import glob
 import os
+import re
 import time
 
 from curtin import (block, udev, util)
@@ -18,6 +21,7 @@ from curtin.block import mdadm
 from curtin.block import multipath
 from curtin.block import zfs
 from curtin.log import LOG
+from curtin.reporter import events
 
 # poll frequenty, but wait up to 60 seconds total
 MDADM_RELEASE_RETRIES = [0.4] * 150
@@ -34,7 +38,8 @@ def _define_handlers_registry():
         'crypt': {'shutdown': shutdown_crypt, 'ident': identify_crypt},
         'raid': {'shutdown': shutdown_mdadm, 'ident': identify_mdadm},
         'bcache': {'shutdown': shutdown_bcache, 'ident': identify_bcache},
-        'disk': {'ident': lambda x: False, 'shutdown': wipe_superblock},
+        'disk': {'ident': lambda device, snapshot=None: False,
+                 'shutdown': wipe_superblock},
     }
 
 
@@ -355,46 +360,55 @@ def _wipe_superblock(blockdev, exclusive=True):
                 time.sleep(wait)
 
 
-def identify_lvm(device):
+def _dm_uuid(device, snapshot=None):
+    if snapshot is not None:
+        return snapshot.dm_uuid(block.path_to_kname(device))
+    return get_dmsetup_uuid(device)
+
+
+def identify_lvm(device, snapshot=None):
     """
     determine if specified device is a lvm device
     """
     return (block.path_to_kname(device).startswith('dm') and
-            get_dmsetup_uuid(device).startswith('LVM'))
+            _dm_uuid(device, snapshot).startswith('LVM'))
 
 
-def identify_crypt(device):
+def identify_crypt(device, snapshot=None):
     """
     determine if specified device is dm-crypt device
     """
     return (block.path_to_kname(device).startswith('dm') and
-            get_dmsetup_uuid(device).startswith('CRYPT'))
+            _dm_uuid(device, snapshot).startswith('CRYPT'))
 
 
-def identify_mdadm(device):
+def identify_mdadm(device, snapshot=None):
     """
     determine if specified device is a mdadm device
     """
     # RAID0 and 1 devices can be partitioned and the partitions are *not*
     # raid devices with a sysfs 'md' subdirectory
-    partition = identify_partition(device)
+    partition = identify_partition(device, snapshot=snapshot)
     return block.path_to_kname(device).startswith('md') and not partition
 
 
-def identify_bcache(device):
+def identify_bcache(device, snapshot=None):
     """
     determine if specified device is a bcache device
     """
     # bcache devices can be partitioned and the partitions are *not*
     # bcache devices with a sysfs 'slaves' subdirectory
-    partition = identify_partition(device)
+    partition = identify_partition(device, snapshot=snapshot)
     return block.path_to_kname(device).startswith('bcache') and not partition
 
 
-def identify_partition(device):
+def identify_partition(device, snapshot=None):
     """
     determine if specified device is a partition
     """
+    if snapshot is not None:
+        return snapshot.is_partition(block.path_to_kname(device))
+
     path = os.path.join(device, 'partition')
     if os.path.exists(path):
         return True
@@ -431,19 +445,126 @@ def get_holders(device):
     return holders
 
 
-def gen_holders_tree(device):
+class StorageSnapshot(object):
+    """
+    Snapshot of the block device topology used to build holders trees.
+
+    The holders and partitions of every block device come from one walk of
+    sysfs and the device mapper uuids of all dm devices from one 'dmsetup
+    info' call, so that identifying the devices in a holders tree does not
+    run any command per device.  Multipath partitions are the dm devices
+    whose uuid is 'part<N>-mpath-<wwid>'.  The snapshot is taken on first
+    use and not updated, so it is only kept while planning: use a new one
+    once the topology has changed.
+    """
+
+    mpath_partition_uuid = re.compile(r'part\d+-mpath-')
+
+    def __init__(self, sysfs_root='/sys/class/block'):
+        self.sysfs_root = sysfs_root
+        self._holders = None
+        self._partitions = None
+        self._dm_uuids = None
+
+    def _load(self):
+        holders = {}
+        partitions = {}
+        for kname in os.listdir(self.sysfs_root):
+            syspath = os.path.join(self.sysfs_root, kname)
+            try:
+                holders[kname] = sorted(
+                    os.listdir(os.path.join(syspath, 'holders')))
+            except FileNotFoundError:
+                holders[kname] = []
+            if os.path.exists(os.path.join(syspath, 'partition')):
+                partitions.setdefault(kname, None)
+        for kname in holders:
+            if kname in partitions:
+                continue
+            syspath = os.path.join(self.sysfs_root, kname)
+            partitions[kname] = [
+                entry for entry in sorted(os.listdir(syspath))
+                if entry in holders and os.path.exists(
+                    os.path.join(syspath, entry, 'partition'))]
+        self._holders = holders
+        self._partitions = partitions
+        self._dm_uuids = {}
+        if any(kname.startswith('dm') for kname in holders):
+            self._dm_uuids = self._load_dm_uuids()
+
+    def _load_dm_uuids(self):
+        try:
+            (out, _) = util.subp(['dmsetup', 'info', '-c', '--noheadings',
+                                  '--separator', '|', '-o',
+                                  'blkdevname,uuid'], capture=True)
+        except util.ProcessExecutionError as e:
+            LOG.debug('dmsetup info failed, querying devices one by one: %s',
+                      e)
+            return {}
+        dm_uuids = {}
+        for line in out.splitlines():
+            kname, _, dm_uuid = line.strip().partition('|')
+            if kname:
+                dm_uuids[kname] = dm_uuid.strip()
+        return dm_uuids
+
+    def _ensure_loaded(self):
+        if self._holders is None:
+            self._load()
+
+    def sys_block_path(self, device):
+        """Return the snapshot path of device, like block.sys_block_path."""
+        self._ensure_loaded()
+        kname = block.path_to_kname(device)
+        if kname not in self._holders:
+            err = OSError("devname '{}' did not have existing syspath '{}'"
+                          .format(device, os.path.join(self.sysfs_root,
+                                                       kname)))
+            err.errno = errno.ENOENT
+            raise err
+        return os.path.join(self.sysfs_root, kname)
+
+    def holders(self, kname):
+        self._ensure_loaded()
+        return self._holders.get(kname, [])
+
+    def partitions(self, kname):
+        self._ensure_loaded()
+        return self._partitions.get(kname) or []
+
+    def dm_uuid(self, kname):
+        self._ensure_loaded()
+        if kname not in self._dm_uuids:
+            self._dm_uuids[kname] = get_dmsetup_uuid(
+                os.path.join(self.sysfs_root, kname))
+        return self._dm_uuids[kname]
+
+    def is_partition(self, kname):
+        self._ensure_loaded()
+        if self._partitions.get(kname, []) is None:
+            return True
+        return bool(kname.startswith('dm-') and
+                    self.mpath_partition_uuid.match(self.dm_uuid(kname)))
+
+
+def gen_holders_tree(device, snapshot=None):
     """
     generate a tree representing the current storage hirearchy above 'device'
+
+    the devices are looked up in snapshot, a StorageSnapshot, which is taken
+    when not given
     """
-    device = block.sys_block_path(device)
+    if snapshot is None:
+        snapshot = StorageSnapshot()
+    device = snapshot.sys_block_path(device)
     dev_name = block.path_to_kname(device)
     # the holders for a device should consist of the devices in the holders/
     # dir in sysfs and any partitions on the device. this ensures that a
     # storage tree starting from a disk will include all devices holding the
     # disk's partitions
-    holders = get_holders(device)
-    holder_paths = ([block.sys_block_path(h) for h in holders] +
-                    block.get_sysfs_partitions(device))
+    holder_paths = [os.path.join(snapshot.sysfs_root, kname)
+                    for kname in (snapshot.holders(dev_name) +
+                                  snapshot.partitions(dev_name))]
     # the DEV_TYPE registry contains a function under the key 'ident' for each
     # device type entry that returns true if the device passed to it is of the
     # correct type. there should never be a situation in which multiple
@@ -454,11 +575,13 @@ def gen_holders_tree(device):
     # (DEFAULT_DEV_TYPE). the identify function for disk never returns true.
     # the next() builtin in python will not raise a StopIteration exception if
     # there is a default value defined
-    dev_type = next((k for k, v in DEV_TYPES.items() if v['ident'](device)),
+    dev_type = next((k for k, v in DEV_TYPES.items()
+                     if v['ident'](device, snapshot=snapshot)),
                     DEFAULT_DEV_TYPE)
     return {
         'device': device, 'dev_type': dev_type, 'name': dev_name,
-        'holders': [gen_holders_tree(h) for h in holder_paths],
+        'holders': [gen_holders_tree(h, snapshot=snapshot)
+                    for h in holder_paths],
     }
 
 
@@ -592,7 +715,8 @@ def assert_clear(base_paths):
         base_paths = [base_paths]
     base_paths = [block.sys_block_path(path, strict=False)
                   for path in base_paths]
-    for holders_tree in [gen_holders_tree(p)
+    snapshot = StorageSnapshot()
+    for holders_tree in [gen_holders_tree(p, snapshot=snapshot)
                          for p in base_paths if os.path.exists(p)]:
         if any(holder_type not in valid and path not in base_paths
                for (holder_type, path) in get_holder_types(holders_tree)):
@@ -600,26 +724,33 @@ def assert_clear(base_paths):
                           .format(format_holders_tree(holders_tree)))
 
 
-def clear_holders(base_paths, try_preserve=False):
+def get_shutdown_groups(holders_trees):
     """
-    Clear all storage layers depending on the devices specified in 'base_paths'
-    A single device or list of devices can be specified.
-    Device paths can be specified either as paths in /dev or /sys/block
-    Will throw OSError if any holders could not be shut down
+    split holders trees into groups which share no device
+
+    trees that hold a common device, like the disks of a raid array, end up
+    in the same group.  the groups and the trees in each group are sorted by
+    device, so that the groups can be planned and shut down independently
     """
-    # handle single path
-    if not isinstance(base_paths, (list, tuple)):
-        base_paths = [base_paths]
-    LOG.info('Generating device storage trees for path(s): %s', base_paths)
+    groups = []
+    for tree in sorted(holders_trees, key=lambda x: x['device']):
+        devices = {device for (_, device) in get_holder_types(tree)}
+        trees = [tree]
+        for group in [g for g in groups if g[0] & devices]:
+            groups.remove(group)
+            devices |= group[0]
+            trees = group[1] + trees
+        groups.append((devices, trees))
+    return sorted([sorted(trees, key=lambda x: x['device'])
+                   for (_, trees) in groups],
+                  key=lambda trees: trees[0]['device'])
 
-    # get current holders and plan how to shut them down
-    holder_trees = [gen_holders_tree(path) for path in base_paths]
-    LOG.info('Current device storage tree:\n%s',
-             '\n'.join(format_holders_tree(tree) for tree in holder_trees))
-    ordered_devs = plan_shutdown_holder_trees(holder_trees)
-    LOG.info('Shutdown Plan:\n%s', "\n".join(map(str, ordered_devs)))
 
-    # run shutdown functions
+def shutdown_holders(ordered_devs, try_preserve=False):
+    """
+    run the shutdown function of each device in a plan from
+    plan_shutdown_holder_trees in order
+    """
     for dev_info in ordered_devs:
         dev_type = DEV_TYPES.get(dev_info['dev_type'])
         shutdown_function = dev_type.get('shutdown')
@@ -638,6 +769,48 @@ def clear_holders(base_paths, try_preserve=False):
             shutdown_function(dev_info['device'])
 
 
+def clear_holders(base_paths, try_preserve=False, workers=1):
+    """
+    Clear all storage layers depending on the devices specified in 'base_paths'
+    A single device or list of devices can be specified.
+    Device paths can be specified either as paths in /dev or /sys/block
+    With workers greater than 1, groups of devices that share no holders are
+    shut down concurrently on up to that many threads.
+    Will throw OSError if any holders could not be shut down
+    """
+    # handle single path
+    if not isinstance(base_paths, (list, tuple)):
+        base_paths = [base_paths]
+    LOG.info('Generating device storage trees for path(s): %s', base_paths)
+
+    # get current holders and plan how to shut them down
+    snapshot = StorageSnapshot()
+    holder_trees = [gen_holders_tree(path, snapshot=snapshot)
+                    for path in base_paths]
+    LOG.info('Current device storage tree:\n%s',
+             '\n'.join(format_holders_tree(tree) for tree in holder_trees))
+
+    groups = get_shutdown_groups(holder_trees) if workers > 1 else []
+    if len(groups) < 2:
+        ordered_devs = plan_shutdown_holder_trees(holder_trees)
+        LOG.info('Shutdown Plan:\n%s', "\n".join(map(str, ordered_devs)))
+        shutdown_holders(ordered_devs, try_preserve=try_preserve)
+        return
+
+    plans = [plan_shutdown_holder_trees(trees) for trees in groups]
+    for (group_no, ordered_devs) in enumerate(plans):
+        LOG.info('Shutdown Plan for group %d of %d:\n%s', group_no + 1,
+                 len(plans), "\n".join(map(str, ordered_devs)))
+    with futures.ThreadPoolExecutor(
+            max_workers=min(workers, len(plans))) as executor:
+        jobs = [executor.submit(events.inherit_stack(shutdown_holders),
+                                ordered_devs, try_preserve)
+                for ordered_devs in plans]
+    # raise the error of the first group once all groups are done
+    for job in jobs:
+        job.result()
+
+
 def start_clear_holders_deps():
     """
     prepare system for clear holders to be able to scan old devices
@@ -0,0 +1,678 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Streaming writer for dd-* disk images.
+
+The image is read from a file or url and decompressed by a pipeline thread
+while the calling thread writes it to the target.  Runs of zero bytes are
+not written: a regular file is left sparse and on a block device that can
+zero ranges without writing them (WRITE ZEROES) the range is zeroed with
+the BLKZEROOUT ioctl instead.  When the source has a 'sha256', the digest
+of the fetched file is checked once it has been read completely.
+
+A source may also have a 'bmap', a block map in the bmaptool XML format or
+as JSON, listing the ranges of the image that hold data.  Only those ranges
+are written and each is checked against its checksum from the map.  Raw
+local images are read with seeks over the unmapped ranges.
+"""
+
+import bz2
+import fcntl
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import os
+import queue
+import stat
+import struct
+import subprocess
+import tarfile
+import threading
+from xml.etree import ElementTree
+
+from curtin import url_helper, util
+from curtin.block import wipe
+from curtin.log import LOG
+from curtin.reporter import events
+
+# size of the blocks handed from the pipeline thread to the writer
+IMAGE_BLOCK_SIZE = 4 * 1024 * 1024
+# granularity at which runs of zeros are detected and skipped
+ZERO_BLOCK_SIZE = 64 * 1024
+# blocks buffered between the pipeline thread and the writer
+QUEUE_DEPTH = 8
+READ_SIZE = 1024 * 1024
+# report progress every PROGRESS_STEP percent of the source
+PROGRESS_STEP = 10
+
+# linux/fs.h: _IO(0x12, 119)
+BLKDISCARD = 0x1277
+
+# dd source type -> (compression, whether the image is in a tar archive)
+IMAGE_FORMATS = {
+    'dd-raw': (None, False),
+    'dd-gz': ('gz', False),
+    'dd-bz2': ('bz2', False),
+    'dd-xz': ('xz', False),
+    'dd-zst': ('zst', False),
+    'dd-tar': (None, True),
+    'dd-tgz': ('gz', True),
+    'dd-tbz': ('bz2', True),
+    'dd-txz': ('xz', True),
+    'dd-tzst': ('zst', True),
+}
+
+
+class BlockMap(object):
+    """The block map of an image.
+
+    ranges is a list of (start, end, checksum) tuples with the byte offsets
+    of the mapped data, end exclusive, and the checksum of the range (or
+    None) of checksum_type.
+    """
+
+    def __init__(self, image_size, block_size, ranges,
+                 checksum_type='sha256'):
+        self.image_size = image_size
+        self.block_size = block_size
+        self.checksum_type = checksum_type
+        self.ranges = []
+        for (first, last, checksum) in sorted(ranges):
+            if first > last or (self.ranges and
+                                first * block_size < self.ranges[-1][1]):
+                raise ValueError('invalid block map range %d-%d' %
+                                 (first, last))
+            self.ranges.append(
+                (first * block_size,
+                 min((last + 1) * block_size, image_size),
+                 checksum.lower() if checksum else None))
+        if self.ranges and self.ranges[-1][1] <= self.ranges[-1][0]:
+            raise ValueError('block map range beyond image size %d' %
+                             image_size)
+
+    @property
+    def mapped_size(self):
+        return sum(end - start for (start, end, _) in self.ranges)
+
+    def unmapped(self):
+        """Return (start, end) tuples of the ranges not in the map."""
+        gaps = []
+        pos = 0
+        for (start, end, _) in self.ranges + [(self.image_size, None, None)]:
+            if start > pos:
+                gaps.append((pos, start))
+            pos = end
+        return gaps
+
+
+def _parse_range(text):
+    (first, _, last) = text.strip().partition('-')
+    return (int(first), int(last or first))
+
+
+def _parse_bmap_xml(content):
+    root = ElementTree.fromstring(content)
+    version = root.get('version', '1.0')
+    checksum_type = 'sha1'
+    if int(version.split('.')[0]) >= 2:
+        checksum_type = root.findtext('ChecksumType', 'sha256').strip()
+    expected = root.findtext('BmapFileChecksum')
+    if expected:
+        # the checksum is of the file with the checksum itself zeroed
+        expected = expected.strip()
+        zeroed = content.replace(expected.encode(),
+                                 b'0' * len(expected), 1)
+        found = hashlib.new(checksum_type, zeroed).hexdigest()
+        if found != expected.lower():
+            raise ValueError('block map checksum is %s, expected %s' %
+                             (found, expected))
+    ranges = []
+    for elem in root.iter('Range'):
+        (first, last) = _parse_range(elem.text)
+        ranges.append(
+            (first, last, elem.get('chksum') or elem.get('sha1')))
+    return BlockMap(int(root.findtext('ImageSize')),
+                    int(root.findtext('BlockSize')), ranges, checksum_type)
+
+
+def _parse_bmap_json(content):
+    data = json.loads(content.decode())
+    ranges = []
+    for entry in data['ranges']:
+        if isinstance(entry, dict):
+            ranges.append((entry['first'], entry.get('last', entry['first']),
+                           entry.get('checksum')))
+        else:
+            ranges.append((entry[0], entry[-1], None))
+    return BlockMap(data['image_size'], data.get('block_size', 4096), ranges,
+                    data.get('checksum_type', 'sha256'))
+
+
+def parse_bmap(content):
+    """Parse the bytes of a block map file.
+
+    The bmaptool XML format is supported as well as JSON like::
+
+        {"image_size": 821752, "block_size": 4096,
+         "checksum_type": "sha256",
+         "ranges": [{"first": 0, "last": 1, "checksum": "..."}, [9, 9]]}
+
+    where the ranges are inclusive block numbers and the checksum is
+    optional.
+    """
+    if content.lstrip().startswith(b'<'):
+        return _parse_bmap_xml(content)
+    return _parse_bmap_json(content)
+
+
+def load_bmap(source):
+    """Return the BlockMap for the source, None if it has none.
+
+    source['bmap'] is the path or url of the block map, or True for the
+    image uri with '.bmap' appended, in which case a missing block map
+    means the whole image is written.
+    """
+    uri = source.get('bmap')
+    if not uri:
+        return None
+    if uri is True:
+        uri = source['uri'] + '.bmap'
+    if uri.startswith('file://'):
+        uri = uri[len('file://'):]
+    try:
+        if '://' in uri:
+            content = url_helper.geturl(uri)
+        else:
+            content = util.load_file(uri, decode=False)
+    except (IOError, OSError) as e:
+        if source['bmap'] is not True:
+            raise
+        LOG.debug('no block map for %s, writing all of it: %s',
+                  source['uri'], e)
+        return None
+    return parse_bmap(content)
+
+
+class ImageProgress(events.ProgressReporter):
+    """Log and report the progress of writing an image every step percent
+    of the source, or every GiB written if the source size is unknown."""
+
+    def __init__(self, uri, target, size=None, step=PROGRESS_STEP):
+        super(ImageProgress, self).__init__(
+            'write-image-%s' % os.path.basename(target),
+            'writing %s to %s' % (uri, target),
+            step if size else 1024 ** 3)
+        self.size = size
+        self.fetched = 0
+        self.written = 0
+        self.skipped = 0
+
+    def update(self):
+        if self.size:
+            done = self.fetched * 100 // self.size
+        else:
+            done = self.written + self.skipped
+        if self.due(done):
+            self.report()
+
+    def report(self):
+        image_bytes = self.written + self.skipped
+        if self.size:
+            msg = '%d%% (fetched %d of %d bytes, ' % (
+                self.fetched * 100 // self.size, self.fetched, self.size)
+        else:
+            msg = '(fetched %d bytes, ' % self.fetched
+        msg += 'wrote %d bytes, skipped %d zero bytes, %.1f MB/s)' % (
+            self.written, self.skipped, image_bytes / self.elapsed / 1e6)
+        self.report_progress(msg)
+
+
+class _SourceReader(object):
+    """Read the source file, counting and optionally hashing the bytes."""
+
+    def __init__(self, fp, progress, digest=None):
+        self.fp = fp
+        self.progress = progress
+        self.digest = digest
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = READ_SIZE
+        buf = self.fp.read(size)
+        if buf:
+            self.progress.fetched += len(buf)
+            if self.digest:
+                self.digest.update(buf)
+        return buf
+
+    def drain(self):
+        while self.read(READ_SIZE):
+            pass
+
+    def close(self):
+        self.fp.close()
+
+    def seek(self, offset):
+        self.fp.seek(offset)
+
+
+class _ProcessReader(object):
+    """Read the output of cmd with src fed to its input by a thread."""
+
+    def __init__(self, cmd, src):
+        self.cmd = cmd
+        self.error = None
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+        self.feeder = threading.Thread(target=self._feed, args=(src,),
+                                       daemon=True)
+        self.feeder.start()
+
+    def _feed(self, src):
+        try:
+            while True:
+                buf = src.read(READ_SIZE)
+                if not buf:
+                    break
+                self.proc.stdin.write(buf)
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def read(self, size=-1):
+        if self.proc.returncode is not None:
+            return b''
+        buf = self.proc.stdout.read(size)
+        if not buf:
+            self.close()
+        return buf
+
+    def kill(self):
+        if self.proc.returncode is None:
+            self.proc.kill()
+            self.proc.stdout.close()
+            self.proc.wait()
+
+    def close(self):
+        if self.proc.returncode is not None:
+            return
+        self.proc.stdout.close()
+        self.feeder.join()
+        ret = self.proc.wait()
+        if self.error:
+            raise self.error
+        if ret != 0:
+            raise util.ProcessExecutionError(cmd=self.cmd, exit_code=ret)
+
+
+class _TarReader(object):
+    """Read the regular files of a tar stream one after the other, like
+    'tar -xO'."""
+
+    def __init__(self, fileobj, mode):
+        self.tar = tarfile.open(fileobj=fileobj, mode=mode)
+        self.member = None
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done:
+            if self.member is None:
+                info = self.tar.next()
+                if info is None:
+                    self.done = True
+                    break
+                if not info.isreg():
+                    continue
+                self.member = self.tar.extractfile(info)
+            buf = self.member.read(size)
+            if buf:
+                return buf
+            self.member = None
+        return b''
+
+
+def _decompressor(src, compression):
+    if compression == 'gz':
+        return gzip.GzipFile(fileobj=src, mode='rb')
+    if compression == 'bz2':
+        return bz2.BZ2File(src)
+    if compression == 'xz':
+        return lzma.LZMAFile(src)
+    if compression == 'zst':
+        return _ProcessReader(['zstd', '-dc'], src)
+    return src
+
+
+def open_image_source(uri):
+    """Open uri, a local path or file:// or http(s):// url, for reading.
+
+    Returns a tuple of the file object and its size, None if unknown.
+    """
+    if uri.startswith('file://'):
+        uri = uri[len('file://'):]
+    if '://' not in uri:
+        fp = open(uri, 'rb')
+        return (fp, os.fstat(fp.fileno()).st_size)
+    fp = url_helper.UrlReader(uri)
+    try:
+        size = int(fp.size)
+    except (TypeError, ValueError):
+        size = -1
+    return (fp, size if size >= 0 else None)
+
+
+def _read_block(reader, size):
+    """Read size bytes from reader, fewer only at the end of the stream."""
+    parts = []
+    got = 0
+    while got < size:
+        buf = reader.read(size - got)
+        if not buf:
+            break
+        parts.append(buf)
+        got += len(buf)
+    return b''.join(parts)
+
+
+def _produce(reader, source, blocks, stop, block_size, ranges=None):
+    """Pipeline thread: put (offset, data) blocks of the decompressed image
+    on blocks, followed by None at the end of the image or the exception
+    raised.  If ranges, a list of (start, end) offsets, is given only those
+    ranges are read from the seekable source."""
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    try:
+        if ranges is None:
+            offset = 0
+            while not stop.is_set():
+                buf = _read_block(reader, block_size)
+                if not buf:
+                    break
+                put((offset, buf))
+                offset += len(buf)
+            if not stop.is_set():
+                # read the rest of the source, like tar padding, so the
+                # digest covers all of it
+                source.drain()
+        for (start, end) in ranges or []:
+            source.seek(start)
+            offset = start
+            while offset < end and not stop.is_set():
+                buf = _read_block(reader, min(block_size, end - offset))
+                if not buf:
+                    break
+                put((offset, buf))
+                offset += len(buf)
+        put(None)
+    except BaseException as e:
+        put(e)
+
+
+def _write_zeroes_offloaded(path):
+    """Return True if the block device at path zeroes ranges without the
+    zeros being written to it."""
+    syspath = os.path.realpath(os.path.join('/sys/class/block',
+                                            os.path.basename(
+                                                os.path.realpath(path))))
+    if os.path.exists(os.path.join(syspath, 'partition')):
+        syspath = os.path.dirname(syspath)
+    try:
+        return int(util.load_file(os.path.join(
+            syspath, 'queue', 'write_zeroes_max_bytes'))) > 0
+    except (IOError, OSError, ValueError):
+        return False
+
+
+class _ImageTarget(object):
+    """Write an image to fd, skipping runs of zeros if zero_mode is 'seek'
+    (the target reads zeros there) or 'zeroout' (zero with BLKZEROOUT)."""
+
+    def __init__(self, fd, zero_mode, progress):
+        self.fd = fd
+        self.zero_mode = zero_mode
+        self.progress = progress
+        self.pos = 0
+        self.zero_start = None
+        self.zeros = bytes(ZERO_BLOCK_SIZE)
+
+    def _pwrite(self, view, offset):
+        while len(view):
+            done = os.pwrite(self.fd, view, offset)
+            view = view[done:]
+            offset += done
+        self.progress.written += offset - self.pos
+
+    def _flush_zeros(self):
+        if self.zero_start is None:
+            return
+        (start, length) = (self.zero_start, self.pos - self.zero_start)
+        self.zero_start = None
+        if self.zero_mode == 'zeroout':
+            try:
+                fcntl.ioctl(self.fd, wipe.BLKZEROOUT,
+                            struct.pack('QQ', start, length))
+                self.progress.skipped += length
+                return
+            except OSError as e:
+                if e.errno not in wipe._UNSUPPORTED_ERRNOS:
+                    raise
+                LOG.debug('BLKZEROOUT not supported, writing zeros: %s', e)
+                self.zero_mode = 'write'
+        elif self.zero_mode == 'seek':
+            self.progress.skipped += length
+            return
+        end = start + length
+        while start < end:
+            count = min(ZERO_BLOCK_SIZE, end - start)
+            pos, self.pos = self.pos, start
+            self._pwrite(memoryview(self.zeros)[:count], start)
+            self.pos = pos
+            start += count
+
+    def write(self, pos, buf):
+        """Write buf at pos, the range from the end of the last write to
+        pos is zero."""
+        if pos > self.pos:
+            if self.zero_start is None:
+                self.zero_start = self.pos
+            self.pos = pos
+        view = memoryview(buf)
+        offset = 0
+        data_start = None
+        while offset < len(buf):
+            end = min(offset + ZERO_BLOCK_SIZE, len(buf))
+            is_zero = (self.zero_mode != 'write' and
+                       buf[offset:end] == self.zeros[:end - offset])
+            if is_zero and data_start is not None:
+                self._write_data(view[data_start:offset])
+                data_start = None
+            if is_zero:
+                if self.zero_start is None:
+                    self.zero_start = self.pos
+                self.pos += end - offset
+            elif data_start is None:
+                self._flush_zeros()
+                data_start = offset
+            offset = end
+        if data_start is not None:
+            self._write_data(view[data_start:])
+
+    def _write_data(self, view):
+        self._pwrite(view, self.pos)
+        self.pos += len(view)
+
+    def finish(self):
+        self._flush_zeros()
+
+
+class _BmapTarget(object):
+    """Write the ranges of an image in bmap to fd, checking the checksum of
+    each range, and discard the unmapped ranges of a block device if
+    discard is True."""
+
+    def __init__(self, fd, bmap, progress, discard=False):
+        self.fd = fd
+        self.bmap = bmap
+        self.progress = progress
+        self.discard = discard
+        self.index = 0
+        self.digest = None
+        self.pos = 0
+
+    def write(self, pos, buf):
+        """Write the mapped parts of buf, the image data at pos."""
+        end = pos + len(buf)
+        view = memoryview(buf)
+        while self.index < len(self.bmap.ranges):
+            (rstart, rend, checksum) = self.bmap.ranges[self.index]
+            if rstart >= end:
+                break
+            (start, stop) = (max(rstart, pos), min(rend, end))
+            if start < stop:
+                if start == rstart:
+                    self.digest = hashlib.new(self.bmap.checksum_type)
+                piece = view[start - pos:stop - pos]
+                self.digest.update(piece)
+                while len(piece):
+                    done = os.pwrite(self.fd, piece, start)
+                    piece = piece[done:]
+                    start += done
+                    self.progress.written += done
+            if rend > end:
+                break
+            self._check_range()
+        self.pos = max(self.pos, end)
+
+    def _check_range(self):
+        (start, end, checksum) = self.bmap.ranges[self.index]
+        self.index += 1
+        if checksum and (self.digest is None or
+                         self.digest.hexdigest() != checksum):
+            raise ValueError(
+                'checksum mismatch for image bytes %d-%d, expected %s %s' % (
+                    start, end, self.bmap.checksum_type, checksum))
+
+    def finish(self):
+        if self.pos > self.bmap.image_size:
+            raise ValueError('image is larger than the %d bytes of its block '
+                             'map' % self.bmap.image_size)
+        if self.index < len(self.bmap.ranges):
+            raise ValueError('image ends at %d before the end of its block '
+                             'map at %d' % (self.pos, self.bmap.ranges[-1][1]))
+        self.pos = self.bmap.image_size
+        self.progress.skipped = self.bmap.image_size - self.progress.written
+        if not self.discard or not stat.S_ISBLK(os.fstat(self.fd).st_mode):
+            return
+        for (start, end) in self.bmap.unmapped():
+            try:
+                fcntl.ioctl(self.fd, BLKDISCARD,
+                            struct.pack('QQ', start, end - start))
+            except OSError as e:
+                if e.errno not in wipe._UNSUPPORTED_ERRNOS:
+                    raise
+                LOG.debug('BLKDISCARD not supported: %s', e)
+                return
+
+
+def write_image(source, target, block_size=IMAGE_BLOCK_SIZE):
+    """Write the dd-* image source to target.
+
+    :param source: dict with the image 'type', 'uri' and optionally the
+                   'sha256' of the file at uri, the path or url of a
+                   'bmap' block map and 'bmap_discard' to discard the
+                   unmapped ranges of a block device.
+    :param target: path to the block device or file to write the image to.
+    :returns: dict with the 'size' of the image and the bytes 'written' and
+              'skipped' as zeros or unmapped.
+    :raises: ValueError on an unsupported type or a checksum mismatch.
+    """
+    if source['type'] not in IMAGE_FORMATS:
+        raise ValueError("unsupported image type '%s'" % source['type'])
+    (compression, is_tar) = IMAGE_FORMATS[source['type']]
+    expected = source.get('sha256')
+    digest = hashlib.sha256() if expected else None
+    bmap = load_bmap(source)
+
+    (fp, size) = open_image_source(source['uri'])
+    ranges = None
+    if (bmap and not compression and not is_tar and not digest and
+            isinstance(fp, io.IOBase)):
+        # only read the mapped ranges of a raw local image
+        ranges = [(start, end) for (start, end, _) in bmap.ranges]
+        size = bmap.mapped_size
+    progress = ImageProgress(source['uri'], target, size)
+    src = _SourceReader(fp, progress, digest)
+    blocks = queue.Queue(maxsize=QUEUE_DEPTH)
+    stop = threading.Event()
+    fd = os.open(target, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if stat.S_ISBLK(os.fstat(fd).st_mode):
+            zero_mode = 'zeroout' if _write_zeroes_offloaded(target) else (
+                'write')
+        else:
+            os.ftruncate(fd, 0)
+            zero_mode = 'seek'
+        LOG.debug('writing image %s to %s, size=%s, zeros=%s, bmap=%s',
+                  source['uri'], target, size, zero_mode,
+                  source.get('bmap') if bmap else None)
+        decompressor = _decompressor(src, compression)
+        reader = decompressor
+        if is_tar:
+            reader = _TarReader(reader, 'r|' if compression else 'r|*')
+        pipeline = threading.Thread(
+            target=_produce,
+            args=(reader, src, blocks, stop, block_size, ranges),
+            daemon=True)
+        pipeline.start()
+        if bmap:
+            out = _BmapTarget(fd, bmap, progress,
+                              discard=source.get('bmap_discard', False))
+        else:
+            out = _ImageTarget(fd, zero_mode, progress)
+        try:
+            while True:
+                item = blocks.get()
+                if isinstance(item, BaseException):
+                    raise item
+                if item is None:
+                    break
+                out.write(*item)
+                progress.update()
+            out.finish()
+        finally:
+            stop.set()
+            if isinstance(decompressor, _ProcessReader):
+                decompressor.kill()
+            # abort a download the pipeline is blocked reading from rather
+            # than wait for the rest of it
+            src.close()
+            pipeline.join()
+        if zero_mode == 'seek':
+            os.ftruncate(fd, out.pos)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+        fp.close()
+
+    progress.report()
+    if expected and digest.hexdigest() != expected.lower():
+        raise ValueError(
+            "sha256 of %s is %s, expected %s" % (
+                source['uri'], digest.hexdigest(), expected))
+    return {'size': out.pos, 'written': progress.written,
+            'skipped': progress.skipped}
+
+# vi: ts=4 expandtab syntax=python
@@ -10,7 +10,8 @@ import re
 import shutil
 
 from curtin import (paths, util, udev)
-from curtin.block import (get_device_slave_knames,
+from curtin.block import (DISK_INDEX,
+                          get_device_slave_knames,
                           path_to_kname)
 
 from curtin.log import LOG
@@ -215,6 +216,7 @@ def ensure_disk_connected(rfc4173, write_config=True):
         if write_config:
             save_iscsi_config(iscsi_disk)
         _ISCSI_DISKS.update({rfc4173: iscsi_disk})
+        DISK_INDEX.invalidate()
 
     # this is just a sanity check that the disk is actually present and
     # the above did what we expected
@@ -215,13 +215,18 @@ def mkfs(path, fstype, strict=False, label=None, uuid=None, force=False,
         cmd.extend(extra_options)
 
     cmd.append(path)
-    util.subp(cmd, capture=True)
+    try:
+        util.subp(cmd, capture=True)
+    finally:
+        # drop what was probed before the filesystem was made, including
+        # results probed while mkfs ran
+        block.PROBE_CACHE.invalidate()
 
     # if fs_family does not support specifying uuid then use blkid to find it
     # if blkid is unable to then just return None for uuid
     if fs_family not in family_flag_mappings['uuid']:
         try:
-            uuid = block.blkid()[path]['UUID']
+            uuid = block.PROBE_CACHE.blkid(path)[path]['UUID']
         except Exception:
             pass
 
@@ -0,0 +1,157 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Whole device wiping.
+
+Zeroing uses the BLKZEROOUT ioctl on block devices, which lets the kernel
+offload the work to the device (WRITE ZEROES / WRITE SAME, or unmap where
+the device guarantees zeroed reads).  Otherwise, and for random data, the
+device is written with O_DIRECT from a single page aligned mmap buffer
+which, for random data, is refilled in place from /dev/urandom.
+"""
+
+import errno
+import fcntl
+import mmap
+import os
+import stat
+import struct
+
+from curtin.log import LOG
+from curtin.reporter import events
+
+# linux/fs.h: _IO(0x12, 127)
+BLKZEROOUT = 0x127f
+
+WIPE_BUFLEN = 4 * 1024 * 1024
+# amount of data zeroed per BLKZEROOUT call, so progress can be reported
+ZEROOUT_CHUNK = 1024 * 1024 * 1024
+# report progress every PROGRESS_STEP percent
+PROGRESS_STEP = 10
+
+# errors that mean BLKZEROOUT (or O_DIRECT) is not usable on the device
+_UNSUPPORTED_ERRNOS = (errno.ENOTTY, errno.EOPNOTSUPP, errno.EINVAL,
+                       errno.ENOSYS)
+
+
+class WipeProgress(events.ProgressReporter):
+    """Log and report the progress of wiping path every step percent."""
+
+    def __init__(self, path, size, mode, step=PROGRESS_STEP):
+        super(WipeProgress, self).__init__(
+            'wipe-%s' % os.path.basename(path),
+            'wiping %s with %s' % (path, mode), step)
+        self.path = path
+        self.size = size
+
+    def update(self, done):
+        if not self.size:
+            return
+        percent = done * 100 // self.size
+        if self.due(percent):
+            self.report_progress('%d%% (%d of %d bytes, %.1f MB/s)' % (
+                percent, done, self.size, done / self.elapsed / 1e6))
+
+
+def set_direct_io(fd):
+    """Switch fd of a block device to O_DIRECT, return True on success."""
+    if not stat.S_ISBLK(os.fstat(fd).st_mode):
+        return False
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_DIRECT)
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED_ERRNOS:
+            raise
+        LOG.debug('O_DIRECT not supported: %s', e)
+        return False
+    return True
+
+
+def _device_size(fd):
+    size = os.lseek(fd, 0, os.SEEK_END)
+    os.lseek(fd, 0, os.SEEK_SET)
+    return size
+
+
+def zeroout(fd, size, progress=None, chunk=ZEROOUT_CHUNK):
+    """Zero the block device open at fd with the BLKZEROOUT ioctl.
+
+    Returns the number of bytes zeroed, which is less than size if the
+    device does not support BLKZEROOUT.
+    """
+    pos = 0
+    while pos < size:
+        length = min(chunk, size - pos)
+        try:
+            fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', pos, length))
+        except OSError as e:
+            if pos or e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            LOG.debug('BLKZEROOUT not supported: %s', e)
+            break
+        pos += length
+        if progress:
+            progress.update(pos)
+    return pos
+
+
+def write_buffer(fd, size, offset=0, reader=None, buflen=WIPE_BUFLEN,
+                 progress=None):
+    """Write size - offset bytes to fd starting at offset.
+
+    The data comes from a page aligned buffer of buflen bytes, which is
+    zero unless reader is given.  reader is called as reader(buf) to fill
+    the buffer in place before every write and returns the number of bytes
+    read (like RawIOBase.readinto).
+    """
+    buf = mmap.mmap(-1, buflen)
+    try:
+        with memoryview(buf) as view:
+            os.lseek(fd, offset, os.SEEK_SET)
+            pos = offset
+            while pos < size:
+                count = min(buflen, size - pos)
+                filled = 0
+                while reader is not None and filled < count:
+                    got = reader(view[filled:count])
+                    if not got:
+                        raise ValueError(
+                            "short read on reader got %d expected %d after "
+                            "%d" % (filled, count, pos))
+                    filled += got
+                written = 0
+                while written < count:
+                    written += os.write(fd, view[written:count])
+                pos += count
+                if progress:
+                    progress.update(pos)
+    finally:
+        buf.close()
+    return pos
+
+
+def wipe_fd(fd, path, mode="zero", buflen=WIPE_BUFLEN):
+    """Overwrite all of the file or block device open at fd with zeros
+    (mode=zero) or random data (mode=random)."""
+    if mode not in ('zero', 'random'):
+        raise ValueError("wipe mode %s not supported" % mode)
+
+    is_blk = stat.S_ISBLK(os.fstat(fd).st_mode)
+    direct = set_direct_io(fd)
+    size = _device_size(fd)
+    LOG.debug("%s is %s bytes. wiping with %s, direct=%s, buflen=%s",
+              path, size, mode, direct, buflen)
+    progress = WipeProgress(path, size, mode)
+    done = 0
+    if mode == "zero" and is_blk:
+        done = zeroout(fd, size, progress=progress)
+    if done < size:
+        if mode == "random":
+            with open("/dev/urandom", "rb", buffering=0) as urandom:
+                write_buffer(fd, size, done, reader=urandom.readinto,
+                             buflen=buflen, progress=progress)
+        else:
+            write_buffer(fd, size, done, buflen=buflen, progress=progress)
+    os.fsync(fd)
+
+# vi: ts=4 expandtab syntax=python
@@ -280,6 +280,7 @@ def handle_apt(cfg, target=None):
         generate_sources_list(cfg, release, mirrors, target)
         apply_preserve_sources_list(target)
         rename_apt_lists(mirrors, target)
+        distro.apt_sources_changed(target)
 
     try:
         apply_apt_proxy_config(cfg, target + APT_PROXY_FN,
@@ -803,6 +804,7 @@ def add_apt_sources(srcdict, target=None, template_params=None,
             LOG.exception("failed write to file %s: %s", sourcefn, detail)
             raise
 
+    distro.apt_sources_changed(target)
     distro.apt_update(target=target)
 
     return
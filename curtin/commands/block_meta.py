@@ -3,13 +3,14 @@
 from collections import OrderedDict, namedtuple
 from curtin import (block, compat, config, paths, storage_actions, util)
 from curtin.block import schemas
-from curtin.block import (bcache, clear_holders, dasd, iscsi, lvm, mdadm, mkfs,
-                          multipath, zfs)
+from curtin.block import (bcache, clear_holders, dasd, image, iscsi, lvm,
+                          mdadm, mkfs, multipath, zfs)
 from curtin import distro
 from curtin.log import LOG, logged_time
 from curtin.reporter import events
 from curtin.storage_config import (
     extract_storage_ordered_dict,
+    get_item_references,
     ptable_part_type_to_flag,
     )
 
@@ -17,20 +18,22 @@ from curtin.storage_config import (
 from . import populate_one_subcmd
 from curtin.udev import (
     compose_udev_equality,
-    udev_all_block_device_properties,
     udevadm_info,
     udevadm_settle,
     udevadm_trigger,
+    wait_for_device,
     )
 
+from concurrent import futures
 import glob
+import heapq
 import json
 import os
 import platform
 import string
 import sys
 import tempfile
-import time
+import threading
 
 
 FstabData = namedtuple(
@@ -46,6 +49,22 @@ PTABLE_UNSUPPORTED = schemas._ptable_unsupported
 PTABLES_SUPPORTED = schemas._ptables
 PTABLES_VALID = schemas._ptables_valid
 
+# full disk wipes that are run concurrently, one worker per disk, before
+# the ordered storage config handlers when storage.wipe_workers is set; see
+# meta_prewipe
+PREWIPE_MODES = ('zero', 'random')
+PREWIPE_WORKERS = 0
+
+# seconds devsync waits for a device to appear
+DEVSYNC_TIMEOUT = 10
+
+# storage config item types that carry a partition table; every other item
+# is locked through the disks it is built on; see meta_custom_parallel
+DISK_TYPES = ('disk', 'image', 'device')
+# storage config item types that mount into the target; they are handled
+# one after another in storage config order; see get_action_graph
+MOUNTING_TYPES = ('mount', 'zpool', 'zfs')
+
 SGDISK_FLAGS = {
     "bios_grub": 'ef02',
     "boot": 'ef00',
@@ -93,6 +112,13 @@ CMD_ARGUMENTS = (
 @logged_time("BLOCK_META")
 def block_meta(args):
     # main entry point for the block-meta command.
+    # disks are looked up in an index of the udev properties of all block
+    # devices, built once for the whole command
+    with block.DISK_INDEX.enabled():
+        return _block_meta(args)
+
+
+def _block_meta(args):
     if args.testmode:
         state = {}
     else:
@@ -115,7 +141,9 @@ def block_meta(args):
 
     LOG.debug('clearing devices=%s', devices)
     if devices:
-        meta_clear(devices, state.get('report_stack_prefix', ''))
+        meta_clear(devices, state.get('report_stack_prefix', ''),
+                   workers=cfg.get('storage', {}).get(
+                       'clear_holders_workers', 1))
 
     # dd-images requires use of meta_simple
     if len(dd_images) > 0 and args.force_mode is False:
@@ -145,27 +173,8 @@ def write_image_to_disk(source, dev):
     Write disk image to block device
     """
     LOG.info('writing image to disk %s, %s', source, dev)
-    extractor = {
-        'dd-tgz': '| tar -xOzf -',
-        'dd-txz': '| tar -xOJf -',
-        'dd-tbz': '| tar -xOjf -',
-        'dd-tar': '| smtar -xOf -',
-        'dd-bz2': '| bzcat',
-        'dd-gz': '| zcat',
-        'dd-xz': '| xzcat',
-        'dd-raw': ''
-    }
-    uri = source['uri']
-    if uri.startswith('file://'):
-        uri = uri[len('file://'):]
-        fetch = 'cat "$1"'
-    else:
-        fetch = 'wget "$1" --progress=dot:mega -O - '
     (devname, devnode) = block.get_dev_name_entry(dev)
-    util.subp(args=[
-        'sh', '-c',
-        fetch + extractor[source['type']] + ' | dd bs=4M of="$2"',
-        '--', uri, devnode])
+    image.write_image(source, devnode)
     util.subp(['partprobe', devnode])
 
     for i in range(3):
@@ -234,17 +243,20 @@ def get_partition_format_type(cfg, machine=None, uefi_bootable=None):
     return "mbr"
 
 
-def devsync(devpath):
+def devsync(devpath, partpath=None):
+    """Re-read the partition table of devpath and wait for udev to have
+    handled devpath and partpath, a partition on it, if given."""
     util.subp(['partprobe', devpath], rcs=[0, 1])
+    # a re-read table that keeps its partition numbers leaves the old nodes
+    # and their udev records in place until udev handled the remove and add
+    # events, so only settling the queue tells that udev is done with them
     udevadm_settle()
-    for x in range(0, 10):
-        if os.path.exists(devpath):
-            LOG.debug('devsync happy - path %s now exists', devpath)
-            return
-        else:
-            LOG.debug('Waiting on device path: %s', devpath)
-            time.sleep(1)
-    raise OSError('Failed to find device at path: %s', devpath)
+    for path in [devpath] + ([partpath] if partpath else []):
+        try:
+            wait_for_device(path, timeout=DEVSYNC_TIMEOUT)
+        except OSError:
+            raise OSError('Failed to find device at path: %s', path)
+        LOG.debug('devsync happy - path %s now exists', path)
 
 
 def determine_partition_number(partition_id, storage_config):
@@ -489,26 +501,11 @@ def v1_get_path_to_disk(vol):
 
 
 def v2_get_path_to_disk(vol):
-    all_disks = []
-    link2dev = {}
-
-    for dev in udev_all_block_device_properties():
-        if 'DM_PART' in dev or 'PARTN' in dev:
-            continue
-        for link in dev.get('DEVLINKS', '').split():
-            link2dev[link] = dev
-        link2dev[dev['DEVNAME']] = dev
-        all_disks.append(dev)
-
-    def disks_matching(key, value):
-        return [dev for dev in all_disks if key in dev and dev[key] == value]
-
-    def disk_by_path(path):
-        return link2dev[path]
+    index = block.DISK_INDEX.get()
 
     def disk_by_keys(val, *keys):
         for key in keys:
-            devs = disks_matching(key, val)
+            devs = index.disks_matching(key, val)
             if devs:
                 return devs
         return []
@@ -521,7 +518,7 @@ def v2_get_path_to_disk(vol):
             if multipath.is_mpath_member(dev['DEVNAME'], dev):
                 mpath_id = multipath.get_mpath_id_from_device(
                     dev['DEVNAME'], dev)
-                dev = link2dev['/dev/mapper/' + mpath_id]
+                dev = index.by_link['/dev/mapper/' + mpath_id]
             new_devs.append(dev)
         cands.append(set([dev['DEVNAME'] for dev in new_devs]))
 
@@ -544,7 +541,9 @@ def v2_get_path_to_disk(vol):
         if path.startswith('iscsi:'):
             i = iscsi.ensure_disk_connected(path)
             path = i.devdisk_path
-        dev = disk_by_path(path)
+            # the index is rebuilt if the disk was not connected yet
+            index = block.DISK_INDEX.get()
+        dev = index.disk_by_path(path)
         if dev is not None:
             add_cands(dev)
         else:
@@ -648,9 +647,12 @@ def get_path_to_storage_volume(volume, storage_config):
             volume '%s' with type '%s'" % (volume, vol.get('type')))
 
     # sync devices
-    if not devsync_vol:
-        devsync_vol = volume_path
-    devsync(devsync_vol)
+    if devsync_vol:
+        # the partition table is read from the disk, wait for the
+        # partition too
+        devsync(devsync_vol, volume_path)
+    else:
+        devsync(volume_path)
 
     LOG.debug('return volume path %s', volume_path)
     return volume_path
@@ -796,7 +798,8 @@ def disk_handler(info, storage_config, context):
     else:
         # wipe the disk and create the partition table if instructed to do so
         with util.FlockEx(disk):
-            if config.value_as_boolean(info.get('wipe')):
+            if (config.value_as_boolean(info.get('wipe')) and
+                    info['id'] not in context.prewiped):
                 block.wipe_volume(disk, mode=info.get('wipe'))
             if config.value_as_boolean(ptable):
                 LOG.info("labeling device: '%s' with '%s' partition table",
@@ -1283,13 +1286,13 @@ def mount_data(info, storage_config):
 
 
 def _get_volume_type(device_path):
-    lsblock = block._lsblock([device_path])
+    lsblock = block.PROBE_CACHE.lsblk(device_path)
     kname = block.path_to_kname(device_path)
     return lsblock[kname]['TYPE']
 
 
 def _get_volume_fstype(device_path):
-    lsblock = block._lsblock([device_path])
+    lsblock = block.PROBE_CACHE.lsblk(device_path)
     kname = block.path_to_kname(device_path)
     return lsblock[kname]['FSTYPE']
 
@@ -1724,6 +1727,11 @@ def dm_crypt_handler(info, storage_config, context):
         if remove_keyfile:
             os.remove(keyfile)
 
+    if create_dmcrypt or open_dmcrypt:
+        # the volume was formatted or a mapping added, drop what was
+        # probed before
+        block.PROBE_CACHE.invalidate()
+
     wipe_mode = info.get('wipe')
     if wipe_mode:
         if wipe_mode == 'superblock' and create_dmcrypt:
@@ -2195,13 +2203,223 @@ class BlockMetaContext:
     def __init__(self, handlers):
         self.handlers = handlers
         self.id_to_device = {}
+        # ids of items whose wipe was already done by meta_prewipe
+        self.prewiped = set()
+
+
+def _prewipe_disk_ok(disk):
+    # disks whose path depends on an earlier handler (dasd formatting, nvme
+    # over tcp connect, test images) are left to the ordered handlers
+    return not (disk.get('ptable') == 'vtoc' or
+                any(key in disk for key in
+                    ('device', 'device_id', 'nvme_controller')))
+
+
+def get_prewipe_plan(storage_config):
+    """Return the devices that meta_prewipe can wipe ahead of time.
+
+    These are disks with a zero or random wipe whose partition table is not
+    preserved.  Preserved partitions are left to the partition handlers so
+    they are verified against the config before any data is touched.  The
+    result is an OrderedDict mapping the real path of each disk to a list of
+    (item, path) tuples, in storage config order.
+    """
+    plan = OrderedDict()
+    for item_id, item in storage_config.items():
+        if (item['type'] != 'disk' or
+                item.get('wipe') not in PREWIPE_MODES or
+                config.value_as_boolean(item.get('preserve')) or
+                not _prewipe_disk_ok(item)):
+            continue
+        try:
+            path = get_path_to_storage_volume(item_id, storage_config)
+        except (ValueError, OSError) as e:
+            LOG.debug('Not pre-wiping %s: %s', item_id, e)
+            continue
+        if not os.path.exists(path):
+            continue
+        plan.setdefault(os.path.realpath(path), []).append((item, path))
+    return plan
+
+
+def prewipe_disk(entries, report_prefix=''):
+    """Wipe the (item, path) disk entries of get_prewipe_plan in order.
+
+    Partitions are not prewiped, they are wiped by their own handler.
+    """
+    for item, path in entries:
+        with events.ReportEventStack(
+                name=report_prefix + '/wipe-%s' % item['id'],
+                reporting_enabled=True, level='INFO',
+                description="wiping disk %s (%s) with %s" % (
+                    item['id'], path, item['wipe'])):
+            with util.FlockEx(path):
+                block.wipe_volume(path, mode=item['wipe'])
 
 
-def meta_clear(devices, report_prefix=''):
+def meta_prewipe(storage_config, context, workers=PREWIPE_WORKERS,
+                 report_prefix=''):
+    """Run the zero and random wipes of independent disks concurrently.
+
+    At most workers disks are wiped at the same time and nothing is done
+    when workers is less than 1, the default.  The ids of the wiped items
+    are added to context.prewiped so the disk handler skips them.
+    """
+    plan = get_prewipe_plan(storage_config)
+    if not plan or workers < 1:
+        return
+    with events.ReportEventStack(
+            name=report_prefix + '/prewipe',
+            reporting_enabled=True, level='INFO',
+            description="wiping %d disks with %d workers" % (
+                len(plan), min(workers, len(plan)))):
+        with futures.ThreadPoolExecutor(
+                max_workers=min(workers, len(plan))) as executor:
+            jobs = [executor.submit(events.inherit_stack(prewipe_disk),
+                                    entries, report_prefix)
+                    for entries in plan.values()]
+        # raise the first error in storage config order once all are done
+        for job in jobs:
+            job.result()
+    for entries in plan.values():
+        context.prewiped.update(item['id'] for item, _path in entries)
+
+
+def get_action_graph(storage_config):
+    """Return the ids each storage config item has to be handled after.
+
+    The result is an OrderedDict in storage config order mapping each item
+    id to a set of ids.  Besides the items it refers to, an item waits for
+    the previous partition on the same disk, the previous mount, zpool or
+    zfs item, which all mount into the target, and, for disks, any dasd
+    formatting.  Only items earlier in the storage config
+    are kept, so the graph has no cycles and every order it allows is one
+    the ordered handler loop would accept.
+    """
+    graph = OrderedDict()
+    last_partition = {}
+    last_mount = None
+    dasds = []
+    for item_id, item in storage_config.items():
+        deps = set(get_item_references(item))
+        if item['type'] in DISK_TYPES:
+            deps.update(dasds)
+        elif item['type'] == 'dasd':
+            dasds.append(item_id)
+        elif item['type'] == 'partition':
+            deps.add(last_partition.get(item.get('device')))
+            last_partition[item.get('device')] = item_id
+        elif item['type'] in MOUNTING_TYPES:
+            deps.add(last_mount)
+            last_mount = item_id
+        graph[item_id] = set(dep for dep in deps if dep in graph)
+    return graph
+
+
+def get_action_disks(storage_config):
+    """Return the ids of the disks each storage config item is built on."""
+    disks = {}
+    for item_id, item in storage_config.items():
+        if item['type'] in DISK_TYPES:
+            disks[item_id] = {item_id}
+            continue
+        disks[item_id] = set()
+        for ref in get_item_references(item):
+            disks[item_id].update(disks.get(ref, ()))
+    return disks
+
+
+def handle_storage_item(command, storage_config, context, report_name):
+    handler = context.handlers.get(command['type'])
+    if not handler:
+        raise ValueError("unknown command type '%s'" % command['type'])
+    with events.ReportEventStack(
+            name=report_name, reporting_enabled=True, level="INFO",
+            description="configuring %s: %s" % (command['type'],
+                                                command['id'])):
+        try:
+            handler(command, storage_config, context)
+        except Exception as error:
+            LOG.error("An error occured handling '%s': %s - %s" %
+                      (command['id'], type(error).__name__, error))
+            raise
+
+
+def meta_custom_parallel(storage_config, context, workers, report_prefix=''):
+    """Handle the storage config items concurrently, in dependency order.
+
+    Items whose dependencies (see get_action_graph) are done are started in
+    storage config order on up to workers threads.  While it is handled an
+    item holds a lock for each disk it is built on, so partitioning, udev
+    settles and rescans of a disk never overlap other work on that disk.
+    After a failure no new item is started and, once the running items
+    are done, the error of the first failed item in storage config order
+    is raised.
+    """
+    for command in storage_config.values():
+        if command['type'] not in context.handlers:
+            raise ValueError("unknown command type '%s'" % command['type'])
+
+    graph = get_action_graph(storage_config)
+    disks = get_action_disks(storage_config)
+    ids = list(graph)
+    order = {item_id: index for index, item_id in enumerate(ids)}
+    locks = {disk: threading.Lock() for item_id in ids
+             for disk in disks[item_id]}
+    waiting = {item_id: len(deps) for item_id, deps in graph.items()}
+    dependents = {item_id: [] for item_id in ids}
+    for item_id, deps in graph.items():
+        for dep in deps:
+            dependents[dep].append(item_id)
+    ready = [order[item_id] for item_id in ids if not waiting[item_id]]
+    heapq.heapify(ready)
+
+    def run(item_id):
+        item_locks = [locks[disk]
+                      for disk in sorted(disks[item_id], key=order.get)]
+        for lock in item_locks:
+            lock.acquire()
+        try:
+            handle_storage_item(storage_config[item_id], storage_config,
+                                context, report_prefix + '/' + item_id)
+        finally:
+            for lock in reversed(item_locks):
+                lock.release()
+
+    running = {}
+    errors = {}
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while ready or running:
+            while ready and not errors and len(running) < workers:
+                item_id = ids[heapq.heappop(ready)]
+                LOG.debug("starting %s after %s", item_id,
+                          sorted(graph[item_id], key=order.get))
+                running[executor.submit(
+                    events.inherit_stack(run), item_id)] = item_id
+            if not running:
+                break
+            done, _ = futures.wait(running,
+                                   return_when=futures.FIRST_COMPLETED)
+            for future in sorted(done, key=lambda f: order[running[f]]):
+                item_id = running.pop(future)
+                if future.exception() is not None:
+                    errors[item_id] = future.exception()
+                    continue
+                for dependent in dependents[item_id]:
+                    waiting[dependent] -= 1
+                    if not waiting[dependent]:
+                        heapq.heappush(ready, order[dependent])
+
+    if errors:
+        raise errors[min(errors, key=order.get)]
+
+
+def meta_clear(devices, report_prefix='', workers=1):
     """ Run clear_holders on specified list of devices.
 
     :param: devices: a list of block devices (/dev/XXX) to be cleared
     :param: report_prefix: a string to pass to the ReportEventStack
+    :param: workers: number of independent holders to shut down concurrently
     """
     # shut down any already existing storage layers above any disks used in
     # config that have 'wipe' set
@@ -2210,7 +2428,7 @@ def meta_clear(devices, report_prefix=''):
             reporting_enabled=True, level='INFO',
             description="removing previous storage devices"):
         clear_holders.start_clear_holders_deps()
-        clear_holders.clear_holders(devices)
+        clear_holders.clear_holders(devices, workers=workers)
         # if anything was not properly shut down, stop installation
         clear_holders.assert_clear(devices)
 
@@ -2266,20 +2484,19 @@ def meta_custom(args):
 
     context = BlockMetaContext(command_handlers)
 
-    for item_id, command in storage_config_dict.items():
-        handler = context.handlers.get(command['type'])
-        if not handler:
-            raise ValueError("unknown command type '%s'" % command['type'])
-        with events.ReportEventStack(
-                name=stack_prefix, reporting_enabled=True, level="INFO",
-                description="configuring %s: %s" % (command['type'],
-                                                    command['id'])):
-            try:
-                handler(command, storage_config_dict, context)
-            except Exception as error:
-                LOG.error("An error occured handling '%s': %s - %s" %
-                          (item_id, type(error).__name__, error))
-                raise
+    meta_prewipe(storage_config_dict, context,
+                 workers=cfg['storage'].get('wipe_workers', PREWIPE_WORKERS),
+                 report_prefix=stack_prefix)
+
+    workers = cfg['storage'].get('parallel_workers', 0)
+    with block.PROBE_CACHE.enabled():
+        if workers > 1:
+            meta_custom_parallel(storage_config_dict, context, workers,
+                                 report_prefix=stack_prefix)
+        else:
+            for command in storage_config_dict.values():
+                handle_storage_item(command, storage_config_dict, context,
+                                    stack_prefix)
 
     device_map_path = cfg['storage'].get('device_map_path')
     if device_map_path is not None:
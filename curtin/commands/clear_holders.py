@@ -33,8 +33,10 @@ def clear_holders_main(args):
     block.clear_holders.start_clear_holders_deps()
     if args.shutdown_plan:
         # get current holders and plan how to shut them down
-        holder_trees = [block.clear_holders.gen_holders_tree(path)
-                        for path in devices]
+        snapshot = block.clear_holders.StorageSnapshot()
+        holder_trees = [
+            block.clear_holders.gen_holders_tree(path, snapshot=snapshot)
+            for path in devices]
         LOG.info('Current device storage tree:\n%s',
                  '\n'.join(block.clear_holders.format_holders_tree(tree)
                            for tree in holder_trees))
@@ -43,7 +45,8 @@ def clear_holders_main(args):
         LOG.info('Shutdown Plan:\n%s', "\n".join(map(str, ordered_devs)))
 
     else:
-        block.clear_holders.clear_holders(devices, try_preserve=args.preserve)
+        block.clear_holders.clear_holders(devices, try_preserve=args.preserve,
+                                          workers=args.workers)
         if args.preserve:
             print('ran clear_holders attempting to preserve data. however, '
                   'hotplug support for some devices may cause holders to '
@@ -60,6 +63,9 @@ CMD_ARGUMENTS = (
      (('-p', '--preserve'),
       {'help': 'try to shut down holders without erasing anything',
        'default': False, 'action': 'store_true'}),
+     (('-w', '--workers'),
+      {'help': 'shut down independent holders on up to this many threads',
+       'default': 1, 'type': int}),
      )
 )
 
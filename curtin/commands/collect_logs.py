@@ -22,6 +22,7 @@ import sys
 import tempfile
 
 
+from .. import profiling
 from .. import util
 from .. import version
 from ..config import load_config, merge_config
@@ -71,6 +72,8 @@ def create_log_tarfile(tarfile, config):
     alllogs = instcfg.get('post_files', [])
     if logfile:
         alllogs.append(logfile)
+        if instcfg.get('subp_profile'):
+            alllogs.extend(profiling.profile_paths(logfile))
     # Prune duplicates and files which do not exist
     stderr = sys.stderr
     valid_logs = []
@@ -358,23 +358,42 @@ def setup_kernel_img_conf(target):
     util.write_file(kernel_img_conf_path, content=content)
 
 
-def install_kernel(cfg, target):
-    def install(pkg):
-        env = os.environ.copy()
-        # recent flash_kernel has checks to prevent it running in cases like
-        # containers or chroots, but we actually want that as curtin
-        # is mostly or always doing chroot installs.  LP: #1992990
-        env["FK_FORCE"] = "yes"
-        env["FK_FORCE_CONTAINER"] = "yes"
-        distro.install_packages([pkg], target=target, env=env)
-
-    kernel_cfg = cfg.get('kernel', {'package': None,
-                                    'fallback-package': "linux-generic",
-                                    'mapping': {}})
+def kernel_install_env():
+    env = os.environ.copy()
+    # recent flash_kernel has checks to prevent it running in cases like
+    # containers or chroots, but we actually want that as curtin
+    # is mostly or always doing chroot installs.  LP: #1992990
+    env["FK_FORCE"] = "yes"
+    env["FK_FORCE_CONTAINER"] = "yes"
+    return env
+
+
+def get_kernel_cfg(cfg):
+    return cfg.get('kernel', {'package': None,
+                              'fallback-package': "linux-generic",
+                              'mapping': {}})
+
+
+def get_flash_kernel_packages(cfg):
+    """Return the list of flash-kernel dependencies to install with the
+    kernel."""
+    if get_kernel_cfg(cfg) is None:
+        return []
+    # Machines using flash-kernel may need additional dependencies installed
+    # before running. Run those checks in the ephemeral environment so the
+    # target only has required packages installed.  See LP: #1640519
+    fk_packages = get_flash_kernel_pkgs()
+    return fk_packages.split() if fk_packages else []
+
+
+def get_kernel_package(cfg, target):
+    """Return the kernel package to install, or None if no kernel should be,
+    or can be, installed."""
+    kernel_cfg = get_kernel_cfg(cfg)
 
     if kernel_cfg is None:
         LOG.debug("Not installing any kernel since kernel: null was specified")
-        return
+        return None
 
     kernel_package = kernel_cfg.get('package')
     kernel_fallback = kernel_cfg.get('fallback-package')
@@ -382,16 +401,8 @@ def install_kernel(cfg, target):
     mapping = copy.deepcopy(KERNEL_MAPPING)
     config.merge_config(mapping, kernel_cfg.get('mapping', {}))
 
-    # Machines using flash-kernel may need additional dependencies installed
-    # before running. Run those checks in the ephemeral environment so the
-    # target only has required packages installed.  See LP: #1640519
-    fk_packages = get_flash_kernel_pkgs()
-    if fk_packages:
-        distro.install_packages(fk_packages.split(), target=target)
-
     if kernel_package:
-        install(kernel_package)
-        return
+        return kernel_package
 
     # uname[2] is kernel name (ie: 3.16.0-7-generic)
     # version gets X.Y.Z, flavor gets anything after second '-'.
@@ -406,9 +417,7 @@ def install_kernel(cfg, target):
     except KeyError:
         LOG.warn("Couldn't detect kernel package to install for %s."
                  % kernel)
-        if kernel_fallback is not None:
-            install(kernel_fallback)
-        return
+        return kernel_fallback
 
     package = "linux-{flavor}{map_suffix}".format(
         flavor=flavor, map_suffix=map_suffix)
@@ -416,18 +425,34 @@ def install_kernel(cfg, target):
     if distro.has_pkg_available(package, target):
         if distro.has_pkg_installed(package, target):
             LOG.debug("Kernel package '%s' already installed", package)
-        else:
-            LOG.debug("installing kernel package '%s'", package)
-            install(package)
+            return None
+        LOG.debug("installing kernel package '%s'", package)
+        return package
+
+    if kernel_fallback is not None:
+        LOG.info("Kernel package '%s' not available.  "
+                 "Installing fallback package '%s'.",
+                 package, kernel_fallback)
     else:
-        if kernel_fallback is not None:
-            LOG.info("Kernel package '%s' not available.  "
-                     "Installing fallback package '%s'.",
-                     package, kernel_fallback)
-            install(kernel_fallback)
-        else:
-            LOG.warn("Kernel package '%s' not available and no fallback."
-                     " System may not boot.", package)
+        LOG.warn("Kernel package '%s' not available and no fallback."
+                 " System may not boot.", package)
+    return kernel_fallback
+
+
+def install_kernel(cfg, target, fk_packages=None):
+    """Install the kernel package.
+
+    fk_packages are the flash-kernel dependencies install_package_plan
+    already installed.  If None, they are looked up and installed first.
+    """
+    if fk_packages is None:
+        fk_packages = get_flash_kernel_packages(cfg)
+        if fk_packages:
+            distro.install_packages(fk_packages, target=target)
+    kernel_package = get_kernel_package(cfg, target)
+    if kernel_package:
+        distro.install_packages([kernel_package], target=target,
+                                env=kernel_install_env())
 
 
 def uefi_remove_old_loaders(grubcfg: config.GrubConfig, target: str):
@@ -1299,12 +1324,9 @@ def detect_required_packages(cfg, osfamily=DISTROS.debian):
     return needed_packages
 
 
-def install_missing_packages(cfg, target, osfamily=DISTROS.debian):
-    ''' describe which operation types will require specific packages
-
-    'custom_config_key': {
-         'pkg1': ['op_name_1', 'op_name_2', ...]
-     }
+def get_missing_packages(cfg, target, osfamily=DISTROS.debian):
+    ''' return the set of storage, network, architecture and bootloader
+    packages required by cfg which are not installed in target.
     '''
     installed_packages = distro.get_installed_packages(target)
     needed_packages = set([pkg for pkg in
@@ -1381,6 +1403,21 @@ def install_missing_packages(cfg, target, osfamily=DISTROS.debian):
                       needed_packages.union(drops))
             needed_packages = needed_packages.difference(drops)
 
+    return needed_packages
+
+
+def install_missing_packages(cfg, target, osfamily=DISTROS.debian,
+                             extra_packages=None):
+    ''' describe which operation types will require specific packages
+
+    'custom_config_key': {
+         'pkg1': ['op_name_1', 'op_name_2', ...]
+     }
+
+    extra_packages are installed in the same transaction.
+    '''
+    needed_packages = get_missing_packages(cfg, target, osfamily=osfamily)
+    needed_packages.update(extra_packages or [])
     if needed_packages:
         to_add = list(sorted(needed_packages))
         state = util.load_command_environment()
@@ -1392,6 +1429,26 @@ def install_missing_packages(cfg, target, osfamily=DISTROS.debian):
             distro.install_packages(to_add, target=target, osfamily=osfamily)
 
 
+def install_package_plan(cfg, target, osfamily=DISTROS.debian):
+    ''' install the packages curthooks needs ahead of the kernel in a single
+    transaction.
+
+    The missing storage, network and bootloader packages and, on Debian
+    family targets, the flash-kernel dependencies are installed by one
+    package manager run.  The kernel itself is left to install_kernel, which
+    runs once the raid, iscsi and nvme configuration its initramfs picks up
+    has been written.
+
+    Returns the list of flash-kernel dependencies, for install_kernel.
+    '''
+    fk_packages = []
+    if osfamily == DISTROS.debian:
+        fk_packages = get_flash_kernel_packages(cfg)
+    install_missing_packages(cfg, target, osfamily=osfamily,
+                             extra_packages=fk_packages)
+    return fk_packages
+
+
 def system_upgrade(cfg, target, osfamily=DISTROS.debian):
     """run system-upgrade (apt-get dist-upgrade) or other in target.
 
@@ -2018,7 +2075,7 @@ def builtin_curthooks(cfg, target, state):
             name=stack_prefix + '/installing-missing-packages',
             reporting_enabled=True, level="INFO",
             description="installing missing packages"):
-        install_missing_packages(cfg, target, osfamily=osfamily)
+        fk_packages = install_package_plan(cfg, target, osfamily=osfamily)
 
     with events.ReportEventStack(
             name=stack_prefix + '/configuring-iscsi-service',
@@ -2045,7 +2102,7 @@ def builtin_curthooks(cfg, target, state):
                 description="installing kernel"):
             setup_zipl(cfg, target)
             setup_kernel_img_conf(target)
-            install_kernel(cfg, target)
+            install_kernel(cfg, target, fk_packages=fk_packages)
             run_zipl(cfg, target)
             restore_dist_interfaces(cfg, target)
             chzdev_persist_active_online(cfg, target)
@@ -2188,6 +2245,32 @@ def builtin_curthooks(cfg, target, state):
         copy_cdrom(cdrom_loc, target)
 
 
+def report_apt_update_stats(stack_prefix):
+    """Report how many apt-get update runs were done or avoided."""
+    stats = distro.APT_INDEX.stats()
+    if not (stats['updates'] or stats['skipped']):
+        return
+    LOG.debug('apt-get update statistics: %s', stats)
+    with events.ReportEventStack(
+            name=stack_prefix + '/apt-update-stats',
+            reporting_enabled=True, level="DEBUG",
+            description=("apt-get update: %(updates)d run, %(skipped)d "
+                         "skipped, %(saved).1fs saved" % stats)):
+        pass
+
+
+def report_chroot_session_stats(session, stack_prefix):
+    """Report the chroot setup and teardown work a session avoided."""
+    stats = session.stats()
+    with events.ReportEventStack(
+            name=stack_prefix + '/chroot-session-stats',
+            reporting_enabled=True, level="DEBUG",
+            description=("chroot session reused %(reused)d times, avoided "
+                         "%(mount)d mount, %(umount)d umount and %(settle)d "
+                         "udevadm settle calls" % stats)):
+        pass
+
+
 def curthooks(args):
     state = util.load_command_environment()
 
@@ -2221,7 +2304,11 @@ def curthooks(args):
         if util.run_hook_if_exists(target, 'curtin-hooks'):
             sys.exit(0)
 
-    builtin_curthooks(cfg, target, state)
+    # keep the target chroot mounts for all of the builtin curthooks
+    with util.ChrootSession(target) as chroot_session:
+        builtin_curthooks(cfg, target, state)
+    report_apt_update_stats(stack_prefix)
+    report_chroot_session_stats(chroot_session, stack_prefix)
     sys.exit(0)
 
 
@@ -5,12 +5,18 @@ try:
 except ImportError:
     ABC = object
 import abc
+from concurrent import futures
+import hashlib
 import os
 import shutil
+import subprocess
 import sys
 import tempfile
+import threading
+import time
 
 import curtin.config
+from curtin.block.image import open_image_source
 from curtin.log import LOG
 from curtin import util
 from curtin.futil import write_files
@@ -30,6 +36,33 @@ CMD_ARGUMENTS = (
      )
 )
 
+# leading bytes of a compressed root tarball -> compression
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gz'),
+    (b'\x1f\x9d', 'Z'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zst'),
+)
+MAGIC_LEN = 6
+
+# compression -> decompressors writing to stdout, the first one found in
+# PATH is used so the parallel ones are listed first
+DECOMPRESSORS = {
+    'gz': (['pigz', '-dc'], ['gzip', '-dc']),
+    'Z': (['gzip', '-dc'],),
+    'bz2': (['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc']),
+    'xz': (['pixz', '-d'], ['xz', '-dc', '-T0']),
+    'zst': (['zstd', '-dc', '-T0'],),
+}
+
+READ_SIZE = 1024 * 1024
+
+# layers of a fsimage-layered source downloaded at once
+LAYER_DOWNLOAD_WORKERS = 4
+# seconds to wait before each retry of fetching the sha256 of a layer
+LAYER_SHA256_RETRIES = (1, 3)
+
 
 def tar_xattr_opts(cmd=None):
     # if tar cmd supports xattrs, return the required flags to extract them.
@@ -46,20 +79,88 @@ def tar_xattr_opts(cmd=None):
     return []
 
 
+def detect_compression(header):
+    """Return the compression of a file starting with header, None if it
+    is not compressed (or not in a format known here)."""
+    for (magic, compression) in COMPRESSION_MAGIC:
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+def decompress_cmd(compression):
+    """Return the command to decompress stdin to stdout, preferring the
+    multithreaded decompressors."""
+    for cmd in DECOMPRESSORS[compression]:
+        if util.which(cmd[0]):
+            return cmd
+    raise ValueError(
+        "no decompressor for %s found, tried: %s" % (
+            compression,
+            ', '.join(cmd[0] for cmd in DECOMPRESSORS[compression])))
+
+
+def _pipe_to_commands(fp, header, cmds):
+    """Write header and then the rest of fp to the pipeline of cmds.
+
+    Returns the number of bytes written to the first command.
+    """
+    procs = []
+    copied = 0
+    try:
+        for (i, cmd) in enumerate(cmds):
+            procs.append(subprocess.Popen(
+                cmd, stdin=procs[-1].stdout if procs else subprocess.PIPE,
+                stdout=subprocess.PIPE if i < len(cmds) - 1 else None))
+            if len(procs) > 1:
+                procs[-2].stdout.close()
+        buf = header
+        try:
+            while buf:
+                procs[0].stdin.write(buf)
+                copied += len(buf)
+                buf = fp.read(READ_SIZE)
+        except BrokenPipeError:
+            # the command exited, its exit code is checked below
+            pass
+        finally:
+            procs[0].stdin.close()
+    except BaseException:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        raise
+    for (cmd, proc) in zip(cmds, procs):
+        ret = proc.wait()
+        if ret != 0:
+            raise util.ProcessExecutionError(cmd=cmd, exit_code=ret)
+    return copied
+
+
 def extract_root_tgz_url(url, target):
     # extract a -root.tar.gz url in the 'target' directory
-    path = _path_from_file_url(url)
-    if path != url or os.path.isfile(path):
-        util.subp(args=['smtar', '-C', target] + tar_xattr_opts() +
-                  ['-Sxpf', path, '--numeric-owner'])
-        return
-
-    # Uses smtar to avoid specifying the compression type
-    util.subp(args=['sh', '-cf',
-                    ('wget "$1" --progress=dot:mega -O - |'
-                     'smtar -C "$2" ' + ' '.join(tar_xattr_opts()) +
-                     ' ' + '-Sxpf - --numeric-owner'),
-                    '--', url, target])
+    (fp, size) = open_image_source(url)
+    try:
+        header = b''
+        while len(header) < MAGIC_LEN:
+            buf = fp.read(MAGIC_LEN - len(header))
+            if not buf:
+                break
+            header += buf
+        compression = detect_compression(header)
+        cmds = [['tar', '-C', target] + tar_xattr_opts() +
+                ['-Sxpf', '-', '--numeric-owner']]
+        if compression:
+            cmds.insert(0, decompress_cmd(compression))
+        LOG.debug('extracting %s (%s) to %s with %s', url, compression,
+                  target, ' | '.join(cmd[0] for cmd in cmds))
+        start = time.monotonic()
+        copied = _pipe_to_commands(fp, header, cmds)
+    finally:
+        fp.close()
+    elapsed = max(time.monotonic() - start, 1e-6)
+    LOG.info('extracted %s to %s: %d bytes in %.1fs (%.1f MB/s)',
+             url, target, copied, elapsed, copied / elapsed / 1e6)
 
 
 def mount(device, mountpoint, options=None, type=None):
@@ -94,52 +195,123 @@ class AbstractSourceHandler(ABC):
         pass
 
 
+def _layer_sha256(url):
+    """Return the sha256 of the image at url from the file with .sha256
+    appended to the path of url (in the format of sha256sum), None if the
+    server has no such file.  Other errors are retried and then raised."""
+    parsed = url_helper.urlparse(url)
+    sha256_url = parsed._replace(path=parsed.path + '.sha256').geturl()
+    for naptime in LAYER_SHA256_RETRIES + (None,):
+        try:
+            content = url_helper.geturl(sha256_url)
+            break
+        except url_helper.UrlError as e:
+            if e.code == 404:
+                return None
+            if naptime is None:
+                raise
+            LOG.debug("fetching %s failed, retrying in %ds: %s",
+                      sha256_url, naptime, e)
+            time.sleep(naptime)
+    fields = content.decode().split()
+    if not fields or len(fields[0]) != 64:
+        raise ValueError("invalid sha256 for %s: %s" % (url, content))
+    return fields[0].lower()
+
+
+def _download_layer(url, path, abort=None):
+    """Download the image at url to path, checking it against the sha256
+    served next to it if there is one.  The download stops with a
+    RuntimeError once the threading.Event abort is set."""
+    def check_abort(*args):
+        if abort is not None and abort.is_set():
+            raise RuntimeError("download of %s aborted" % url)
+
+    check_abort()
+    expected = _layer_sha256(url)
+    url_helper.download(url, path, retries=3, reporthook=check_abort)
+    if expected:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            for buf in iter(lambda: fp.read(READ_SIZE), b''):
+                digest.update(buf)
+        if digest.hexdigest() != expected:
+            raise ValueError("sha256 of %s is %s, expected %s" % (
+                url, digest.hexdigest(), expected))
+        LOG.debug("%s matches its sha256 %s", url, expected)
+    return path
+
+
 class LayeredSourceHandler(AbstractSourceHandler):
 
-    def __init__(self, image_stack):
+    def __init__(self, image_stack, workers=LAYER_DOWNLOAD_WORKERS):
         self.image_stack = image_stack
+        self.workers = workers
         self._tmpdir = None
         self._mounts = []
 
-    def _download(self):
-        new_image_stack = []
+    def _download(self, executor, abort):
+        """Start downloading the remote images of the stack with executor,
+        until abort is set.
+
+        Returns a list with the local path, or the future of the download,
+        of each image of the stack.
+        """
+        images = []
         for path in self.image_stack:
             if url_helper.urlparse(path).scheme not in ["", "file"]:
                 new_path = os.path.join(self._tmpdir, os.path.basename(path))
-                url_helper.download(path, new_path, retries=3)
+                images.append(executor.submit(
+                    events.inherit_stack(_download_layer), path, new_path,
+                    abort))
             else:
-                new_path = _path_from_file_url(path)
-            new_image_stack.append(new_path)
-        self.image_stack = new_image_stack
+                images.append(_path_from_file_url(path))
+        return images
 
     def setup(self):
         self._tmpdir = tempfile.mkdtemp()
         LOG.debug(f"Setting up Layered Source for stack {self.image_stack}")
+        abort = threading.Event()
+        executor = futures.ThreadPoolExecutor(max_workers=self.workers)
+        images = []
         try:
-            self._download()
-            # Check that all images exists on disk and are not empty
-            for img in self.image_stack:
-                if not os.path.isfile(img) or os.path.getsize(img) <= 0:
-                    raise ValueError(
-                        ("Failed to use fsimage: '%s' doesn't exist " +
-                         "or is invalid") % (img,))
-            for img in self.image_stack:
-                mp = os.path.join(
-                    self._tmpdir, os.path.basename(img) + ".dir")
-                os.mkdir(mp)
-                mount(img, mp, options='loop,ro')
-                self._mounts.append(mp)
-            if len(self._mounts) == 1:
-                root_dir = self._mounts[0]
-            else:
-                # Multiple image files, merge them with an overlay.
-                root_dir = os.path.join(self._tmpdir, "root.dir")
-                os.mkdir(root_dir)
-                mount(
-                    'overlay', root_dir, type='overlay',
-                    options='lowerdir=' + ':'.join(reversed(self._mounts)))
-                self._mounts.append(root_dir)
-            return root_dir
+            try:
+                images = self._download(executor, abort)
+                # mount the images in order as soon as each is available,
+                # the upper layers download meanwhile
+                for (i, img) in enumerate(images):
+                    if isinstance(img, futures.Future):
+                        img = img.result()
+                        images[i] = img
+                    # Check that the image exists on disk and is not empty
+                    if not os.path.isfile(img) or os.path.getsize(img) <= 0:
+                        raise ValueError(
+                            ("Failed to use fsimage: '%s' doesn't exist " +
+                             "or is invalid") % (img,))
+                    mp = os.path.join(
+                        self._tmpdir, os.path.basename(img) + ".dir")
+                    os.mkdir(mp)
+                    mount(img, mp, options='loop,ro')
+                    self._mounts.append(mp)
+                self.image_stack = images
+                if len(self._mounts) == 1:
+                    root_dir = self._mounts[0]
+                else:
+                    # Multiple image files, merge them with an overlay.
+                    root_dir = os.path.join(self._tmpdir, "root.dir")
+                    os.mkdir(root_dir)
+                    mount('overlay', root_dir, type='overlay',
+                          options='lowerdir=' + ':'.join(
+                              reversed(self._mounts)))
+                    self._mounts.append(root_dir)
+                return root_dir
+            finally:
+                # after an error, stop the downloads still running or queued
+                abort.set()
+                for job in images:
+                    if isinstance(job, futures.Future):
+                        job.cancel()
+                executor.shutdown(wait=True)
         except Exception:
             self.cleanup()
             raise
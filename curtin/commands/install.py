@@ -1,15 +1,18 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import argparse
+from collections import deque
 from copy import deepcopy
 import json
 import os
 import re
+import selectors
 import shlex
 import shutil
 import subprocess
 import sys
 import tempfile
+import time
 
 import attr
 
@@ -18,8 +21,10 @@ from curtin import config
 from curtin import distro
 from curtin import util
 from curtin import paths
+from curtin import profiling
 from curtin import version
 from curtin.log import LOG, logged_time
+from curtin import reporter
 from curtin.reporter.legacy import load_reporter
 from curtin.reporter import events
 from . import populate_one_subcmd
@@ -30,6 +35,13 @@ ERROR_TARFILE = '/var/log/curtin/curtin-error-logs.tar'
 SAVE_INSTALL_LOG = '/root/curtin-install.log'
 SAVE_INSTALL_CONFIG = '/root/curtin-install-cfg.yaml'
 
+# Stage command output is read in chunks of STAGE_READ_SIZE bytes, the install
+# log is flushed at least every STAGE_FLUSH_INTERVAL seconds and only the last
+# STAGE_CAPTURE_LIMIT bytes of output are kept for the error report.
+STAGE_READ_SIZE = 64 * 1024
+STAGE_FLUSH_INTERVAL = 1.0
+STAGE_CAPTURE_LIMIT = 1024 * 1024
+
 INSTALL_START_MSG = ("curtin: Installation started. (%s)" %
                      version.version_string())
 INSTALL_PASS_MSG = "curtin: Installation finished."
@@ -212,12 +224,40 @@ class WorkingDir:
             json.dump(attr.asdict(self), fh)
 
 
+class OutputTail(object):
+    """Bounded buffer keeping the most recent bytes appended to it."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self._chunks = deque()
+
+    def append(self, data):
+        self._chunks.append(data)
+        self.size += len(data)
+        while (len(self._chunks) > 1 and
+               self.size - len(self._chunks[0]) >= self.limit):
+            self.size -= len(self._chunks.popleft())
+
+    def getvalue(self):
+        value = b"".join(self._chunks)
+        if len(value) > self.limit:
+            value = value[-self.limit:]
+        return value
+
+
 class Stage(object):
 
-    def __init__(self, name, commands, env, reportstack=None, logfile=None):
+    def __init__(self, name, commands, env, reportstack=None, logfile=None,
+                 read_size=STAGE_READ_SIZE,
+                 flush_interval=STAGE_FLUSH_INTERVAL,
+                 capture_limit=STAGE_CAPTURE_LIMIT):
         self.name = name
         self.commands = commands
         self.env = env
+        self.read_size = read_size
+        self.flush_interval = flush_interval
+        self.capture_limit = capture_limit
         if logfile is None:
             logfile = INSTALL_LOG
         self.install_log = self._open_install_log(logfile)
@@ -251,12 +291,47 @@ class Stage(object):
         sys.stdout.flush()
 
     def write(self, data):
-        """Write data to stdout and to the install_log."""
+        """Write data to stdout and to the install_log.
+
+        The install log is buffered, call flush() to push it to disk."""
         self.write_stdout(data)
         if self.install_log is not None:
             self.install_log.write(data)
+
+    def flush(self):
+        """Flush buffered install_log data."""
+        if self.install_log is not None:
             self.install_log.flush()
 
+    def pump(self, stream):
+        """Copy stream to stdout and the install log until EOF.
+
+        Output is read in chunks of up to read_size bytes as soon as it is
+        available.  The install log is flushed every flush_interval seconds
+        and whenever the writer goes quiet.  Returns the last capture_limit
+        bytes of output."""
+        tail = OutputTail(self.capture_limit)
+        fd = stream.fileno()
+        last_flush = time.monotonic()
+        with selectors.DefaultSelector() as sel:
+            sel.register(fd, selectors.EVENT_READ)
+            while True:
+                if not sel.select(timeout=self.flush_interval):
+                    self.flush()
+                    last_flush = time.monotonic()
+                    continue
+                data = os.read(fd, self.read_size)
+                if not data:
+                    break
+                self.write(data)
+                tail.append(data)
+                now = time.monotonic()
+                if now - last_flush >= self.flush_interval:
+                    self.flush()
+                    last_flush = now
+        self.flush()
+        return tail.getvalue()
+
     def run(self):
         for cmdname in sorted(self.commands.keys()):
             cmd = self.commands[cmdname]
@@ -272,6 +347,9 @@ class Stage(object):
             shell = not isinstance(cmd, list)
             with util.LogTimer(LOG.debug, cmdname):
                 with cur_res:
+                    # the command reports its own events, keep them after
+                    # the queued ones of this process
+                    reporter.flush()
                     try:
                         sp = subprocess.Popen(
                             cmd, stdout=subprocess.PIPE,
@@ -281,15 +359,9 @@ class Stage(object):
                         LOG.warn("%s command failed", cmdname)
                         raise util.ProcessExecutionError(cmd=cmd, reason=e)
 
-                    output = b""
-                    while True:
-                        data = sp.stdout.read(1)
-                        if not data and sp.poll() is not None:
-                            break
-                        self.write(data)
-                        output += data
-
-                    rc = sp.returncode
+                    with sp.stdout:
+                        output = self.pump(sp.stdout)
+                    rc = sp.wait()
                     if rc != 0:
                         LOG.warn("%s command failed", cmdname)
                         raise util.ProcessExecutionError(
@@ -483,6 +555,12 @@ def cmd_install(args):
     # Load reporter
     if not logfile_append:
         clear_install_log(logfile)
+    profile_records = None
+    if instcfg.get('subp_profile'):
+        (profile_records, profile_summary) = profiling.profile_paths(logfile)
+        if not logfile_append:
+            util.write_file(profile_records, '')
+        profiling.enable(profile_records)
     legacy_reporter = load_reporter(cfg)
     legacy_reporter.files = post_files
 
@@ -534,9 +612,16 @@ def cmd_install(args):
         LOG.error(exp_msg)
         legacy_reporter.report_failure(exp_msg)
         if error_tarfile:
+            reporter.flush()
+            if profile_records:
+                # written now so that the tarfile includes it
+                profiling.write_summary(profile_records, profile_summary)
+                profile_records = None
             create_log_tarfile(error_tarfile, cfg)
         raise e
     finally:
+        if profile_records:
+            profiling.write_summary(profile_records, profile_summary)
         log_target_path = instcfg.get('save_install_log', SAVE_INSTALL_LOG)
         if log_target_path and workingd:
             copy_install_log(logfile, workingd.target, log_target_path)
@@ -8,7 +8,6 @@ import traceback
 
 from .. import log
 from .. import util
-from ..deps import install_deps
 from .. import version
 
 VERSIONSTR = version.version_string()
@@ -19,7 +18,7 @@ SUB_COMMAND_MODULES = [
     'clear-holders', 'curthooks', 'collect-logs', 'extract', 'features',
     'hook', 'install', 'mkfs', 'in-target', 'net-meta', 'pack',
     'schema-validate', 'swap', 'system-install', 'system-upgrade',
-    'unmount', 'version',
+    'trace-diff', 'unmount', 'version',
 ]
 
 
@@ -74,6 +73,12 @@ def get_main_parser(stacktrace=False, verbosity=0,
 
 
 def maybe_install_deps(args, stacktrace=True, verbosity=0):
+    """Install the dependencies of curtin if args ask for it.
+
+    Returns the name of the subcommand in args, or None if there is none
+    or the arguments are not valid.  Only the names of the subcommands are
+    known to the parser used here, so no command module is imported.
+    """
     parser = get_main_parser(stacktrace=stacktrace, verbosity=verbosity,
                              parser_class=NoHelpParser)
     subps = parser.add_subparsers(dest="subcmd", parser_class=NoHelpParser)
@@ -90,24 +95,27 @@ def maybe_install_deps(args, stacktrace=True, verbosity=0):
 
     install_only = args in install_only_args
 
+    subcmd = None
     if install_only:
         verbosity = 1
     else:
         try:
             ns, unknown = parser.parse_known_args(args)
             verbosity = ns.verbosity
+            subcmd = ns.subcmd
             if not ns.install_deps:
-                return
+                return subcmd
         except ValueError:
             # bad usage will be reported by the real reporter
-            return
+            return None
 
+    from ..deps import install_deps
     ret = install_deps(verbosity=verbosity)
 
     if ret != 0 or install_only:
         sys.exit(ret)
 
-    return
+    return subcmd
 
 
 def main(argv=None):
@@ -122,17 +130,22 @@ def main(argv=None):
     except ValueError:
         verbosity = 1
 
-    maybe_install_deps(argv, stacktrace=stacktrace,
-                       verbosity=verbosity)
+    selected = maybe_install_deps(argv, stacktrace=stacktrace,
+                                  verbosity=verbosity)
 
     # Above here, only standard library modules can be assumed.
     from .. import config
-    from ..reporter import (events, update_configuration)
+    from ..reporter import (events, flush, update_configuration)
 
     parser = get_main_parser(stacktrace=stacktrace, verbosity=verbosity)
     subps = parser.add_subparsers(dest="subcmd")
     for subcmd in SUB_COMMAND_MODULES:
-        add_subcmd(subps, subcmd)
+        # only import the module of the subcommand being run, all of them
+        # if there is none so that help and usage errors are complete
+        if selected in (None, subcmd):
+            add_subcmd(subps, subcmd)
+        else:
+            subps.add_parser(subcmd)
     args = parser.parse_args(argv)
 
     # merge config flags into a single config dictionary
@@ -198,8 +211,12 @@ def main(argv=None):
         description="curtin command %s" % args.subcmd)
 
     try:
-        with args.reportstack:
-            ret = args.func(args)
+        try:
+            with args.reportstack:
+                ret = args.func(args)
+        finally:
+            # deliver the events of asynchronous handlers before exiting
+            flush()
         sys.exit(ret)
     except Exception as e:
         if showtrace:
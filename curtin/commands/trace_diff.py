@@ -0,0 +1,118 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+"""Compare the event durations of two traces written by the trace reporter."""
+
+import json
+import sys
+
+from . import populate_one_subcmd
+
+# rows shown by default, the events whose duration changed the most
+DIFF_TOP = 30
+
+
+def load_trace(path):
+    """Load a Chrome trace event file.
+
+    Both the json array format, whose closing ] may be missing as in the
+    traces curtin writes, and the object format with a traceEvents list are
+    accepted.  Returns the list of trace events.
+    """
+    with open(path) as fp:
+        content = fp.read().strip()
+    if content.startswith('['):
+        content = content.rstrip(',')
+        if not content.endswith(']'):
+            content += ']'
+    data = json.loads(content)
+    if isinstance(data, dict):
+        data = data.get('traceEvents', [])
+    return data
+
+
+def event_durations(trace):
+    """Return a dictionary of event name to the total duration, in
+    seconds, and the count of the complete events of trace with that name.
+
+    The full name of the event, kept in args by the trace reporter, is used
+    when present.
+    """
+    durations = {}
+    for entry in trace:
+        if entry.get('ph') != 'X':
+            continue
+        name = entry.get('args', {}).get('name', entry.get('name'))
+        (total, count) = durations.get(name, (0.0, 0))
+        durations[name] = (total + entry.get('dur', 0) / 1e6, count + 1)
+    return durations
+
+
+def diff_traces(old, new):
+    """Compare the event durations of the traces old and new.
+
+    Returns a list of (name, old duration, new duration) sorted by the
+    largest change first.  The duration is None for events missing from
+    one of the traces.
+    """
+    old_durations = event_durations(old)
+    new_durations = event_durations(new)
+    rows = []
+    for name in set(old_durations) | set(new_durations):
+        rows.append((name, old_durations.get(name, (None,))[0],
+                     new_durations.get(name, (None,))[0]))
+
+    def change(row):
+        return abs((row[2] or 0.0) - (row[1] or 0.0))
+    return sorted(rows, key=lambda row: (-change(row), row[0]))
+
+
+def format_diff(rows):
+    def seconds(value):
+        return '-' if value is None else '%.3f' % value
+
+    width = max([len('event')] + [len(row[0]) for row in rows])
+    lines = ['%-*s %10s %10s %10s %8s' % (
+        width, 'event', 'old(s)', 'new(s)', 'delta(s)', 'delta%')]
+    for (name, old, new) in rows:
+        delta = (new or 0.0) - (old or 0.0)
+        percent = '%+.1f' % (100 * delta / old) if old else '-'
+        lines.append('%-*s %10s %10s %+10.3f %8s' % (
+            width, name, seconds(old), seconds(new), delta, percent))
+    return '\n'.join(lines) + '\n'
+
+
+def trace_diff_main(args):
+    rows = diff_traces(load_trace(args.old), load_trace(args.new))
+    rows = [row for row in rows
+            if abs((row[2] or 0.0) - (row[1] or 0.0)) >= args.min_delta]
+    if args.top:
+        rows = rows[:args.top]
+    if args.json:
+        sys.stdout.write(json.dumps(
+            [{'name': name, 'old': old, 'new': new}
+             for (name, old, new) in rows], indent=1) + '\n')
+    else:
+        sys.stdout.write(format_diff(rows))
+    sys.exit(0)
+
+
+CMD_ARGUMENTS = (
+    ('old', {'help': 'trace to compare against', 'metavar': 'OLD'}),
+    ('new', {'help': 'trace to compare', 'metavar': 'NEW'}),
+    (('-n', '--top'),
+     {'help': 'show the N events whose duration changed the most, 0 for '
+              'all (default %d)' % DIFF_TOP,
+      'metavar': 'N', 'type': int, 'default': DIFF_TOP}),
+    ('--min-delta',
+     {'help': 'hide events whose duration changed less than SECONDS',
+      'metavar': 'SECONDS', 'type': float, 'default': 0.0}),
+    (('-j', '--json'),
+     {'help': 'output data in json format', 'default': False,
+      'action': 'store_true'}),
+)
+
+
+def POPULATE_SUBCMD(parser):
+    populate_one_subcmd(parser, CMD_ARGUMENTS, trace_diff_main)
+    parser.description = __doc__
+
+# vi: ts=4 expandtab syntax=python
@@ -3,6 +3,7 @@ from collections import namedtuple
 import os
 import re
 import textwrap
+import time
 from typing import Optional, Sequence
 
 from .paths import target_path
@@ -195,7 +196,92 @@ def _lsb_release(target=None):
     return data
 
 
-def apt_update(target=None, env=None):
+# files and directories whose content affects the result of apt-get update
+APT_INDEX_INPUTS = ('/etc/apt/sources.list', '/etc/apt/sources.list.d',
+                    '/etc/apt/trusted.gpg', '/etc/apt/trusted.gpg.d',
+                    '/etc/apt/apt.conf.d')
+
+
+class AptIndexTracker(object):
+    """Remember when apt indexes of a target were last refreshed.
+
+    An apt-get update is only needed if the apt sources (or keys, or apt
+    configuration) of the target changed since the last successful update.
+    The tracker fingerprints APT_INDEX_INPUTS by path, size and mtime and
+    records the fingerprint seen by the last update of each target.
+    """
+
+    def __init__(self):
+        self._updated = {}
+        self.updates = 0
+        self.skipped = 0
+        self.saved = 0.0
+
+    @staticmethod
+    def _key(target):
+        return os.path.realpath(target_path(target))
+
+    @staticmethod
+    def fingerprint(target=None):
+        """Return a hashable summary of the apt sources of target."""
+        found = []
+        for inpath in APT_INDEX_INPUTS:
+            path = target_path(target, inpath)
+            if os.path.isdir(path):
+                paths = [os.path.join(path, f) for f in os.listdir(path)]
+            else:
+                paths = [path]
+            for fpath in sorted(paths):
+                try:
+                    st = os.stat(fpath)
+                except OSError:
+                    continue
+                found.append((fpath, st.st_size, st.st_mtime_ns))
+        return tuple(found)
+
+    def is_fresh(self, target=None, fingerprint=None):
+        """Return True if target apt indexes match its apt sources."""
+        if fingerprint is None:
+            fingerprint = self.fingerprint(target)
+        if not fingerprint:
+            # nothing to track, never claim the indexes are current
+            return False
+        last = self._updated.get(self._key(target))
+        return last is not None and last[0] == fingerprint
+
+    def record_update(self, target, fingerprint, duration):
+        self.updates += 1
+        self._updated[self._key(target)] = (fingerprint, duration)
+
+    def record_skip(self, target):
+        self.skipped += 1
+        self.saved += self._updated[self._key(target)][1]
+
+    def invalidate(self, target=None):
+        """Force the next apt_update of target to run."""
+        self._updated.pop(self._key(target), None)
+
+    def stats(self):
+        return {'updates': self.updates, 'skipped': self.skipped,
+                'saved': self.saved}
+
+
+APT_INDEX = AptIndexTracker()
+
+
+def apt_sources_changed(target=None):
+    """Note that apt sources in target were modified."""
+    APT_INDEX.invalidate(target)
+
+
+def apt_update(target=None, env=None, force=False):
+    fingerprint = APT_INDEX.fingerprint(target)
+    if not force and APT_INDEX.is_fresh(target, fingerprint):
+        LOG.debug("Apt sources in %s unchanged since last update, "
+                  "skipping apt-get update", target)
+        APT_INDEX.record_skip(target)
+        return
+
     LOG.debug("Updating apt sources in %s", target)
     if env is None:
         env = os.environ.copy()
@@ -216,8 +302,11 @@ def apt_update(target=None, env=None):
             'update']
 
         # do not using 'run_apt_command' so we can use 'retries' to subp
+        start = time.monotonic()
         with ChrootableTarget(target, allow_daemons=True) as inchroot:
             inchroot.subp(update_cmd, env=env, retries=(1, 2, 3))
+        APT_INDEX.record_update(target, fingerprint,
+                                time.monotonic() - start)
     finally:
         for fname, perms in restore_perms:
             os.chmod(fname, perms)
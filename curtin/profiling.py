@@ -0,0 +1,190 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Accounting of the commands run through util.subp.
+
+Profiling is enabled by setting CURTIN_SUBP_PROFILE to the path of a
+records file, which the install command does when 'install/subp_profile'
+is set.  The variable is inherited by the curtin commands run by each
+stage, so every process appends one json line per command to the same
+file, and write_summary aggregates them into a report.  When disabled the
+only cost to a command is the check of enabled().
+"""
+
+import collections
+import json
+import os
+import subprocess
+import time
+
+from .log import LOG
+
+PROFILE_ENV = 'CURTIN_SUBP_PROFILE'
+PROFILE_RECORDS = 'subp-profile.jsonl'
+PROFILE_SUMMARY = 'subp-profile.txt'
+# number of rows in each table of the summary
+SUMMARY_TOP = 20
+
+_records_path = os.environ.get(PROFILE_ENV) or None
+
+
+def enabled():
+    return _records_path is not None
+
+
+def enable(path):
+    """Record commands run by this process, and by the curtin commands it
+    starts, in the file at path."""
+    global _records_path
+    _records_path = path
+    os.environ[PROFILE_ENV] = path
+
+
+def disable():
+    global _records_path
+    _records_path = None
+    os.environ.pop(PROFILE_ENV, None)
+
+
+def profile_paths(logfile):
+    """Return the paths of the records and summary kept next to logfile."""
+    logdir = os.path.dirname(logfile)
+    return (os.path.join(logdir, PROFILE_RECORDS),
+            os.path.join(logdir, PROFILE_SUMMARY))
+
+
+class RusagePopen(subprocess.Popen):
+    """Popen which keeps the resource usage of the process when reaping it.
+
+    The usage is in the rusage attribute once the process has been waited
+    for, it stays None if the process was reaped some other way.
+    """
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # same as Popen: the child was reaped elsewhere (SIGCLD ignored)
+            return (self.pid, 0)
+        if pid == self.pid:
+            self.rusage = rusage
+        return (pid, sts)
+
+
+def command_name(args):
+    """Return the name of the command run by args, the argv[0] once any
+    chroot, unshare or shell wrapping is skipped."""
+    args = list(args)
+    if args and os.path.basename(args[0]) == 'unshare':
+        # unshare options come before the command, the first argument
+        # which is not an option is the command
+        args = args[1:]
+        while args and args[0].startswith('-'):
+            args = args[1:]
+    if args and os.path.basename(args[0]) == 'chroot':
+        args = args[2:]
+    if args[:2] == ['sh', '-c'] and len(args) > 2:
+        args = args[2].split()[:1]
+    if not args:
+        return ''
+    return os.path.basename(args[0])
+
+
+def record(args, start, returncode, rusage=None):
+    """Append a record of a command which ran from time.monotonic() start
+    and exited with returncode to the records file."""
+    if _records_path is None:
+        return
+    from .reporter import events
+    entry = {
+        'cmd': command_name(args),
+        'duration': time.monotonic() - start,
+        'rc': returncode,
+        'stack': events.current_stack_name(),
+        'pid': os.getpid(),
+    }
+    if rusage is not None:
+        entry['cpu'] = rusage.ru_utime + rusage.ru_stime
+        entry['maxrss'] = rusage.ru_maxrss
+    try:
+        with open(_records_path, 'a') as fp:
+            fp.write(json.dumps(entry) + '\n')
+    except OSError as e:
+        LOG.debug('Failed to record profile of %s: %s', entry['cmd'], e)
+
+
+def load_records(path):
+    records = []
+    with open(path) as fp:
+        for line in fp:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # a process killed while writing leaves a partial line
+                continue
+    return records
+
+
+def aggregate(records, key='cmd'):
+    """Aggregate records by key.
+
+    Returns a dictionary of key to a dictionary with the count, failures,
+    total duration and cpu time, and the largest maxrss of the records.
+    """
+    totals = collections.OrderedDict()
+    for entry in records:
+        total = totals.setdefault(entry.get(key) or '', {
+            'count': 0, 'failures': 0, 'duration': 0.0, 'cpu': 0.0,
+            'maxrss': 0})
+        total['count'] += 1
+        if entry.get('rc') != 0:
+            total['failures'] += 1
+        total['duration'] += entry.get('duration', 0.0)
+        total['cpu'] += entry.get('cpu', 0.0)
+        total['maxrss'] = max(total['maxrss'], entry.get('maxrss', 0))
+    return totals
+
+
+def _format_table(title, totals, sort_key, top):
+    rows = sorted(totals.items(), key=lambda item: item[1][sort_key],
+                  reverse=True)[:top]
+    width = max([len(title)] + [len(name) for (name, _) in rows])
+    lines = ['%-*s %8s %8s %10s %10s %10s' % (
+        width, title, 'count', 'failed', 'total(s)', 'cpu(s)',
+        'maxrss(KB)')]
+    for (name, total) in rows:
+        lines.append('%-*s %8d %8d %10.3f %10.3f %10d' % (
+            width, name, total['count'], total['failures'],
+            total['duration'], total['cpu'], total['maxrss']))
+    return lines
+
+
+def format_summary(records, top=SUMMARY_TOP):
+    commands = aggregate(records)
+    stacks = aggregate(records, key='stack')
+    lines = ['%d commands, %.3fs total' % (
+        len(records), sum(r.get('duration', 0.0) for r in records)), '']
+    lines.extend(['Top commands by total time:'] +
+                 _format_table('command', commands, 'duration', top) + [''])
+    lines.extend(['Top commands by count:'] +
+                 _format_table('command', commands, 'count', top) + [''])
+    lines.extend(['Top events by total time:'] +
+                 _format_table('event', stacks, 'duration', top))
+    return '\n'.join(lines) + '\n'
+
+
+def write_summary(records_path, summary_path, top=SUMMARY_TOP):
+    """Write the summary of the records at records_path to summary_path.
+
+    Returns False if there are no records.
+    """
+    if not os.path.exists(records_path):
+        return False
+    records = load_records(records_path)
+    with open(summary_path, 'w') as fp:
+        fp.write(format_summary(records, top=top))
+    LOG.debug('Wrote profile of %d commands to %s', len(records),
+              summary_path)
+    return True
+
+# vi: ts=4 expandtab syntax=python
@@ -19,6 +19,10 @@ def update_configuration(config):
         will be unregistered.
     """
     for handler_name, handler_config in config.items():
+        current = instantiated_handler_registry.registered_items.get(
+            handler_name)
+        if current is not None:
+            current.flush()
         if not handler_config:
             instantiated_handler_registry.unregister_item(
                 handler_name, force=True)
@@ -30,6 +34,12 @@ def update_configuration(config):
         instantiated_handler_registry.register_item(handler_name, instance)
 
 
+def flush():
+    """Wait until the handlers have handled the events published so far."""
+    for handler in instantiated_handler_registry.registered_items.values():
+        handler.flush()
+
+
 instantiated_handler_registry = DictRegistry()
 update_configuration(DEFAULT_CONFIG)
 # vi: ts=4 expandtab syntax=python
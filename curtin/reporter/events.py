@@ -7,17 +7,25 @@ The reporting framework is intended to allow all parts of cloud-init to
 report events in a structured manner.
 """
 import base64
+import functools
 import os.path
+import threading
 import time
 
 from . import instantiated_handler_registry
+from ..log import LOG
 
 FINISH_EVENT_TYPE = 'finish'
 START_EVENT_TYPE = 'start'
 RESULT_EVENT_TYPE = 'result'
+PROGRESS_EVENT_TYPE = 'progress'
 
 DEFAULT_EVENT_ORIGIN = 'curtin'
 
+# per thread, the ReportEventStacks entered and not yet exited, innermost
+# last, and the stack name inherited from the thread which started the work
+_thread_stacks = threading.local()
+
 
 class _nameset(set):
     def __getattr__(self, name):
@@ -202,6 +210,7 @@ class ReportEventStack(object):
                                level=self.level)
         if self.parent:
             self.parent.children[self.name] = (None, None)
+        _active_stacks().append(self)
         return self
 
     def _childrens_finish_info(self):
@@ -239,6 +248,9 @@ class ReportEventStack(object):
         return self._childrens_finish_info()
 
     def __exit__(self, exc_type, exc_value, traceback):
+        stacks = _active_stacks()
+        if self in stacks:
+            stacks.remove(self)
         (result, msg) = self._finish_info(exc_value)
         if self.parent:
             self.parent.children[self.name] = (result, msg)
@@ -247,6 +259,76 @@ class ReportEventStack(object):
                                 post_files=self.post_files, level=self.level)
 
 
+def _active_stacks():
+    try:
+        return _thread_stacks.active
+    except AttributeError:
+        _thread_stacks.active = []
+        return _thread_stacks.active
+
+
+def current_stack_name():
+    """Return the fullname of the innermost ReportEventStack entered and
+    not yet exited by this thread, else the name inherited with
+    inherit_stack, or None."""
+    stacks = _active_stacks()
+    if stacks:
+        return stacks[-1].fullname
+    return getattr(_thread_stacks, 'inherited', None)
+
+
+def inherit_stack(func):
+    """Return a wrapper of func which runs it with the current stack name of
+    the calling thread, for work submitted to another thread."""
+    name = current_stack_name()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_thread_stacks, 'inherited', None)
+        _thread_stacks.inherited = name
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _thread_stacks.inherited = previous
+    return wrapper
+
+
+class ProgressReporter(object):
+    """Log and report the progress of a long running operation.
+
+    The progress events are named name below the CURTIN_REPORTSTACK of the
+    command, and due() spaces them step apart in whatever unit the caller
+    counts progress.
+    """
+
+    def __init__(self, name, description, step):
+        self.step = step
+        self.start = time.monotonic()
+        self.next_report = step
+        self.name = '/'.join(
+            [p for p in (os.environ.get('CURTIN_REPORTSTACK', ''), name)
+             if p])
+        self.description = description
+
+    @property
+    def elapsed(self):
+        return max(time.monotonic() - self.start, 1e-6)
+
+    def due(self, done):
+        """Return True if done reached the next step, which is then moved
+        past done."""
+        if done < self.next_report:
+            return False
+        self.next_report = (done // self.step + 1) * self.step
+        return True
+
+    def report_progress(self, msg):
+        msg = '%s: %s' % (self.description, msg)
+        LOG.info(msg)
+        report_event(ReportingEvent(
+            PROGRESS_EVENT_TYPE, self.name, msg, level='DEBUG'))
+
+
 def _collect_file_info(files):
     if not files:
         return None
@@ -1,14 +1,25 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import abc
+import atexit
+import json
+import os
+import queue
+import threading
+import time
 
 from .registry import DictRegistry
-from .. import url_helper
 from .. import log as logging
 
 
 LOG = logging.getLogger(__name__)
 
+# events an asynchronous webhook queues before publish_event blocks
+WEBHOOK_QUEUE_SIZE = 1000
+# seconds flush waits for an asynchronous webhook to post its queued events
+WEBHOOK_FLUSH_TIMEOUT = 60
+TRACE_FILE = '/var/log/curtin/trace.json'
+
 
 class ReportingHandler(object):
     """Base class for report handlers.
@@ -21,6 +32,9 @@ class ReportingHandler(object):
     def publish_event(self, event):
         """Publish an event to the ``INFO`` log level."""
 
+    def flush(self):
+        """Wait until the events published so far have been handled."""
+
 
 class LogHandler(ReportingHandler):
     """Publishes events to the curtin log at the ``DEBUG`` log level."""
@@ -53,10 +67,25 @@ class PrintHandler(ReportingHandler):
 
 
 class WebHookHandler(ReportingHandler):
+    """Post events as json to endpoint.
+
+    With asynchronous=True events are queued, up to queue_size, and posted
+    by a sender thread so publish_event does not wait for the endpoint.
+    Queued progress events superseded by a later one of the same name are
+    not sent, and with batch_size > 1 up to batch_size queued events are
+    posted at once as a json list (falling back to one post per event if
+    that fails, and for good if the endpoint rejects batches).  flush()
+    waits, up to a timeout, for the queue to drain; it is called at exit.
+    """
+
     def __init__(self, endpoint, consumer_key=None, token_key=None,
                  token_secret=None, consumer_secret=None, timeout=None,
-                 retries=None, level="DEBUG"):
+                 retries=None, level="DEBUG", asynchronous=False,
+                 queue_size=WEBHOOK_QUEUE_SIZE, batch_size=1):
         super(WebHookHandler, self).__init__()
+        # url_helper pulls in http.client and ssl, import it only when a
+        # webhook is configured to keep the startup of curtin commands fast
+        from .. import url_helper
 
         self.oauth_helper = url_helper.OauthUrlHelper(
             consumer_key=consumer_key, token_key=token_key,
@@ -70,15 +99,140 @@ class WebHookHandler(ReportingHandler):
             LOG.warn("invalid level '%s', using WARN", level)
             self.level = logging.WARN
         self.headers = {'Content-Type': 'application/json'}
+        self.asynchronous = asynchronous
+        self.batch_size = max(int(batch_size), 1)
+        self.stats = {'sent': 0, 'failed': 0, 'dropped': 0, 'coalesced': 0,
+                      'posts': 0, 'max_latency': 0.0, 'total_latency': 0.0}
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._sender = None
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self):
+        """The number of events waiting to be sent."""
+        return self._queue.qsize()
+
+    def _post(self, data):
+        return self.oauth_helper.geturl(
+            url=self.endpoint, data=data, headers=self.headers,
+            retries=self.retries)
 
     def publish_event(self, event):
+        if self.asynchronous:
+            return self._enqueue(event)
         try:
-            return self.oauth_helper.geturl(
-                url=self.endpoint, data=event.as_dict(),
-                headers=self.headers, retries=self.retries)
+            return self._post(event.as_dict())
         except Exception as e:
             LOG.warn("failed posting event: %s [%s]" % (event.as_string(), e))
 
+    def _enqueue(self, event):
+        from .events import PROGRESS_EVENT_TYPE
+
+        with self._lock:
+            if self._sender is None:
+                self._sender = threading.Thread(
+                    target=self._send_loop, name='webhook-sender',
+                    daemon=True)
+                self._sender.start()
+                atexit.register(self.flush)
+        item = (time.monotonic(), event)
+        if event.event_type != PROGRESS_EVENT_TYPE:
+            self._queue.put(item)
+            return
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.stats['dropped'] += 1
+
+    def _send_loop(self):
+        while True:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                sendable = self._coalesce(items)
+                for start in range(0, len(sendable), self.batch_size):
+                    self._send(sendable[start:start + self.batch_size])
+            except Exception as e:
+                LOG.warn("webhook sender failed: %s", e)
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    def _coalesce(self, items):
+        """Drop progress events followed by one of the same name."""
+        from .events import PROGRESS_EVENT_TYPE
+
+        latest = {}
+        for (i, (_, event)) in enumerate(items):
+            if event.event_type == PROGRESS_EVENT_TYPE:
+                latest[event.name] = i
+        sendable = [item for (i, item) in enumerate(items)
+                    if (item[1].event_type != PROGRESS_EVENT_TYPE or
+                        latest[item[1].name] == i)]
+        self.stats['coalesced'] += len(items) - len(sendable)
+        return sendable
+
+    def _send(self, items):
+        from .. import url_helper
+        if len(items) > 1:
+            try:
+                self._post(json.dumps(
+                    [event.as_dict() for (_, event) in items]).encode())
+                self._sent(items)
+                return
+            except Exception as e:
+                if (isinstance(e, url_helper.UrlError) and
+                        e.code is not None and 400 <= e.code < 500):
+                    LOG.warn("endpoint %s does not accept batched events, "
+                             "posting them one by one [%s]", self.endpoint, e)
+                    self.batch_size = 1
+                else:
+                    LOG.warn("failed posting %d events, posting them one by "
+                             "one [%s]", len(items), e)
+        for item in items:
+            try:
+                self._post(item[1].as_dict())
+                self._sent([item])
+            except Exception as e:
+                self.stats['failed'] += 1
+                LOG.warn("failed posting event: %s [%s]" % (
+                    item[1].as_string(), e))
+
+    def _sent(self, items):
+        now = time.monotonic()
+        self.stats['posts'] += 1
+        for (queued, _) in items:
+            latency = now - queued
+            self.stats['sent'] += 1
+            self.stats['total_latency'] += latency
+            self.stats['max_latency'] = max(self.stats['max_latency'],
+                                            latency)
+
+    def flush(self, timeout=WEBHOOK_FLUSH_TIMEOUT):
+        if self._sender is None:
+            return
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    LOG.warn("webhook %s: gave up waiting for %d queued "
+                             "events after %ds", self.endpoint,
+                             self._queue.unfinished_tasks, timeout)
+                    break
+                self._queue.all_tasks_done.wait(remaining)
+        stats = self.stats
+        LOG.debug("webhook %s: sent %d events in %d posts, %d failed, "
+                  "%d dropped, %d coalesced, latency avg %.3fs max %.3fs",
+                  self.endpoint, stats['sent'], stats['posts'],
+                  stats['failed'], stats['dropped'], stats['coalesced'],
+                  stats['total_latency'] / max(stats['sent'], 1),
+                  stats['max_latency'])
+
 
 class JournaldHandler(ReportingHandler):
 
@@ -117,10 +271,81 @@ class JournaldHandler(ReportingHandler):
             )
 
 
+def _thread_id():
+    # threading.get_native_id is new in python 3.8
+    return getattr(threading, 'get_native_id', threading.get_ident)()
+
+
+class TraceHandler(ReportingHandler):
+    """Write events to path in the Chrome trace event format.
+
+    The file can be loaded in Perfetto or chrome://tracing, and compared
+    with ``curtin trace-diff``.  Each finished event is written as a
+    complete event spanning from its start, with the full name of the event
+    and of its parent in the args, other events as instant events.  The
+    curtin commands run by a command (those with CURTIN_REPORTSTACK set)
+    append to its trace, unless append is set explicitly.
+    """
+
+    def __init__(self, path=TRACE_FILE, append=None, level="DEBUG"):
+        super(TraceHandler, self).__init__()
+        self.path = path
+        if append is None:
+            append = bool(os.environ.get('CURTIN_REPORTSTACK'))
+        self.append = append
+        self._fd = None
+        self._starts = {}
+        self._lock = threading.Lock()
+
+    def _open(self, event):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        if not self.append:
+            flags |= os.O_TRUNC
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._fd = os.open(self.path, flags, 0o644)
+        if os.fstat(self._fd).st_size == 0:
+            # the closing ] of the json array is optional in the format,
+            # leaving it out lets processes append to the trace
+            os.write(self._fd, b'[\n')
+        self._write({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+                     'args': {'name': event.name.rpartition('/')[2]}})
+
+    def _write(self, entry):
+        # a single write per event keeps lines of concurrent writers whole
+        os.write(self._fd, (json.dumps(entry) + ',\n').encode())
+
+    def publish_event(self, event):
+        from .events import FINISH_EVENT_TYPE, START_EVENT_TYPE
+        entry = {'name': event.name.rpartition('/')[2], 'cat': event.origin,
+                 'pid': os.getpid(), 'tid': _thread_id(),
+                 'args': {'name': event.name,
+                          'description': event.description}}
+        timestamp = int(event.timestamp * 1e6)
+        with self._lock:
+            if self._fd is None:
+                self._open(event)
+            if event.event_type == START_EVENT_TYPE:
+                self._starts[event.name] = timestamp
+                return
+            if event.event_type == FINISH_EVENT_TYPE:
+                start = self._starts.pop(event.name, timestamp)
+                entry.update({'ph': 'X', 'ts': start,
+                              'dur': timestamp - start})
+                entry['args'].update({'parent': event.name.rpartition('/')[0],
+                                      'result': event.result})
+            else:
+                entry.update({'ph': 'i', 's': 't', 'ts': timestamp})
+                entry['args']['event_type'] = event.event_type
+            self._write(entry)
+
+
 available_handlers = DictRegistry()
 available_handlers.register_item('log', LogHandler)
 available_handlers.register_item('print', PrintHandler)
 available_handlers.register_item('webhook', WebHookHandler)
+available_handlers.register_item('trace', TraceHandler)
 # only add journald handler on systemd systems
 try:
     available_handlers.register_item('journald', JournaldHandler)
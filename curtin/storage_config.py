@@ -91,6 +91,9 @@ STORAGE_CONFIG_SCHEMA = {
             },
             'additionalItems': False,
         },
+        'wipe_workers': {'type': 'integer', 'minimum': 0},
+        'parallel_workers': {'type': 'integer', 'minimum': 0},
+        'clear_holders_workers': {'type': 'integer', 'minimum': 0},
     },
     'additionalProperties': False,
 }
@@ -106,38 +109,89 @@ def load_and_validate(config_path):
     return validate_config(config.get('storage'), sourcefile=config_path)
 
 
+# STORAGE_CONFIG_SCHEMA without the per item schemas, which are checked
+# one item at a time with the schema of the item type
+_STORAGE_CONFIG_TOP_SCHEMA = copy.deepcopy(STORAGE_CONFIG_SCHEMA)
+_STORAGE_CONFIG_TOP_SCHEMA['properties']['config']['items'] = {
+    'type': 'object'}
+
+# compiled jsonschema validators by storage type ('storage' for the top
+# level schema), see _get_validator
+_VALIDATORS = {}
+
+
+def _get_validator(key):
+    """Return the validator for storage type key, building it on first use.
+
+    The schema itself is checked once, when the validator is built.
+    """
+    validator = _VALIDATORS.get(key)
+    if validator is None:
+        import jsonschema
+        if key == 'storage':
+            schema = _STORAGE_CONFIG_TOP_SCHEMA
+        else:
+            schema = STORAGE_CONFIG_TYPES[key].schema
+        cls = jsonschema.validators.validator_for(schema)
+        cls.check_schema(schema)
+        validator = _VALIDATORS[key] = cls(schema)
+    return validator
+
+
+def _best_error(validator, instance):
+    import jsonschema
+    return jsonschema.exceptions.best_match(validator.iter_errors(instance))
+
+
+def _item_error(item, sourcefile):
+    """Return the error message for storage config item, or None."""
+    if not isinstance(item, dict) or 'type' not in item:
+        return "'type' is a required property in %s" % (item,)
+    validator = _VALIDATORS.get(item['type'])
+    if validator is None:
+        if item['type'] not in STORAGE_CONFIG_TYPES:
+            return "Unknown storage type: %s in %s" % (item['type'], item)
+        validator = _get_validator(item['type'])
+    error = _best_error(validator, item)
+    if error is None:
+        return None
+    return "%s in %s\n%s" % (error.message, sourcefile,
+                             util.json_dumps(item))
+
+
 def validate_config(config, sourcefile=None):
-    """Validate storage config object."""
+    """Validate storage config object.
+
+    config is either a storage config with 'version' and 'config' keys or
+    a single storage config item.  Every item is validated with the schema
+    of its type and all errors are raised together in one ValueError.
+    """
     if not sourcefile:
         sourcefile = ''
     try:
-        import jsonschema
-        jsonschema.validate(config, STORAGE_CONFIG_SCHEMA)
+        top_validator = _get_validator('storage')
     except ImportError:
         LOG.error('Cannot validate storage config, missing jsonschema')
         raise
-    except jsonschema.exceptions.ValidationError as e:
-        if isinstance(e.instance, int):
-            msg = 'Unexpected value (%s) for property "%s"' % (e.path[0],
-                                                               e.instance)
-            raise ValueError(msg)
-        if 'type' not in e.instance:
-            msg = "%s in %s" % (e.message, e.instance)
-            raise ValueError(msg)
 
-        instance_type = e.instance['type']
-        stype = get_storage_types().get(instance_type)
-        if stype:
-            try:
-                jsonschema.validate(e.instance, stype.schema)
-            except jsonschema.exceptions.ValidationError as f:
-                msg = "%s in %s\n%s" % (f.message, sourcefile,
-                                        util.json_dumps(e.instance))
-                raise ValueError(msg)
-        else:
-            msg = "Unknown storage type: %s in %s" % (instance_type,
-                                                      e.instance)
+    if isinstance(config, dict) and 'type' in config and (
+            'config' not in config):
+        items = [config]
+    else:
+        error = _best_error(top_validator, config)
+        if error is not None:
+            if isinstance(error.instance, int):
+                msg = 'Unexpected value (%s) for property "%s"' % (
+                    error.path[0], error.instance)
+            else:
+                msg = "%s in %s" % (error.message, error.instance)
             raise ValueError(msg)
+        items = config['config']
+
+    errors = [msg for msg in (_item_error(item, sourcefile) for item in items)
+              if msg]
+    if errors:
+        raise ValueError('\n'.join(errors))
 
 
 # FIXME: move this map to each types schema and extract these
@@ -255,6 +309,26 @@ def _validate_dep_type(source_id, dep_key, dep_id, sconfig):
     return result
 
 
+def get_item_references(item_cfg):
+    """ Return the ids of the storage config items that item_cfg refers to
+        directly, through the keys returned by _stype_to_deps.
+    """
+    try:
+        dep_keys = _stype_to_deps(item_cfg.get('type'))
+    except KeyError:
+        return []
+
+    refs = []
+    for dep_key in sorted(dep_keys):
+        dep_value = item_cfg.get(dep_key)
+        if dep_value is None:
+            continue
+        if not isinstance(dep_value, list):
+            dep_value = [dep_value]
+        refs.extend(dep_value)
+    return refs
+
+
 def find_item_dependencies(item_id, config, validate=True):
     """ Walk a storage config collecting any dependent device ids."""
 
@@ -378,6 +452,90 @@ def merge_config_trees_to_list(config_trees):
     return merged
 
 
+def get_item_dependency_sets(sconfig, validate=True):
+    """ Return a dict mapping each item id in sconfig to a frozenset of the
+        ids find_item_dependencies returns for it.
+
+        Items referring to the same device through the same key are found
+        through an index built once, and the dependencies of each item are
+        computed once and reused by every item built on top of it.
+    """
+    dep_keys = set()
+    for stype in STORAGE_CONFIG_TYPES:
+        dep_keys.update(_stype_to_deps(stype))
+
+    # (dep_key, dep_id) -> ids of the items whose dep_key is dep_id
+    same_deps = {}
+    for item_id, item_cfg in sconfig.items():
+        for dep_key in dep_keys:
+            dep_value = item_cfg.get(dep_key)
+            if dep_value is not None and not isinstance(dep_value,
+                                                        (list, dict)):
+                same_deps.setdefault((dep_key, dep_value), []).append(item_id)
+
+    deps = {}
+
+    def _resolve(item_id):
+        if item_id in deps:
+            if deps[item_id] is None:
+                raise ValueError(
+                    'Dependency cycle in storage config at %s' % item_id)
+            return deps[item_id]
+        item_cfg = sconfig.get(item_id)
+        if not item_cfg:
+            return frozenset()
+
+        deps[item_id] = None
+        item_type = item_cfg.get('type')
+        _stype_to_order_key(item_type)
+        found = set()
+        for dep_key in _stype_to_deps(item_type):
+            if dep_key not in item_cfg:
+                continue
+            dep_value = item_cfg[dep_key]
+            if not isinstance(dep_value, list):
+                dep_value = [dep_value]
+            for dep in dep_value:
+                if validate:
+                    _validate_dep_type(item_id, dep_key, dep, sconfig)
+                found.add(dep)
+                found.update(same_deps.get((dep_key, dep), ()))
+                found.update(_resolve(dep))
+        deps[item_id] = frozenset(found)
+        return deps[item_id]
+
+    for item_id in sconfig:
+        _resolve(item_id)
+    return deps
+
+
+def sort_storage_config(configs, validate=True):
+    """ Return the list of storage configs sorted from the least to the
+        most dependent item.
+
+        This is the order merge_config_trees_to_list returns for the config
+        trees of all items: items are sorted by the number of items they
+        depend on (including themselves), then by type and then by the order
+        key of the type, keeping the original order on ties.  Of items with
+        the same id, the last one is kept at the position of the first.
+    """
+    sconfig = OrderedDict()
+    for cfg in configs:
+        if cfg['id'] in sconfig:
+            LOG.warning('Dropping Duplicate id: %s' % cfg['id'])
+        sconfig[cfg['id']] = cfg
+
+    deps = get_item_dependency_sets(sconfig, validate=validate)
+
+    def _sort_key(item_id):
+        item_cfg = sconfig[item_id]
+        order_key = _stype_to_order_key(item_cfg['type'])
+        return (len(deps[item_id] | {item_id}), item_cfg['type'],
+                operator.itemgetter(*list(order_key))(item_cfg))
+
+    return [sconfig[item_id] for item_id in sorted(sconfig, key=_sort_key)]
+
+
 def config_tree_to_list(config_tree):
     """ ConfigTrees are OrderedDicts which insert dependent storage configs
         from leaf to root.  Reversing this insertion order creates a list
@@ -402,6 +560,70 @@ def extract_storage_ordered_dict(config):
     return OrderedDict((d["id"], d) for d in scfg)
 
 
+class ProbeDataIndex(object):
+    """ Lookups into probert probe data shared by the ProbertParsers.
+
+        Each map is built by a single pass over the 'blockdev' data the
+        first time it is needed, so all the parsers run by
+        extract_storage_config share the cost.  The probe data must not be
+        modified once lookups have been made.
+    """
+
+    def __init__(self, probe_data):
+        self.blockdev_data = probe_data.get('blockdev') or {}
+        self._devlinks = None
+        self._partitions = {}
+        self._mpath = {}
+
+    @property
+    def devlinks(self):
+        """ Map every DEVLINKS alias (by-id, by-uuid, by-path, /dev/mapper
+            names, ...) to the kernel name of the blockdev that lists it
+            first. """
+        if self._devlinks is None:
+            self._devlinks = {}
+            for bd_key, bdata in self.blockdev_data.items():
+                for link in bdata.get('DEVLINKS', '').split():
+                    self._devlinks.setdefault(link, bd_key)
+        return self._devlinks
+
+    def lookup_devname(self, devname):
+        if devname in self.blockdev_data:
+            return devname
+        return self.devlinks.get(devname)
+
+    def partition_entry(self, parent_devname, devname):
+        """ Return the 'partitiontable' entry of parent_devname for the
+            partition devname, or None. """
+        if parent_devname not in self._partitions:
+            entries = {}
+            parent = self.blockdev_data.get(parent_devname, {})
+            ptable = parent.get('partitiontable') or {}
+            for pentry in ptable.get('partitions', []):
+                entries.setdefault(self.lookup_devname(pentry['node']),
+                                   pentry)
+            self._partitions[parent_devname] = entries
+        return self._partitions[parent_devname].get(devname)
+
+    def _mpath_check(self, check, blockdev):
+        devname = blockdev.get('DEVNAME', '')
+        if self.blockdev_data.get(devname) is not blockdev:
+            return check(devname, blockdev)
+        key = (check, devname)
+        if key not in self._mpath:
+            self._mpath[key] = check(devname, blockdev)
+        return self._mpath[key]
+
+    def is_mpath_member(self, blockdev):
+        return self._mpath_check(multipath.is_mpath_member, blockdev)
+
+    def is_mpath_device(self, blockdev):
+        return self._mpath_check(multipath.is_mpath_device, blockdev)
+
+    def is_mpath_partition(self, blockdev):
+        return self._mpath_check(multipath.is_mpath_partition, blockdev)
+
+
 class ProbertParser(object):
     """ Base class for parsing probert storage configuration.
 
@@ -416,7 +638,7 @@ class ProbertParser(object):
     probe_data_key = None
     class_data = None
 
-    def __init__(self, probe_data):
+    def __init__(self, probe_data, index=None):
         if not probe_data or not isinstance(probe_data, dict):
             raise ValueError('Invalid probe_data: %s' % probe_data)
 
@@ -438,6 +660,10 @@ class ProbertParser(object):
         if not self.blockdev_data:
             LOG.warning('probe_data missing valid "blockdev" data')
 
+        if index is None:
+            index = ProbeDataIndex(probe_data)
+        self.index = index
+
     def parse(self):
         raise NotImplementedError()
 
@@ -450,25 +676,16 @@ class ProbertParser(object):
             the dictionary keys, search under 'DEVLINKS' of each
             device and return the dictionary for the kernel.
         """
-        if devname in self.blockdev_data:
-            return devname
-
-        for bd_key, bdata in self.blockdev_data.items():
-            devlinks = bdata.get('DEVLINKS', '').split()
-            if devname in devlinks:
-                return bd_key
-
-        return None
+        return self.index.lookup_devname(devname)
 
     def is_mpath_member(self, blockdev):
-        return multipath.is_mpath_member(blockdev.get('DEVNAME', ''), blockdev)
+        return self.index.is_mpath_member(blockdev)
 
     def is_mpath_device(self, blockdev):
-        return multipath.is_mpath_device(blockdev.get('DEVNAME', ''), blockdev)
+        return self.index.is_mpath_device(blockdev)
 
     def is_mpath_partition(self, blockdev):
-        return multipath.is_mpath_partition(
-            blockdev.get('DEVNAME', ''), blockdev)
+        return self.index.is_mpath_partition(blockdev)
 
     def blockdev_to_id(self, blockdev):
         """ Examine a blockdev dictionary and return a tuple of curtin
@@ -521,8 +738,8 @@ class BcacheParser(ProbertParser):
 
     probe_data_key = 'bcache'
 
-    def __init__(self, probe_data):
-        super(BcacheParser, self).__init__(probe_data)
+    def __init__(self, probe_data, index=None):
+        super(BcacheParser, self).__init__(probe_data, index=index)
         self.backing = self.class_data.get('backing', {})
         self.caching = self.class_data.get('caching', {})
 
@@ -567,17 +784,12 @@ class BcacheParser(ProbertParser):
 
             return None
 
-        def _find_bcache_devname(uuid, backing_data, blockdev_data):
+        def _find_bcache_devname(uuid, backing_data):
             by_uuid = '/dev/bcache/by-uuid/' + uuid
             label = _sb_get(backing_data, 'dev.label')
-            for devname, data in blockdev_data.items():
-                if not devname:
-                    continue
-                if devname.startswith('/dev/bcache'):
-                    # DEVLINKS is a space separated list
-                    devlinks = data.get('DEVLINKS', '').split()
-                    if by_uuid in devlinks:
-                        return devname
+            devname = self.index.devlinks.get(by_uuid)
+            if devname and devname.startswith('/dev/bcache'):
+                return devname
             if label:
                 return label
             LOG.warning('Failed to find bcache %s ' % (by_uuid))
@@ -596,8 +808,7 @@ class BcacheParser(ProbertParser):
         backing_device = backing_data.get('blockdev')
         cache_device = _find_cache_device(backing_data, self.caching)
         cache_mode = _cache_mode(backing_data)
-        devname = _find_bcache_devname(backing_uuid,
-                                       backing_data, self.blockdev_data)
+        devname = _find_bcache_devname(backing_uuid, backing_data)
         bcache_name = os.path.basename(devname)
         bcache_entry = {'type': 'bcache', 'id': 'disk-%s' % bcache_name,
                         'name': bcache_name, 'path': devname}
@@ -790,12 +1001,7 @@ class BlockdevParser(ProbertParser):
                     return None
             ptable = parent_blockdev.get('partitiontable')
             if ptable:
-                part = None
-                for pentry in ptable['partitions']:
-                    if self.lookup_devname(pentry['node']) == devname:
-                        part = pentry
-                        break
-
+                part = self.index.partition_entry(parent_devname, devname)
                 if part is None:
                     raise RuntimeError(
                         "Couldn't find partition entry in table")
@@ -1364,32 +1570,23 @@ def extract_storage_config(probe_data, strict=False):
         'nvme': NVMeParser,
         'zfs': ZfsParser,
     }
-    configs = []
+    type_order = ['nvme_controller', 'dasd', 'disk', 'partition', 'format',
+                  'lvm_volgroup', 'lvm_partition', 'raid', 'dm_crypt',
+                  'mount', 'bcache', 'zpool', 'zfs']
+    configs = {stype: [] for stype in type_order}
     errors = []
+    index = ProbeDataIndex(probe_data)
     LOG.debug('Extracting storage config from probe data')
     for ptype, pname in convert_map.items():
-        parser = pname(probe_data)
+        parser = pname(probe_data, index=index)
         found_cfgs, found_errs = parser.parse()
-        configs.extend(found_cfgs)
+        for cfg in found_cfgs:
+            if cfg.get('type') in configs:
+                configs[cfg['type']].append(cfg)
         errors.extend(found_errs)
 
     LOG.debug('Sorting extracted configurations')
-    dasd = [cfg for cfg in configs if cfg.get('type') == 'dasd']
-    disk = [cfg for cfg in configs if cfg.get('type') == 'disk']
-    part = [cfg for cfg in configs if cfg.get('type') == 'partition']
-    format = [cfg for cfg in configs if cfg.get('type') == 'format']
-    lvols = [cfg for cfg in configs if cfg.get('type') == 'lvm_volgroup']
-    lparts = [cfg for cfg in configs if cfg.get('type') == 'lvm_partition']
-    raids = [cfg for cfg in configs if cfg.get('type') == 'raid']
-    dmcrypts = [cfg for cfg in configs if cfg.get('type') == 'dm_crypt']
-    mounts = [cfg for cfg in configs if cfg.get('type') == 'mount']
-    nvmes = [cfg for cfg in configs if cfg.get('type') == 'nvme_controller']
-    bcache = [cfg for cfg in configs if cfg.get('type') == 'bcache']
-    zpool = [cfg for cfg in configs if cfg.get('type') == 'zpool']
-    zfs = [cfg for cfg in configs if cfg.get('type') == 'zfs']
-
-    ordered = (nvmes + dasd + disk + part + format + lvols + lparts + raids +
-               dmcrypts + mounts + bcache + zpool + zfs)
+    ordered = [cfg for stype in type_order for cfg in configs[stype]]
 
     final_config = {'storage': {'version': 2, 'config': ordered}}
     try:
@@ -1414,16 +1611,10 @@ def extract_storage_config(probe_data, strict=False):
               yaml.dump({'storage': ordered},
                         indent=4, default_flow_style=False))
 
-    LOG.debug("Generating storage config dependencies")
-    ctrees = []
-    for cfg in ordered:
-        tree = get_config_tree(cfg.get('id'), final_config)
-        ctrees.append(tree)
-
-    LOG.debug("Merging storage config dependencies")
+    LOG.debug("Sorting storage config by dependencies")
     merged_config = {
         'version': 2,
-        'config': merge_config_trees_to_list(ctrees)
+        'config': sort_storage_config(ordered)
     }
     LOG.debug("Merged storage config:\n%s",
               yaml.dump({'storage': merged_config},
@@ -2,6 +2,9 @@
 
 import shlex
 import os
+import stat
+import threading
+import time
 
 from curtin import util
 from curtin.log import logged_call, LOG
@@ -13,6 +16,23 @@ except AttributeError:
     import pipes
     shlex_quote = pipes.quote
 
+UDEV_DATA_DIR = '/run/udev/data'
+SYSFS_ROOT = '/sys'
+# seconds wait_for_device waits by default
+DEVICE_WAIT_TIMEOUT = 30
+# longest time wait_for goes without checking its condition, and the first
+# interval of its polling when udev events can not be monitored
+DEVICE_POLL_INTERVAL = 0.5
+DEVICE_POLL_START = 0.01
+
+# udevadm_info results read from the udev database, keyed by the
+# 'major:minor' of the block device and dropped by udevadm_settle
+_UDEV_DB_CACHE = {}
+# incremented every time the cache is dropped
+_UDEV_DB_GENERATION = 0
+# guards the generation, which worker threads may bump concurrently
+_UDEV_DB_LOCK = threading.Lock()
+
 
 def compose_udev_equality(key, value):
     """Return a udev comparison clause, like `ACTION=="add"`."""
@@ -56,12 +76,16 @@ def udevadm_settle(exists=None, timeout=None):
     if exists:
         # skip the settle if the requested path already exists
         if os.path.exists(exists):
+            clear_udev_db_cache()
             return
         settle_cmd.extend(['--exit-if-exists=%s' % exists])
     if timeout:
         settle_cmd.extend(['--timeout=%s' % timeout])
 
-    util.subp(settle_cmd)
+    try:
+        util.subp(settle_cmd)
+    finally:
+        clear_udev_db_cache()
 
 
 def udevadm_trigger(devices):
@@ -71,10 +95,202 @@ def udevadm_trigger(devices):
     udevadm_settle()
 
 
+def clear_udev_db_cache():
+    """Forget the device properties read from the udev database."""
+    global _UDEV_DB_GENERATION
+    with _UDEV_DB_LOCK:
+        _UDEV_DB_CACHE.clear()
+        _UDEV_DB_GENERATION += 1
+
+
+def udev_db_generation():
+    """Return a number that changes every time udevadm_settle or wait_for
+    runs."""
+    return _UDEV_DB_GENERATION
+
+
+def _block_monitor():
+    """Return a started pyudev monitor of the block device events processed
+    by udev, or None if they can not be monitored."""
+    try:
+        import pyudev
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        monitor.filter_by(subsystem='block')
+        monitor.start()
+    except (ImportError, OSError) as e:
+        LOG.debug('Polling, unable to monitor udev events: %s', e)
+        return None
+    return monitor
+
+
+def wait_for(condition, timeout=DEVICE_WAIT_TIMEOUT, description=None):
+    """Wait until condition() returns True.
+
+    Rather than settling the whole udev queue, condition is checked again
+    after every block device event udev processes, and at least every
+    DEVICE_POLL_INTERVAL seconds for changes which come with no event.
+    Without pyudev or access to the udev netlink socket, condition is
+    polled with intervals growing from DEVICE_POLL_START.
+
+    :param condition: callable taking no argument.
+    :param timeout: seconds to wait for condition.
+    :param description: what is waited for, for the messages.
+    :returns: seconds waited.
+    :raises: OSError if condition is not true after timeout seconds.
+    """
+    if description is None:
+        description = getattr(condition, '__name__', 'condition')
+    start = time.monotonic()
+    try:
+        if condition():
+            return 0
+        deadline = start + timeout
+        interval = DEVICE_POLL_START
+        # the monitor is started before the next check so no event is missed
+        monitor = _block_monitor()
+        LOG.debug('waiting up to %ss for %s', timeout, description)
+        while not condition():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise OSError('Timeout exceeded waiting for %s' % description)
+            if monitor is not None:
+                monitor.poll(timeout=min(remaining, DEVICE_POLL_INTERVAL))
+            else:
+                time.sleep(min(remaining, interval))
+                interval = min(interval * 2, DEVICE_POLL_INTERVAL)
+    finally:
+        # callers wait after changing devices, the properties read before
+        # may be stale even when no wait was needed
+        clear_udev_db_cache()
+    waited = time.monotonic() - start
+    LOG.debug('waited %.3fs for %s', waited, description)
+    return waited
+
+
+def _udev_initialized(path):
+    """Return False if udev runs and has not processed the block device at
+    path yet."""
+    if not os.path.isdir(UDEV_DATA_DIR):
+        return True
+    devt = _block_devt(path)
+    if devt is None:
+        return True
+    return os.path.exists(os.path.join(UDEV_DATA_DIR, 'b' + devt))
+
+
+def wait_for_device(path, present=True, timeout=DEVICE_WAIT_TIMEOUT,
+                    initialized=False):
+    """Wait for path to appear, or with present=False to disappear.
+
+    With initialized=True, also wait until udev has processed the block
+    device at path, so its udev properties and symlinks are in place.
+    Returns the seconds waited, raises OSError after timeout seconds.
+    """
+    def ready():
+        if not present:
+            return not os.path.exists(path)
+        return (os.path.exists(path) and
+                (not initialized or _udev_initialized(path)))
+    return wait_for(ready, timeout=timeout, description='%s to %s' % (
+        path, 'appear' if present else 'be removed'))
+
+
+def _block_devt(path):
+    """Return 'major:minor' of the block device at a /dev or /sys path, or
+    None if path is not a block device."""
+    if path.startswith(SYSFS_ROOT + '/'):
+        try:
+            return util.load_file(os.path.join(path, 'dev')).strip()
+        except (IOError, OSError):
+            return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISBLK(st.st_mode):
+        return None
+    return '%d:%d' % (os.major(st.st_rdev), os.minor(st.st_rdev))
+
+
+def _udev_db_value(key, value):
+    """Return value as udevadm_info parses it from 'udevadm info' output."""
+    if ' ' not in value:
+        return value
+    if key == 'DEVLINKS':
+        return value.split()
+    if key == 'ID_SERIAL':
+        return value
+    return [value]
+
+
+def _copy_udev_db_entry(entry):
+    return {key: list(value) if isinstance(value, list) else value
+            for (key, value) in entry.items()}
+
+
+def udev_db_info(devt):
+    """ Return the udevadm_info dictionary of a block device read from the
+        udev database and the kernel uevent of the device.
+
+    :params: devt: 'major:minor' of the block device
+    :returns: dictionary of properties or None if udev has no record of the
+              device.
+    """
+    # a single lookup, the cache may be cleared by another thread
+    entry = _UDEV_DB_CACHE.get(devt)
+    if entry is not None:
+        return _copy_udev_db_entry(entry)
+
+    sysdev = os.path.join(SYSFS_ROOT, 'dev', 'block', devt)
+    try:
+        data = util.load_file(os.path.join(UDEV_DATA_DIR, 'b' + devt))
+        uevent = util.load_file(os.path.join(sysdev, 'uevent'))
+    except (IOError, OSError):
+        return None
+
+    props = {
+        'DEVPATH': '/' + os.path.relpath(os.path.realpath(sysdev),
+                                         os.path.realpath(SYSFS_ROOT)),
+        'SUBSYSTEM': 'block',
+    }
+    for line in uevent.splitlines():
+        key, _, value = line.partition('=')
+        props[key] = value
+    if props.get('DEVNAME'):
+        props['DEVNAME'] = os.path.join('/dev', props['DEVNAME'])
+
+    links = []
+    tags = {'G': [], 'Q': []}
+    for line in data.splitlines():
+        kind, _, value = line.partition(':')
+        if kind == 'E':
+            key, _, value = value.partition('=')
+            props[key] = value
+        elif kind == 'S':
+            links.append(os.path.join('/dev', value))
+        elif kind == 'I':
+            props['USEC_INITIALIZED'] = value
+        elif kind in tags:
+            tags[kind].append(value)
+    if links:
+        props['DEVLINKS'] = ' '.join(links)
+    for (kind, key) in (('G', 'TAGS'), ('Q', 'CURRENT_TAGS')):
+        if tags[kind]:
+            props[key] = ':%s:' % ':'.join(tags[kind])
+
+    entry = {key: _udev_db_value(key, value)
+             for (key, value) in props.items() if value}
+    _UDEV_DB_CACHE[devt] = entry
+    return _copy_udev_db_entry(entry)
+
+
 def udevadm_info(path=None):
     """ Return a dictionary populated by properties of the device specified
         in the `path` variable via querying udev 'property' database.
 
+    The properties of block devices are read from the udev database when
+    udev has a record of the device, otherwise 'udevadm info' is run.
+
     :params: path: path to device, either /dev or /sys
     :returns: dictionary of key=value pairs as exported from the udev database
     :raises: ValueError path is None, ProcessExecutionError on exec error.
@@ -82,6 +298,12 @@ def udevadm_info(path=None):
     if not path:
         raise ValueError('Invalid path: "%s"' % path)
 
+    devt = _block_devt(path)
+    if devt is not None:
+        info = udev_db_info(devt)
+        if info is not None:
+            return info
+
     info_cmd = ['udevadm', 'info', '--query=property', '--export', path]
     output, _ = util.subp(info_cmd, capture=True)
 
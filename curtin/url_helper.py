@@ -1,10 +1,14 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 from email.utils import parsedate
+import http.client
+import io
 import json
 import os
 import socket
+import ssl
 import sys
+import threading
 import time
 import uuid
 from functools import partial
@@ -15,19 +19,213 @@ try:
     from urllib import request as _u_re  # pylint: disable=no-name-in-module
     from urllib import error as _u_e     # pylint: disable=no-name-in-module
     from urllib.parse import urlparse    # pylint: disable=no-name-in-module
+    from urllib.parse import urljoin     # pylint: disable=no-name-in-module
     urllib_request = _u_re
     urllib_error = _u_e
 except ImportError:
     # python2
     import urllib2 as urllib_request
     import urllib2 as urllib_error
-    from urlparse import urlparse  # pylint: disable=import-error
+    from urlparse import urlparse, urljoin  # pylint: disable=import-error
 
 from .log import LOG
 
 error = urllib_error
 
 DEFAULT_HEADERS = {'User-Agent': 'Curtin/' + version.version_string()}
+DOWNLOAD_BUFLEN = 1024 * 1024
+# idle keep-alive connections kept per host
+POOL_MAXSIZE = 8
+# redirects followed by a pooled request, like urllib
+MAX_REDIRECTS = 10
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class _PooledResponse(object):
+    """A http.client response that hands its connection back to the pool
+    once it has been read completely."""
+
+    def __init__(self, pool, key, conn, resp, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self.url = url
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.msg
+
+    def info(self):
+        return self._resp.msg
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def read(self, amt=None):
+        try:
+            if amt is None or amt < 0:
+                buf = self._resp.read()
+            else:
+                buf = self._resp.read(amt)
+        except BaseException:
+            self.close()
+            raise
+        if self._resp.isclosed():
+            self._release()
+        return buf
+
+    def _release(self):
+        (conn, self._conn) = (self._conn, None)
+        if conn is None:
+            return
+        if self._resp.will_close:
+            conn.close()
+        else:
+            self._pool.put(self._key, conn)
+
+    def close(self):
+        if self._resp.isclosed():
+            self._release()
+        elif self._conn is not None:
+            # the rest of the response was not read, the connection can
+            # not be reused
+            self._resp.close()
+            self._conn.close()
+            self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        self.close()
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of keep-alive http and https connections.
+
+    Connections are taken from the pool for a request and put back once
+    the response was read completely, at most maxsize idle connections
+    are kept per host.  A request that fails because the server closed an
+    idle connection is sent again on a new connection, once it is sent
+    only if it is a GET or HEAD request, which can safely be repeated.
+    """
+
+    def __init__(self, maxsize=POOL_MAXSIZE):
+        self.maxsize = maxsize
+        self.connects = 0
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def get(self, key):
+        """Return (connection, reused) for key, (scheme, host, port)."""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return (idle.pop(), True)
+            self.connects += 1
+        (scheme, host, port) = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(
+                host, port, context=ssl.create_default_context())
+        else:
+            conn = http.client.HTTPConnection(host, port)
+        return (conn, False)
+
+    def put(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            (idle, self._idle) = (self._idle, {})
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _request(self, key, method, path, body, headers):
+        while True:
+            (conn, reused) = self.get(key)
+            sent = False
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                sent = True
+                return (conn, conn.getresponse())
+            except (ConnectionError, http.client.BadStatusLine) as e:
+                conn.close()
+                # the server may have acted on a request it got already
+                if not reused or (sent and method not in ('GET', 'HEAD')):
+                    raise
+                LOG.debug('idle connection to %s closed, reconnecting: %s',
+                          key[1], e)
+            except BaseException:
+                conn.close()
+                raise
+
+    def urlopen(self, req):
+        """Open the urllib Request req like urllib.request.urlopen."""
+        url = req.full_url
+        method = req.get_method()
+        body = req.data
+        headers = dict(req.header_items())
+        if body is not None and 'Content-type' not in headers:
+            headers['Content-type'] = 'application/x-www-form-urlencoded'
+        for _ in range(MAX_REDIRECTS + 1):
+            parsed = urlparse(url)
+            key = (parsed.scheme, parsed.hostname, parsed.port)
+            path = parsed.path or '/'
+            if parsed.query:
+                path += '?' + parsed.query
+            (conn, resp) = self._request(key, method, path, body, headers)
+            response = _PooledResponse(self, key, conn, resp, url)
+            location = resp.getheader('location')
+            if resp.status not in REDIRECT_CODES or not location:
+                break
+            if resp.status in (307, 308) and method not in ('GET', 'HEAD'):
+                break
+            response.read()
+            url = urljoin(url, location)
+            if method != 'HEAD':
+                method = 'GET'
+            if body is not None:
+                body = None
+                headers = dict((k, v) for (k, v) in headers.items()
+                               if k not in ('Content-type', 'Content-length'))
+            if not _use_pool(url):
+                # the redirect target goes through a proxy
+                return urllib_request.urlopen(urllib_request.Request(
+                    url, headers=headers, method=method))
+        if response.status >= 300:
+            # read the error so the connection can be reused
+            raise urllib_error.HTTPError(url, response.status,
+                                         response.reason, response.headers,
+                                         io.BytesIO(response.read()))
+        return response
+
+
+POOL = ConnectionPool()
+
+
+def _use_pool(url):
+    """Return True if url is http(s) and does not go through a proxy."""
+    parsed = urlparse(url)
+    return (parsed.scheme in ('http', 'https') and
+            (parsed.scheme not in urllib_request.getproxies() or
+             bool(urllib_request.proxy_bypass(parsed.hostname))))
+
+
+def _urlopen(req):
+    """Open the urllib Request req on a pooled connection unless it is not
+    http(s) or goes through a proxy."""
+    if _use_pool(req.full_url):
+        return POOL.urlopen(req)
+    return urllib_request.urlopen(req)
 
 
 class _ReRaisedException(Exception):
@@ -46,7 +244,7 @@ class UrlReader(object):
         self.url = url
         try:
             req = urllib_request.Request(url=url, data=data, headers=headers)
-            self.fp = urllib_request.urlopen(req)
+            self.fp = _urlopen(req)
         except urllib_error.HTTPError as exc:
             raise UrlError(exc, code=exc.code, headers=exc.headers, url=url,
                            reason=exc.reason)
@@ -56,6 +254,7 @@ class UrlReader(object):
 
         self.info = self.fp.info()
         self.size = self.info.get('content-length', -1)
+        self.status = getattr(self.fp, 'status', None)
 
     def read(self, buflen):
         try:
@@ -85,20 +284,38 @@ class UrlReader(object):
 def download(url, path, reporthook=None, data=None, retries=0, retry_delay=3):
     """Download url to path.
 
+    Server errors (http 5xx) are retried up to retries times, as are
+    transfers interrupted after some data was received.  Those are resumed
+    with a Range request if the server supports it.
+
     reporthook is compatible with py3 urllib.request.urlretrieve.
     urlretrieve does not exist in py2."""
 
-    buflen = 8192
+    buflen = DOWNLOAD_BUFLEN
     attempts = 0
+    fsize = 0
+    start = time.time()
 
     while True:
-        wfp = open(path, "wb")
+        headers = None
+        if fsize and data is None:
+            headers = {'Range': 'bytes=%d-' % fsize}
+        wfp = open(path, "ab" if headers else "wb")
         try:
             buf = None
             blocknum = 0
-            fsize = 0
-            start = time.time()
-            with UrlReader(url) as rfp:
+            if headers:
+                rfp = UrlReader(url, headers=headers)
+                if rfp.status != 206:
+                    # the server sent all of it
+                    LOG.debug("Range not supported by %s, restarting",
+                              url)
+                    wfp.seek(0)
+                    wfp.truncate()
+                    fsize = 0
+            else:
+                rfp = UrlReader(url)
+            with rfp:
                 if reporthook:
                     reporthook(blocknum, buflen, rfp.size)
 
@@ -117,8 +334,13 @@ def download(url, path, reporthook=None, data=None, retries=0, retry_delay=3):
                       fsize / timedelta / 1024 / 1024)
             return path, rfp.info
         except UrlError as e:
-            # retry on internal server errors up to "retries #"
-            if (e.code < 500 or attempts >= retries):
+            # retry on internal server errors and interrupted transfers up
+            # to "retries #"
+            if e.code is None:
+                retry = fsize > 0
+            else:
+                retry = e.code >= 500
+            if not retry or attempts >= retries:
                 raise e
             LOG.debug("Current download failed with error: %s. Retrying in"
                       " %d seconds.",
@@ -207,7 +429,7 @@ def _geturl(url, headers=None, headers_cb=None, exception_cb=None, data=None):
 
     try:
         req = urllib_request.Request(url=url, data=data, headers=headers)
-        r = urllib_request.urlopen(req).read()
+        r = _urlopen(req).read()
         # python2, we want to return bytes, which is what python3 does
         if isinstance(r, str):
             return r.decode()
@@ -47,6 +47,7 @@ except NameError:
     FileMissingError = IOError
 
 from . import paths
+from . import profiling
 from .log import LOG, log_call
 
 binary_type = bytes
@@ -114,7 +115,8 @@ def _subp(args, data=None, rcs=None, env=None, capture=False,
     except RuntimeError as e:
         raise RuntimeError("Unable to unshare pid (cmd=%s): %s" % (args, e))
 
-    args = unshare_args + chroot_args + sh_args + list(args)
+    cmd_args = sh_args + list(args)
+    args = unshare_args + chroot_args + cmd_args
 
     if not logstring:
         LOG.debug(
@@ -138,11 +140,17 @@ def _subp(args, data=None, rcs=None, env=None, capture=False,
             stdin = devnull_fp
         else:
             stdin = subprocess.PIPE
-        sp = subprocess.Popen(args, stdout=stdout,
-                              stderr=stderr, stdin=stdin,
-                              env=env, shell=False, cwd=cwd)
+        if profiling.enabled():
+            popen = profiling.RusagePopen
+            start = time.monotonic()
+        else:
+            popen = subprocess.Popen
+        sp = popen(args, stdout=stdout, stderr=stderr, stdin=stdin,
+                   env=env, shell=False, cwd=cwd)
         # communicate in python2 returns str, python3 returns bytes
         (out, err) = sp.communicate(data)
+        if popen is not subprocess.Popen:
+            profiling.record(cmd_args, start, sp.returncode, sp.rusage)
 
         # Just ensure blank instead of none.
         if capture or combine_capture:
@@ -324,24 +332,17 @@ def subp(*args, **kwargs):
 
 
 def wait_for_removal(path, retries=[1, 3, 5, 7]):
+    """Wait for path to be removed, for up to the sum of retries seconds.
+
+    The path is checked again as soon as udev processes a block device
+    event, see udev.wait_for.
+    """
+    from curtin import udev
     if not path:
         raise ValueError('wait_for_removal: missing path parameter')
 
-    # Retry with waits between checking for existence
-    LOG.debug('waiting for %s to be removed', path)
-    for num, wait in enumerate(retries):
-        if not os.path.exists(path):
-            LOG.debug('%s has been removed', path)
-            return
-        LOG.debug('sleeping %s', wait)
-        time.sleep(wait)
-
-    # final check
-    if not os.path.exists(path):
-        LOG.debug('%s has been removed', path)
-        return
-
-    raise OSError('Timeout exceeded for removal of %s', path)
+    udev.wait_for_device(path, present=False, timeout=sum(retries))
+    LOG.debug('%s has been removed', path)
 
 
 def load_command_environment(env=os.environ, strict=False):
@@ -755,6 +756,10 @@ def undisable_daemons_in_root(target):
     return True
 
 
+# target path -> ChrootSession currently holding the target's chroot mounts
+_CHROOT_SESSIONS = {}
+
+
 class ChrootableTarget(object):
     def __init__(self, target, allow_daemons=False, sys_resolvconf=True,
                  mounts=None):
@@ -773,13 +778,41 @@ class ChrootableTarget(object):
         self.sys_resolvconf = sys_resolvconf
         self.rconf_d = None
         self.rc_tmp = None
+        self.session = None
 
-    def __enter__(self):
+    def _mount(self):
         for p in self.mounts:
             tpath = paths.target_path(self.target, p)
             if do_mount(p, tpath, opts='--bind'):
                 self.umounts.append(tpath)
 
+        # Bind-mount true to ischroot since we may be in separate PID
+        # namespace, which can throw off ischroot
+        true_mount_path = paths.target_path(self.target, '/usr/bin/true')
+        ischroot_mount_path = paths.target_path(self.target,
+                                                '/usr/bin/ischroot')
+        true_exists = os.path.isfile(true_mount_path)
+        ischroot_exists = os.path.isfile(ischroot_mount_path)
+        both_exist = true_exists and ischroot_exists
+        if both_exist and do_mount(true_mount_path, ischroot_mount_path,
+                                   opts='--bind'):
+            self.umounts.append(ischroot_mount_path)
+
+    def _umount(self):
+        # if /dev is to be unmounted, udevadm settle (LP: #1462139)
+        if paths.target_path(self.target, "/dev") in self.umounts:
+            log_call(subp, ['udevadm', 'settle'])
+
+        for p in reversed(self.umounts):
+            do_umount(p, private=True)
+
+    def __enter__(self):
+        session = _CHROOT_SESSIONS.get(self.target)
+        if session is not None and session.covers(self.mounts):
+            self.session = session.acquire()
+        else:
+            self._mount()
+
         if self.target != "/" and not self.allow_daemons:
             self.disabled_daemons = disable_daemons_in_root(self.target)
 
@@ -807,30 +840,17 @@ class ChrootableTarget(object):
                     self.rc_tmp = None
                 raise
 
-        # Bind-mount true to ischroot since we may be in separate PID
-        # namespace, which can throw off ischroot
-        true_mount_path = paths.target_path(self.target, '/usr/bin/true')
-        ischroot_mount_path = paths.target_path(self.target,
-                                                '/usr/bin/ischroot')
-        true_exists = os.path.isfile(true_mount_path)
-        ischroot_exists = os.path.isfile(ischroot_mount_path)
-        both_exist = true_exists and ischroot_exists
-        if both_exist and do_mount(true_mount_path, ischroot_mount_path,
-                                   opts='--bind'):
-            self.umounts.append(ischroot_mount_path)
-
         return self
 
     def __exit__(self, etype, value, trace):
         if self.disabled_daemons:
             undisable_daemons_in_root(self.target)
 
-        # if /dev is to be unmounted, udevadm settle (LP: #1462139)
-        if paths.target_path(self.target, "/dev") in self.umounts:
-            log_call(subp, ['udevadm', 'settle'])
-
-        for p in reversed(self.umounts):
-            do_umount(p, private=True)
+        if self.session is not None:
+            self.session.release()
+            self.session = None
+        else:
+            self._umount()
 
         rconf = paths.target_path(self.target, "/etc/resolv.conf")
         if self.sys_resolvconf and self.rconf_d:
@@ -846,6 +866,66 @@ class ChrootableTarget(object):
         return paths.target_path(self.target, path)
 
 
+class ChrootSession(object):
+    """Keep the ChrootableTarget mounts of target in place until exit.
+
+    ChrootableTarget users entered inside the session reuse its bind mounts
+    instead of mounting them, and settling udev and unmounting them again,
+    on every enter and exit.  Nested sessions for the same target reuse the
+    outermost one, which is the only one that tears the mounts down.
+    """
+
+    def __init__(self, target, mounts=None):
+        self.chroot = ChrootableTarget(target, mounts=mounts)
+        self.target = self.chroot.target
+        self.mounts = self.chroot.mounts
+        self.owner = False
+        self.users = 0
+        self.reused = 0
+
+    def covers(self, mounts):
+        return set(mounts).issubset(self.mounts)
+
+    def acquire(self):
+        self.users += 1
+        self.reused += 1
+        return self
+
+    def release(self):
+        self.users -= 1
+
+    def stats(self):
+        """Return the number of mount, umount and settle calls avoided."""
+        mounts = len(self.chroot.umounts)
+        settles = int(paths.target_path(self.target, "/dev") in
+                      self.chroot.umounts)
+        return {'reused': self.reused,
+                'mount': self.reused * mounts,
+                'umount': self.reused * mounts,
+                'settle': self.reused * settles}
+
+    def __enter__(self):
+        session = _CHROOT_SESSIONS.get(self.target)
+        if session is not None:
+            return session
+        self.chroot._mount()
+        _CHROOT_SESSIONS[self.target] = self
+        self.owner = True
+        return self
+
+    def __exit__(self, etype, value, trace):
+        if not self.owner:
+            return
+        if self.users:
+            LOG.warning("Closing chroot session for %s with %d active users",
+                        self.target, self.users)
+        LOG.debug("Chroot session for %s avoided: %s", self.target,
+                  self.stats())
+        del _CHROOT_SESSIONS[self.target]
+        self.owner = False
+        self.chroot._umount()
+
+
 def is_exe(fpath):
     # Return path of program for execution if found in path
     return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
@@ -1081,9 +1161,9 @@ def sanitize_source(source):
     if type(source) is dict:
         # already sanitized?
         return source
-    supported = ['tgz', 'dd-tgz', 'tbz', 'dd-tbz', 'txz', 'dd-txz', 'dd-tar',
-                 'dd-bz2', 'dd-gz', 'dd-xz', 'dd-raw', 'fsimage',
-                 'fsimage-layered']
+    supported = ['tgz', 'dd-tgz', 'tbz', 'dd-tbz', 'txz', 'dd-txz', 'tzst',
+                 'dd-tar', 'dd-tzst', 'dd-bz2', 'dd-gz', 'dd-xz', 'dd-zst',
+                 'dd-raw', 'fsimage', 'fsimage-layered']
     deftype = 'tgz'
     for i in supported:
         prefix = i + ":"
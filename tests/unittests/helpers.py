@@ -54,6 +54,13 @@ def skipUnlessJsonSchema():
         _missing_jsonschema_dep, "No python-jsonschema dependency present.")
 
 
+def skipUnlessBenchmark():
+    """Benchmarks are slow, only run them with CURTIN_BENCHMARK=1."""
+    return skipIf(
+        os.environ.get('CURTIN_BENCHMARK', '0') in ('', '0'),
+        "Benchmarks disabled, set CURTIN_BENCHMARK=1 to enable.")
+
+
 class CiTestCase(TestCase):
     """Common testing class which all curtin unit tests subclass."""
 
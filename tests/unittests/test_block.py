@@ -6,10 +6,11 @@ import os
 from unittest import mock
 import sys
 import textwrap
+import time
 
 from collections import OrderedDict
 
-from .helpers import CiTestCase, simple_mocked_open
+from .helpers import CiTestCase, skipUnlessBenchmark
 from curtin import util
 from curtin import block
 
@@ -416,20 +417,21 @@ class TestWipeVolume(CiTestCase):
         mock_quick_zero.assert_called_with(self.dev, exclusive=True,
                                            partitions=True)
 
-    @mock.patch('curtin.block.wipe_file')
-    def test_wipe_zero(self, mock_wipe_file):
-        with simple_mocked_open():
-            block.wipe_volume(self.dev, exclusive=True, mode='zero')
-            mock_wipe_file.assert_called_with(self.dev, exclusive=True)
-
-    @mock.patch('curtin.block.wipe_file')
-    def test_wipe_random(self, mock_wipe_file):
-        with simple_mocked_open() as mock_open:
-            block.wipe_volume(self.dev, mode='random')
-            mock_open.assert_called_with('/dev/urandom', 'rb')
-            mock_wipe_file.assert_called_with(
-                self.dev, exclusive=True,
-                reader=mock_open.return_value.__enter__().read)
+    @mock.patch('curtin.block.wipe.wipe_fd')
+    @mock.patch('curtin.block.exclusive_open')
+    def test_wipe_zero(self, mock_exclusive_open, mock_wipe_fd):
+        block.wipe_volume(self.dev, exclusive=True, mode='zero')
+        mock_exclusive_open.assert_called_with(self.dev, exclusive=True)
+        fp = mock_exclusive_open.return_value.__enter__.return_value
+        mock_wipe_fd.assert_called_with(fp.fileno(), self.dev, mode='zero')
+
+    @mock.patch('curtin.block.wipe.wipe_fd')
+    @mock.patch('curtin.block.exclusive_open')
+    def test_wipe_random(self, mock_exclusive_open, mock_wipe_fd):
+        block.wipe_volume(self.dev, mode='random')
+        mock_exclusive_open.assert_called_with(self.dev, exclusive=True)
+        fp = mock_exclusive_open.return_value.__enter__.return_value
+        mock_wipe_fd.assert_called_with(fp.fileno(), self.dev, mode='random')
 
     def test_bad_input(self):
         with self.assertRaises(ValueError):
@@ -940,4 +942,218 @@ class TestResize(CiTestCase):
             self.assertEqual({'a', 'b'}, block.get_resize_fstypes())
 
 
+class TestProbeCache(CiTestCase):
+
+    blkid_out = textwrap.dedent("""\
+        /dev/vda1: UUID="0aa1" TYPE="ext4" PARTUUID="7f01"
+        /dev/vda2: UUID="0aa2" TYPE="swap" PARTUUID="7f02"
+        """)
+    lsblk_out = {
+        'vda': {'TYPE': 'disk', 'FSTYPE': '', 'LOG-SEC': '512',
+                'PHY-SEC': '4096', 'device_path': '/dev/vda'},
+        'vda1': {'TYPE': 'part', 'FSTYPE': 'ext4', 'LOG-SEC': '512',
+                 'PHY-SEC': '4096', 'device_path': '/dev/vda1'},
+    }
+
+    def setUp(self):
+        super(TestProbeCache, self).setUp()
+        self.add_patch('curtin.block.util.subp', 'm_subp')
+        self.m_subp.return_value = (self.blkid_out, '')
+        self.add_patch('curtin.block._lsblock', 'm_lsblock')
+        self.m_lsblock.side_effect = lambda args=None: {
+            k: dict(v) for (k, v) in self.lsblk_out.items()}
+        self.cache = block.ProbeCache()
+
+    def test_not_caching_probes_every_time(self):
+        self.m_subp.return_value = (self.blkid_out.splitlines()[0], '')
+        for _ in range(2):
+            self.assertEqual({'/dev/vda1': {'UUID': '0aa1', 'TYPE': 'ext4',
+                                            'PARTUUID': '7f01'}},
+                             self.cache.blkid('/dev/vda1'))
+        self.m_subp.assert_called_with(['blkid', '-o', 'full', '/dev/vda1'],
+                                       capture=True)
+        self.assertEqual(2, self.m_subp.call_count)
+        self.cache.lsblk('/dev/vda')
+        self.m_lsblock.assert_called_with(['/dev/vda'])
+        self.assertEqual((0, 0), (self.cache.hits, self.cache.misses))
+
+    def test_caching_probes_all_devices_once(self):
+        with self.cache.enabled():
+            self.assertEqual({'/dev/vda2': {'UUID': '0aa2', 'TYPE': 'swap',
+                                            'PARTUUID': '7f02'}},
+                             self.cache.blkid('/dev/vda2'))
+            self.cache.blkid('/dev/vda1')
+            self.assertEqual({'vda1': self.lsblk_out['vda1']},
+                             self.cache.lsblk('/dev/vda1'))
+            self.cache.lsblk('/dev/vda')
+        self.m_subp.assert_called_once_with(
+            ['blkid', '-o', 'full', '-c', '/dev/null'], capture=True)
+        self.m_lsblock.assert_called_once_with()
+        self.assertEqual((2, 2), (self.cache.hits, self.cache.misses))
+
+    def test_missing_device_probed_on_its_own(self):
+        with self.cache.enabled():
+            self.cache.blkid('/dev/vda1')
+            self.m_subp.return_value = ('/dev/vdb: PTUUID="0bb0"', '')
+            for _ in range(2):
+                self.assertEqual({'/dev/vdb': {'PTUUID': '0bb0'}},
+                                 self.cache.blkid('/dev/vdb'))
+            self.m_subp.assert_called_with(['blkid', '-o', 'full', '/dev/vdb'],
+                                           capture=True)
+            self.assertEqual(2, self.m_subp.call_count)
+            self.m_subp.side_effect = util.ProcessExecutionError(exit_code=2)
+            with self.assertRaises(util.ProcessExecutionError):
+                self.cache.blkid('/dev/vdc')
+
+    def test_invalidate_and_settle_drop_results(self):
+        with self.cache.enabled():
+            self.cache.lsblk('/dev/vda1')
+            self.cache.invalidate()
+            self.cache.lsblk('/dev/vda1')
+            with mock.patch('curtin.udev.util.subp'):
+                block.udevadm_settle()
+            self.cache.lsblk('/dev/vda1')
+            self.cache.lsblk('/dev/vda1')
+        self.assertEqual(3, self.m_lsblock.call_count)
+        self.assertEqual((1, 3), (self.cache.hits, self.cache.misses))
+
+    def test_get_volume_id_and_sector_size_use_cache(self):
+        with mock.patch('curtin.block.PROBE_CACHE', self.cache):
+            with self.cache.enabled():
+                for _ in range(3):
+                    self.assertEqual(('UUID', '0aa1'),
+                                     block.get_volume_id('/dev/vda1'))
+                    self.assertEqual(
+                        (512, 4096),
+                        block.get_blockdev_sector_size('/dev/vda1'))
+                with mock.patch('curtin.block.quick_zero'):
+                    block.wipe_volume('/dev/vda1')
+                block.get_volume_id('/dev/vda1')
+        self.assertEqual(2, self.m_subp.call_count)
+        self.assertEqual(1, self.m_lsblock.call_count)
+
+    def test_wipe_volume_drops_results_probed_while_wiping(self):
+        with mock.patch('curtin.block.PROBE_CACHE', self.cache):
+            with self.cache.enabled():
+                with mock.patch('curtin.block.quick_zero') as m_zero:
+                    m_zero.side_effect = (
+                        lambda *args, **kwargs: self.cache.blkid('/dev/vda1'))
+                    block.wipe_volume('/dev/vda1')
+                self.cache.blkid('/dev/vda1')
+        self.assertEqual(2, self.m_subp.call_count)
+
+
+def _udev_disk(kname, serial, partitions=0, **props):
+    """Return udev properties of a disk and its partitions."""
+    byid = '/dev/disk/by-id/virtio-%s' % serial
+    devs = [dict(DEVNAME='/dev/' + kname, ID_SERIAL=serial,
+                 DEVLINKS=' '.join([byid, '/dev/disk/by-path/' + kname]),
+                 **props)]
+    for part in range(1, partitions + 1):
+        devs.append({'DEVNAME': '/dev/%s%d' % (kname, part),
+                     'ID_SERIAL': serial, 'PARTN': str(part),
+                     'DEVLINKS': '%s-part%d' % (byid, part)})
+    return devs
+
+
+class TestDiskIndex(CiTestCase):
+
+    def setUp(self):
+        super(TestDiskIndex, self).setUp()
+        self.devices = (
+            _udev_disk('vda', 'disk-a', partitions=2, ID_WWN='0x5000a') +
+            _udev_disk('vdb', 'disk-b') +
+            _udev_disk('dasda', 'dasd-a', ID_PATH='ccw-0.0.1520'))
+        self.add_patch('curtin.block.udev.udev_all_block_device_properties',
+                       'm_udev_all')
+        self.m_udev_all.side_effect = lambda: [
+            dict(dev) for dev in self.devices]
+        self.add_patch('curtin.block.multipath', 'm_mpath')
+        self.m_mpath.is_mpath_device.return_value = False
+        self.m_mpath.is_mpath_member.return_value = False
+        self.cache = block.DiskIndexCache()
+        self.add_patch('curtin.block.DISK_INDEX', new=self.cache)
+
+    def test_index(self):
+        index = block.DiskIndex(self.devices)
+        self.assertEqual(['/dev/vda', '/dev/vdb', '/dev/dasda'],
+                         [dev['DEVNAME'] for dev in index.disks])
+        self.assertEqual(
+            ['/dev/vda'],
+            [dev['DEVNAME']
+             for dev in index.disks_matching('ID_SERIAL', 'disk-a')])
+        self.assertEqual([], index.disks_matching('ID_WWN', 'disk-a'))
+        self.assertEqual(
+            '/dev/vdb',
+            index.disk_by_path('/dev/disk/by-path/vdb')['DEVNAME'])
+        self.assertIsNone(index.disk_by_path('/dev/vda1'))
+        self.assertEqual('/dev/vda2',
+                         index.by_id['virtio-disk-a-part2']['DEVNAME'])
+        self.assertEqual({'0.0.1520': self.devices[-1]}, index.by_ccw)
+
+    def test_index_kept_while_enabled(self):
+        self.assertIsNone(self.cache.current())
+        self.cache.get()
+        self.cache.get()
+        self.assertEqual(2, self.m_udev_all.call_count)
+        with self.cache.enabled():
+            self.assertIs(self.cache.get(), self.cache.current())
+        self.assertEqual(3, self.m_udev_all.call_count)
+
+    @mock.patch('curtin.block.udevadm_settle')
+    @mock.patch('curtin.block.util.subp')
+    @mock.patch('curtin.block.get_unused_blockdev_info')
+    def test_rescan_of_all_disks_rebuilds_index(self, m_unused, m_subp,
+                                                m_settle):
+        m_unused.return_value = {}
+        with self.cache.enabled():
+            index = self.cache.get()
+            block.rescan_block_devices(['/dev/vda'])
+            self.assertIs(index, self.cache.get())
+            block.rescan_block_devices()
+            self.assertIsNot(index, self.cache.get())
+        self.assertEqual(2, self.m_udev_all.call_count)
+
+    @mock.patch('curtin.block.os.path.exists')
+    @mock.patch('curtin.block.os.listdir')
+    def test_lookup_disk_and_dasd_use_index(self, m_listdir, m_exists):
+        m_exists.return_value = True
+        with self.cache.enabled():
+            self.assertEqual('/dev/vda', block.lookup_disk('disk-a'))
+            self.assertEqual('/dev/vdb', block.lookup_disk('disk-b'))
+            self.assertEqual('/dev/dasda', block.lookup_dasd('0.0.1520'))
+            with self.assertRaises(ValueError):
+                block.lookup_disk('disk-c')
+        self.assertEqual(0, m_listdir.call_count)
+        self.assertEqual(1, self.m_udev_all.call_count)
+        self.m_mpath.is_mpath_member.assert_called_with(
+            '/dev/vdb', self.devices[3])
+
+    @skipUnlessBenchmark()
+    def test_benchmark_v2_disk_lookup(self):
+        """Time resolving every disk of a v2 config, where enumerating the
+        udev properties of a device takes 20us."""
+        from curtin.commands import block_meta
+        self.devices = []
+        for disk in range(300):
+            self.devices += _udev_disk('sd%d' % disk, 'serial-%d' % disk,
+                                       partitions=3)
+
+        def enumerate_devices():
+            time.sleep(2e-5 * len(self.devices))
+            return [dict(dev) for dev in self.devices]
+        self.m_udev_all.side_effect = enumerate_devices
+        vols = [{'id': 'disk%d' % disk, 'serial': 'serial-%d' % disk}
+                for disk in range(300)]
+        times = []
+        for caching in (False, True):
+            start = time.monotonic()
+            self.cache.caching = caching
+            for vol in vols:
+                block_meta.v2_get_path_to_disk(vol)
+            times.append(time.monotonic() - start)
+        print('\nresolved %d disks: %.2fs without index, %.2fs with index' %
+              (len(vols), times[0], times[1]))
+
+
 # vi: ts=4 expandtab syntax=python
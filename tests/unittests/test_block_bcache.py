@@ -445,4 +445,41 @@ class TestBlockBcache(CiTestCase):
         m_wait.assert_called_with(stop_path, retries=bcache.BCACHE_RETRIES)
 
 
+class TestEnsureBcacheIsRegistered(CiTestCase):
+
+    def setUp(self):
+        super(TestEnsureBcacheIsRegistered, self).setUp()
+        basepath = 'curtin.block.bcache.'
+        self.add_patch(basepath + 'wait_for_device', 'm_wait')
+        self.add_patch(basepath + 'validate_bcache_ready', 'm_validate')
+        self.add_patch(basepath + 'register_bcache', 'm_register')
+        self.add_patch(basepath + 'time.sleep', 'm_sleep')
+
+    def test_registered_when_device_missing(self):
+        self.m_wait.side_effect = [OSError('Timeout exceeded'), None]
+        bcache.ensure_bcache_is_registered(
+            '/dev/vdb', '/sys/class/block/vdb/bcache', retry=[1, 2])
+        self.m_register.assert_called_once_with('/dev/vdb')
+        self.assertEqual(
+            [mock.call('/sys/class/block/vdb/bcache', timeout=1,
+                       initialized=True),
+             mock.call('/sys/class/block/vdb/bcache', timeout=2,
+                       initialized=True)],
+            self.m_wait.call_args_list)
+        self.assertEqual(0, self.m_sleep.call_count)
+
+    def test_sleeps_when_device_found_but_not_ready(self):
+        self.m_validate.side_effect = [ValueError('no holders'), None]
+        bcache.ensure_bcache_is_registered(
+            '/dev/vdb', '/sys/class/block/vdb/bcache', retry=[1, 2])
+        self.m_register.assert_called_once_with('/dev/vdb')
+        self.m_sleep.assert_called_once_with(1)
+
+    def test_retries_exhausted_raises(self):
+        self.m_wait.side_effect = OSError('Timeout exceeded')
+        with self.assertRaises(RuntimeError):
+            bcache.ensure_bcache_is_registered(
+                '/dev/vdb', '/sys/class/block/vdb/bcache', retry=[1, 2])
+        self.assertEqual(2, self.m_register.call_count)
+
 # vi: ts=4 expandtab syntax=python
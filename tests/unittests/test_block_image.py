@@ -0,0 +1,558 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import bz2
+import errno
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import os
+import shutil
+import stat
+import struct
+import subprocess
+import tarfile
+import time
+from unittest import mock, skipIf
+
+from curtin.block import image, wipe
+from curtin import util
+from .helpers import CiTestCase, skipUnlessBenchmark
+
+
+def _disk_image(size=1024 * 1024):
+    """An image of mostly zeros with data at the start, middle and end."""
+    data = bytearray(size)
+    data[0:512] = 512 * b'\1'
+    data[size // 2:size // 2 + 100] = 100 * b'\2'
+    data[size - 10:] = 10 * b'\3'
+    return bytes(data)
+
+
+def _bmap_xml(data, block_size=4096, version='2.0', checksum_file=True):
+    """A bmaptool block map of the non-zero blocks of data."""
+    ctype = 'sha256' if version.startswith('2') else 'sha1'
+    attr = 'chksum' if version.startswith('2') else 'sha1'
+    blocks = [i for i in range(0, (len(data) + block_size - 1) // block_size)
+              if any(data[i * block_size:(i + 1) * block_size])]
+    ranges = []
+    for block in blocks:
+        if ranges and ranges[-1][1] == block - 1:
+            ranges[-1][1] = block
+        else:
+            ranges.append([block, block])
+    lines = ['<?xml version="1.0" ?>', '<bmap version="%s">' % version,
+             '<ImageSize> %d </ImageSize>' % len(data),
+             '<BlockSize> %d </BlockSize>' % block_size,
+             '<BlocksCnt> %d </BlocksCnt>' % (len(data) // block_size),
+             '<MappedBlocksCnt> %d </MappedBlocksCnt>' % len(blocks)]
+    if version.startswith('2'):
+        lines.append('<ChecksumType> sha256 </ChecksumType>')
+    if checksum_file:
+        lines.append('<BmapFileChecksum> %s </BmapFileChecksum>' % (
+            '0' * len(hashlib.new(ctype).hexdigest())))
+    lines.append('<BlockMap>')
+    for (first, last) in ranges:
+        csum = hashlib.new(
+            ctype, data[first * block_size:(last + 1) * block_size])
+        text = '%d-%d' % (first, last) if last != first else '%d' % first
+        lines.append('<Range %s="%s"> %s </Range>' % (
+            attr, csum.hexdigest(), text))
+    lines.extend(['</BlockMap>', '</bmap>', ''])
+    content = '\n'.join(lines).encode()
+    if checksum_file:
+        csum = hashlib.new(ctype, content).hexdigest()
+        content = content.replace(b'0' * len(csum), csum.encode(), 1)
+    return content
+
+
+class TestWriteImage(CiTestCase):
+
+    def setUp(self):
+        super(TestWriteImage, self).setUp()
+        self.data = _disk_image()
+        self.target = self.tmp_path('disk.img')
+
+    def _source(self, itype, content, name='image'):
+        path = self.tmp_path(name)
+        util.write_file(path, content, omode='wb')
+        return {'type': itype, 'uri': 'file://' + path}
+
+    def _tar(self, data, compression=''):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:' + compression) as tar:
+            info = tarfile.TarInfo('root.img')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        return buf.getvalue()
+
+    def _assert_written(self, source):
+        stats = image.write_image(source, self.target)
+        self.assertEqual(self.data, util.load_file(self.target, decode=False))
+        self.assertEqual(len(self.data), stats['size'])
+        self.assertEqual(len(self.data),
+                         stats['written'] + stats['skipped'])
+        return stats
+
+    def test_raw(self):
+        self._assert_written(self._source('dd-raw', self.data))
+
+    def test_raw_plain_path(self):
+        source = self._source('dd-raw', self.data)
+        source['uri'] = source['uri'][len('file://'):]
+        self._assert_written(source)
+
+    def test_gz(self):
+        self._assert_written(self._source('dd-gz', gzip.compress(self.data)))
+
+    def test_bz2(self):
+        self._assert_written(self._source('dd-bz2', bz2.compress(self.data)))
+
+    def test_xz(self):
+        self._assert_written(self._source('dd-xz', lzma.compress(self.data)))
+
+    @skipIf(not shutil.which('zstd'), 'zstd not available')
+    def test_zst(self):
+        content = subprocess.check_output(['zstd', '-c'], input=self.data)
+        self._assert_written(self._source('dd-zst', content))
+
+    @skipIf(not shutil.which('zstd'), 'zstd not available')
+    def test_zst_corrupt_raises(self):
+        source = self._source('dd-zst', b'not zstd data')
+        with self.assertRaises(util.ProcessExecutionError):
+            image.write_image(source, self.target)
+
+    def test_tar(self):
+        self._assert_written(self._source('dd-tar', self._tar(self.data)))
+
+    def test_tar_detects_compression(self):
+        self._assert_written(
+            self._source('dd-tar', self._tar(self.data, 'xz')))
+
+    def test_tgz(self):
+        self._assert_written(
+            self._source('dd-tgz', gzip.compress(self._tar(self.data))))
+
+    def test_txz(self):
+        self._assert_written(
+            self._source('dd-txz', self._tar(self.data, 'xz')))
+
+    def test_tbz(self):
+        self._assert_written(
+            self._source('dd-tbz', self._tar(self.data, 'bz2')))
+
+    def test_tar_members_are_concatenated(self):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            tar.addfile(tarfile.TarInfo('dir'))
+            tar.getmember('dir').type = tarfile.DIRTYPE
+            for (name, part) in (('a', self.data[:4096]),
+                                 ('b', self.data[4096:])):
+                info = tarfile.TarInfo(name)
+                info.size = len(part)
+                tar.addfile(info, io.BytesIO(part))
+        self._assert_written(self._source('dd-tar', buf.getvalue()))
+
+    def test_unsupported_type_raises(self):
+        with self.assertRaises(ValueError):
+            image.write_image({'type': 'dd-foo', 'uri': 'file:///x'},
+                              self.target)
+
+    def test_zero_blocks_are_skipped(self):
+        stats = self._assert_written(self._source('dd-raw', self.data))
+        self.assertEqual(3 * image.ZERO_BLOCK_SIZE, stats['written'])
+        # the target is a sparse file
+        st = os.stat(self.target)
+        self.assertLess(st.st_blocks * 512, len(self.data))
+
+    def test_existing_target_is_replaced(self):
+        util.write_file(self.target, 2 * len(self.data) * b'\7', omode='wb')
+        self._assert_written(self._source('dd-raw', self.data))
+
+    def test_trailing_zeros_set_size(self):
+        self.data = self.data[:-10] + 10 * b'\0'
+        self._assert_written(self._source('dd-raw', self.data))
+
+    def test_small_blocks(self):
+        source = self._source('dd-gz', gzip.compress(self.data))
+        stats = image.write_image(source, self.target, block_size=1000)
+        self.assertEqual(self.data, util.load_file(self.target, decode=False))
+        self.assertEqual(len(self.data), stats['size'])
+
+    def test_sha256_matches(self):
+        content = gzip.compress(self.data)
+        source = self._source('dd-gz', content)
+        source['sha256'] = hashlib.sha256(content).hexdigest().upper()
+        self._assert_written(source)
+
+    def test_sha256_covers_tar_padding(self):
+        content = self._tar(self.data) + 10240 * b'\0'
+        source = self._source('dd-tar', content)
+        source['sha256'] = hashlib.sha256(content).hexdigest()
+        self._assert_written(source)
+
+    def test_sha256_mismatch_raises(self):
+        source = self._source('dd-raw', self.data)
+        source['sha256'] = hashlib.sha256(b'other').hexdigest()
+        with self.assertRaises(ValueError):
+            image.write_image(source, self.target)
+
+    def test_decompress_error_raises(self):
+        source = self._source('dd-gz', b'not gzip data')
+        with self.assertRaises(OSError):
+            image.write_image(source, self.target)
+
+    @mock.patch('curtin.block.image.url_helper.UrlReader')
+    def test_url_source(self, m_reader):
+        content = lzma.compress(self.data)
+        m_reader.return_value.size = str(len(content))
+        m_reader.return_value.read.side_effect = io.BytesIO(content).read
+        source = {'type': 'dd-xz', 'uri': 'http://myhost/disk.xz'}
+        self._assert_written(source)
+        m_reader.assert_called_with(source['uri'])
+        m_reader.return_value.close.assert_called_with()
+
+    @mock.patch('curtin.block.image._ImageTarget.write')
+    @mock.patch('curtin.block.image.url_helper.UrlReader')
+    def test_write_error_aborts_download(self, m_reader, m_write):
+        """A failed write closes the download instead of reading the rest
+        of it."""
+        size = 1024 * 1024 * 1024
+        fetched = []
+
+        def read(size):
+            if m_reader.return_value.close.called:
+                raise ValueError('read of closed file')
+            fetched.append(size)
+            return size * b'\0'
+        m_reader.return_value.size = str(size)
+        m_reader.return_value.read.side_effect = read
+        m_write.side_effect = OSError(errno.EIO, 'write failed')
+        with self.assertRaises(OSError):
+            image.write_image({'type': 'dd-raw', 'uri': 'http://myhost/x'},
+                              self.target)
+        m_reader.return_value.close.assert_called_with()
+        self.assertLess(sum(fetched), size)
+
+    @mock.patch('curtin.block.image.events.report_event')
+    def test_progress_reported(self, m_report):
+        image.write_image(self._source('dd-raw', self.data), self.target,
+                          block_size=len(self.data) // 4)
+        msgs = [c[0][0].description for c in m_report.call_args_list]
+        self.assertIn('100%', msgs[-1])
+        self.assertIn('wrote %d bytes' % (3 * image.ZERO_BLOCK_SIZE),
+                      msgs[-1])
+
+    def _bmap_source(self, itype, content, bmap):
+        source = self._source(itype, content)
+        util.write_file(source['uri'][len('file://'):] + '.bmap', bmap,
+                        omode='wb')
+        source['bmap'] = True
+        return source
+
+    def test_bmap_raw(self):
+        source = self._bmap_source('dd-raw', self.data, _bmap_xml(self.data))
+        with mock.patch('curtin.block.image._read_block',
+                        side_effect=image._read_block) as m_read:
+            stats = self._assert_written(source)
+        self.assertEqual(3 * 4096, stats['written'])
+        # only the mapped blocks are read
+        self.assertEqual(3 * 4096, sum(c[0][1] for c in m_read.call_args_list))
+
+    def test_bmap_compressed(self):
+        source = self._bmap_source('dd-xz', lzma.compress(self.data),
+                                   _bmap_xml(self.data, version='1.4'))
+        stats = self._assert_written(source)
+        self.assertEqual(3 * 4096, stats['written'])
+
+    def test_bmap_raw_with_sha256_reads_everything(self):
+        source = self._bmap_source('dd-raw', self.data, _bmap_xml(self.data))
+        source['sha256'] = hashlib.sha256(self.data).hexdigest()
+        stats = self._assert_written(source)
+        self.assertEqual(3 * 4096, stats['written'])
+
+    def test_bmap_json(self):
+        bmap = json.dumps({'image_size': len(self.data), 'block_size': 4096,
+                           'ranges': [[0, 0], {'first': 128, 'last': 128},
+                                      [255, 255]]})
+        source = self._source('dd-gz', gzip.compress(self.data))
+        path = self.tmp_path('map.json')
+        util.write_file(path, bmap)
+        source['bmap'] = 'file://' + path
+        stats = self._assert_written(source)
+        self.assertEqual(3 * 4096, stats['written'])
+
+    def test_bmap_leaves_unmapped_ranges(self):
+        util.write_file(self.target, len(self.data) * b'\7', omode='wb')
+        fd = os.open(self.target, os.O_WRONLY)
+        bmap = image.parse_bmap(_bmap_xml(self.data))
+        out = image._BmapTarget(fd, bmap, image.ImageProgress('s', 't'))
+        try:
+            out.write(0, self.data)
+            out.finish()
+        finally:
+            os.close(fd)
+        written = util.load_file(self.target, decode=False)
+        self.assertEqual(self.data[:4096], written[:4096])
+        self.assertEqual(4096 * b'\7', written[4096:8192])
+
+    def test_bmap_range_checksum_mismatch_raises(self):
+        bmap = _bmap_xml(self.data, checksum_file=False)
+        self.data = b'\4' + self.data[1:]
+        source = self._bmap_source('dd-raw', self.data, bmap)
+        with self.assertRaisesRegex(ValueError, 'bytes 0-4096'):
+            image.write_image(source, self.target)
+
+    def test_bmap_file_checksum_mismatch_raises(self):
+        bmap = _bmap_xml(self.data).replace(b'<BlockSize> 4096',
+                                            b'<BlockSize>  4096')
+        source = self._bmap_source('dd-raw', self.data, bmap)
+        with self.assertRaisesRegex(ValueError, 'block map checksum'):
+            image.write_image(source, self.target)
+
+    def test_bmap_short_image_raises(self):
+        source = self._bmap_source('dd-gz', gzip.compress(self.data[:8192]),
+                                   _bmap_xml(self.data))
+        with self.assertRaises(ValueError):
+            image.write_image(source, self.target)
+
+    def test_bmap_missing_writes_everything(self):
+        source = self._source('dd-raw', self.data)
+        source['bmap'] = True
+        stats = self._assert_written(source)
+        self.assertEqual(3 * image.ZERO_BLOCK_SIZE, stats['written'])
+
+    def test_bmap_missing_explicit_raises(self):
+        source = self._source('dd-raw', self.data)
+        source['bmap'] = self.tmp_path('missing.bmap')
+        with self.assertRaises(IOError):
+            image.write_image(source, self.target)
+
+
+class TestImageProgress(CiTestCase):
+
+    @mock.patch('curtin.block.image.events.report_event')
+    def test_reports_every_step(self, m_report):
+        progress = image.ImageProgress('src', '/dev/sda', 1000, step=25)
+        for fetched in range(100, 1100, 100):
+            progress.fetched = fetched
+            progress.update()
+        msgs = [c[0][0].description for c in m_report.call_args_list]
+        self.assertEqual(4, len(msgs))
+        for (msg, percent) in zip(msgs, (30, 50, 80, 100)):
+            self.assertIn(': %d%%' % percent, msg)
+        self.assertEqual('write-image-sda', m_report.call_args[0][0].name)
+
+    @mock.patch('curtin.block.image.events.report_event')
+    def test_unknown_size_reports_every_gib(self, m_report):
+        progress = image.ImageProgress('src', '/dev/sda')
+        progress.written = 1024 ** 3 - 1
+        progress.update()
+        self.assertEqual(0, m_report.call_count)
+        progress.skipped = 1
+        progress.update()
+        self.assertEqual(1, m_report.call_count)
+
+
+class TestBlockMap(CiTestCase):
+
+    def test_parse_xml(self):
+        data = _disk_image()
+        bmap = image.parse_bmap(_bmap_xml(data))
+        self.assertEqual(len(data), bmap.image_size)
+        self.assertEqual('sha256', bmap.checksum_type)
+        self.assertEqual([(0, 4096), (128 * 4096, 129 * 4096),
+                          (255 * 4096, 256 * 4096)],
+                         [r[:2] for r in bmap.ranges])
+        self.assertEqual(3 * 4096, bmap.mapped_size)
+        self.assertEqual([(4096, 128 * 4096), (129 * 4096, 255 * 4096)],
+                         bmap.unmapped())
+
+    def test_parse_xml_v1_uses_sha1(self):
+        bmap = image.parse_bmap(_bmap_xml(_disk_image(), version='1.4'))
+        self.assertEqual('sha1', bmap.checksum_type)
+        self.assertEqual(40, len(bmap.ranges[0][2]))
+
+    def test_last_range_is_clipped_to_image_size(self):
+        bmap = image.BlockMap(5000, 4096, [(0, 1, None)])
+        self.assertEqual([(0, 5000, None)], bmap.ranges)
+        self.assertEqual([], bmap.unmapped())
+
+    def test_overlapping_ranges_raise(self):
+        with self.assertRaises(ValueError):
+            image.BlockMap(8192 * 4, 4096, [(0, 2, None), (2, 3, None)])
+
+    def test_range_beyond_image_raises(self):
+        with self.assertRaises(ValueError):
+            image.BlockMap(4096, 4096, [(3, 4, None)])
+
+    def test_no_bmap(self):
+        self.assertIsNone(image.load_bmap({'uri': '/x.img'}))
+
+    @mock.patch('curtin.block.image.url_helper.geturl')
+    def test_load_bmap_url(self, m_geturl):
+        m_geturl.return_value = b'{"image_size": 4096, "ranges": [[0, 0]]}'
+        bmap = image.load_bmap({'uri': 'http://host/x.img', 'bmap': True})
+        m_geturl.assert_called_with('http://host/x.img.bmap')
+        self.assertEqual([(0, 4096, None)], bmap.ranges)
+
+
+class TestImageTarget(CiTestCase):
+
+    def setUp(self):
+        super(TestImageTarget, self).setUp()
+        self.progress = image.ImageProgress('src', 'target', 0)
+
+    @mock.patch('curtin.block.image.os.pwrite')
+    @mock.patch('curtin.block.image.fcntl.ioctl')
+    def test_zeroout_coalesces_runs(self, m_ioctl, m_pwrite):
+        m_pwrite.side_effect = lambda fd, view, offset: len(view)
+        zb = image.ZERO_BLOCK_SIZE
+        out = image._ImageTarget(3, 'zeroout', self.progress)
+        out.write(0, b'\1' * zb + bytes(2 * zb))
+        out.write(3 * zb, bytes(zb) + b'\1' * zb)
+        out.finish()
+        m_ioctl.assert_called_once_with(
+            3, wipe.BLKZEROOUT, struct.pack('QQ', zb, 3 * zb))
+        self.assertEqual([mock.call(3, mock.ANY, 0),
+                          mock.call(3, mock.ANY, 4 * zb)],
+                         m_pwrite.call_args_list)
+        self.assertEqual(3 * zb, self.progress.skipped)
+
+    @mock.patch('curtin.block.image.os.pwrite')
+    @mock.patch('curtin.block.image.fcntl.ioctl')
+    def test_zeroout_unsupported_writes_zeros(self, m_ioctl, m_pwrite):
+        m_ioctl.side_effect = OSError(errno.ENOTTY, 'not a block device')
+        written = []
+
+        def pwrite(fd, view, offset):
+            written.append((offset, bytes(view)))
+            return len(view)
+
+        m_pwrite.side_effect = pwrite
+        zb = image.ZERO_BLOCK_SIZE
+        out = image._ImageTarget(3, 'zeroout', self.progress)
+        out.write(0, bytes(2 * zb) + b'\1' * zb)
+        out.write(3 * zb, bytes(zb))
+        out.finish()
+        self.assertEqual('write', out.zero_mode)
+        self.assertEqual(
+            [(0, bytes(zb)), (zb, bytes(zb)), (2 * zb, b'\1' * zb)],
+            written[:3])
+        # once unsupported, zeros are written as data
+        self.assertEqual((3 * zb, bytes(zb)), written[3])
+        self.assertEqual(4 * zb, self.progress.written)
+        self.assertEqual(0, self.progress.skipped)
+        self.assertEqual(1, m_ioctl.call_count)
+
+    @mock.patch('curtin.block.image.os.pwrite')
+    def test_gap_before_write_is_zeros(self, m_pwrite):
+        m_pwrite.side_effect = lambda fd, view, offset: len(view)
+        out = image._ImageTarget(3, 'seek', self.progress)
+        out.write(0, b'\1' * 10)
+        out.write(100, b'\1' * 10)
+        out.finish()
+        self.assertEqual([mock.call(3, mock.ANY, 0),
+                          mock.call(3, mock.ANY, 100)],
+                         m_pwrite.call_args_list)
+        self.assertEqual(90, self.progress.skipped)
+        self.assertEqual(110, out.pos)
+
+    @mock.patch('curtin.block.image.fcntl.ioctl')
+    @mock.patch('curtin.block.image.os.fstat')
+    def test_bmap_discards_unmapped(self, m_fstat, m_ioctl):
+        m_fstat.return_value.st_mode = stat.S_IFBLK
+        bmap = image.BlockMap(4 * 4096, 4096, [(1, 1, None)])
+        with mock.patch('curtin.block.image.os.pwrite') as m_pwrite:
+            m_pwrite.side_effect = lambda fd, view, offset: len(view)
+            out = image._BmapTarget(3, bmap, self.progress, discard=True)
+            out.write(0, bytes(4 * 4096))
+            out.finish()
+        self.assertEqual(
+            [mock.call(3, image.BLKDISCARD, struct.pack('QQ', 0, 4096)),
+             mock.call(3, image.BLKDISCARD,
+                       struct.pack('QQ', 8192, 8192))],
+            m_ioctl.call_args_list)
+        self.assertEqual(3 * 4096, self.progress.skipped)
+
+    @mock.patch('curtin.block.image.os.pwrite')
+    def test_write_mode_writes_everything(self, m_pwrite):
+        m_pwrite.side_effect = lambda fd, view, offset: len(view)
+        out = image._ImageTarget(3, 'write', self.progress)
+        out.write(0, bytes(3 * image.ZERO_BLOCK_SIZE))
+        out.finish()
+        m_pwrite.assert_called_once_with(3, mock.ANY, 0)
+        self.assertEqual(3 * image.ZERO_BLOCK_SIZE, self.progress.written)
+
+    @mock.patch('curtin.block.image.os.pwrite')
+    def test_short_writes_are_retried(self, m_pwrite):
+        m_pwrite.side_effect = lambda fd, view, offset: min(len(view), 100)
+        out = image._ImageTarget(3, 'seek', self.progress)
+        out.write(0, b'\1' * 250)
+        self.assertEqual([0, 100, 200],
+                         [c[0][2] for c in m_pwrite.call_args_list])
+        self.assertEqual(250, self.progress.written)
+
+    def test_write_zeroes_offloaded(self):
+        with mock.patch('curtin.block.image.util.load_file') as m_load:
+            m_load.return_value = '33550336\n'
+            self.assertTrue(image._write_zeroes_offloaded('/dev/sda'))
+            m_load.return_value = '0\n'
+            self.assertFalse(image._write_zeroes_offloaded('/dev/sda'))
+            m_load.side_effect = IOError(errno.ENOENT, 'no such file')
+            self.assertFalse(image._write_zeroes_offloaded('/dev/sda'))
+
+    @skipUnlessBenchmark()
+    def test_benchmark_write_image(self):
+        """Compare the shell pipeline with the in process writer on a
+        gzipped 512MiB image that is mostly zeros."""
+        size = 512 * 1024 * 1024
+        data = bytearray(size)
+        for pos in range(0, size, 32 * 1024 * 1024):
+            data[pos:pos + 4 * 1024 * 1024] = os.urandom(4 * 1024 * 1024)
+        src = self.tmp_path('disk.img.gz')
+        with gzip.open(src, 'wb', compresslevel=1) as fp:
+            fp.write(data)
+        del data
+        target = self.tmp_path('disk.img')
+
+        start = time.monotonic()
+        subprocess.check_call(
+            ['sh', '-c', 'cat "$1" | zcat | dd bs=4M of="$2" 2>/dev/null',
+             '--', src, target])
+        shell = time.monotonic() - start
+        os.unlink(target)
+
+        start = time.monotonic()
+        stats = image.write_image({'type': 'dd-gz', 'uri': src}, target)
+        native = time.monotonic() - start
+        print('\nwrite %d MiB image: shell pipeline %.2fs, in process '
+              '%.2fs, skipped %d MiB of zeros' % (
+                  size >> 20, shell, native, stats['skipped'] >> 20))
+
+    @skipUnlessBenchmark()
+    def test_benchmark_bmap(self):
+        """Compare writing a raw 512MiB image that is 7/8 zeros with and
+        without its block map."""
+        size = 512 * 1024 * 1024
+        data = bytearray(size)
+        for pos in range(0, size, 32 * 1024 * 1024):
+            data[pos:pos + 4 * 1024 * 1024] = os.urandom(4 * 1024 * 1024)
+        src = self.tmp_path('disk.img')
+        util.write_file(src, data, omode='wb')
+        util.write_file(src + '.bmap', _bmap_xml(data, block_size=1 << 20),
+                        omode='wb')
+        del data
+
+        times = []
+        for bmap in (False, True):
+            target = self.tmp_path('out-%s.img' % bmap)
+            start = time.monotonic()
+            image.write_image({'type': 'dd-raw', 'uri': src, 'bmap': bmap},
+                              target)
+            times.append(time.monotonic() - start)
+        print('\nwrite %d MiB raw image: full %.2fs, with bmap %.2fs' % (
+            size >> 20, times[0], times[1]))
+
+# vi: ts=4 expandtab syntax=python
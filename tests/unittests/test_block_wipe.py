@@ -0,0 +1,142 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import errno
+import os
+import struct
+from unittest import mock
+
+from curtin.block import wipe
+from curtin import util
+from .helpers import CiTestCase
+
+
+class TestWriteBuffer(CiTestCase):
+
+    def setUp(self):
+        super(TestWriteBuffer, self).setUp()
+        self.path = self.tmp_path('wipeme')
+        util.write_file(self.path, 5000 * b'\1', omode='wb')
+
+    def _write(self, *args, **kwargs):
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            return wipe.write_buffer(fd, 5000, *args, **kwargs)
+        finally:
+            os.close(fd)
+
+    def test_zero_fill(self):
+        self.assertEqual(5000, self._write(buflen=4096))
+        self.assertEqual(5000 * b'\0', util.load_file(self.path, decode=False))
+
+    def test_zero_fill_from_offset(self):
+        self._write(offset=1000, buflen=4096)
+        self.assertEqual(1000 * b'\1' + 4000 * b'\0',
+                         util.load_file(self.path, decode=False))
+
+    def test_reader_fills_buffer_in_place(self):
+        calls = []
+
+        def reader(view):
+            calls.append(len(view))
+            view[:] = len(view) * b'\2'
+            return len(view)
+
+        self._write(reader=reader, buflen=4096)
+        self.assertEqual([4096, 904], calls)
+        self.assertEqual(5000 * b'\2', util.load_file(self.path, decode=False))
+
+    def test_reader_short_reads_are_retried(self):
+        def reader(view):
+            view[:1] = b'\3'
+            return 1
+
+        self._write(reader=reader, buflen=4096)
+        self.assertEqual(5000 * b'\3', util.load_file(self.path, decode=False))
+
+    def test_reader_eof_raises(self):
+        with self.assertRaises(ValueError):
+            self._write(reader=lambda view: 0, buflen=4096)
+
+    def test_progress_updated(self):
+        progress = mock.Mock()
+        self._write(buflen=4096, progress=progress)
+        self.assertEqual([mock.call(4096), mock.call(5000)],
+                         progress.update.call_args_list)
+
+
+class TestZeroout(CiTestCase):
+
+    @mock.patch('curtin.block.wipe.fcntl.ioctl')
+    def test_zeroout_in_chunks(self, m_ioctl):
+        self.assertEqual(2500, wipe.zeroout(3, 2500, chunk=1000))
+        self.assertEqual(
+            [mock.call(3, wipe.BLKZEROOUT, struct.pack('QQ', 0, 1000)),
+             mock.call(3, wipe.BLKZEROOUT, struct.pack('QQ', 1000, 1000)),
+             mock.call(3, wipe.BLKZEROOUT, struct.pack('QQ', 2000, 500))],
+            m_ioctl.call_args_list)
+
+    @mock.patch('curtin.block.wipe.fcntl.ioctl')
+    def test_zeroout_unsupported(self, m_ioctl):
+        m_ioctl.side_effect = OSError(errno.EOPNOTSUPP, 'not supported')
+        self.assertEqual(0, wipe.zeroout(3, 2500))
+
+    @mock.patch('curtin.block.wipe.fcntl.ioctl')
+    def test_zeroout_error_after_start_raises(self, m_ioctl):
+        m_ioctl.side_effect = [None, OSError(errno.EINVAL, 'invalid')]
+        with self.assertRaises(OSError):
+            wipe.zeroout(3, 2500, chunk=1000)
+
+    @mock.patch('curtin.block.wipe.fcntl.ioctl')
+    def test_zeroout_io_error_raises(self, m_ioctl):
+        m_ioctl.side_effect = OSError(errno.EIO, 'io error')
+        with self.assertRaises(OSError):
+            wipe.zeroout(3, 2500)
+
+
+class TestWipeFd(CiTestCase):
+
+    def setUp(self):
+        super(TestWipeFd, self).setUp()
+        self.path = self.tmp_path('wipeme')
+        util.write_file(self.path, 5000 * b'\1', omode='wb')
+        self.add_patch('curtin.block.wipe.events.report_event', 'm_report')
+
+    def _wipe(self, mode):
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            wipe.wipe_fd(fd, self.path, mode=mode, buflen=4096)
+        finally:
+            os.close(fd)
+
+    def test_wipe_zero_file(self):
+        self._wipe('zero')
+        self.assertEqual(5000 * b'\0', util.load_file(self.path, decode=False))
+
+    def test_wipe_random_file(self):
+        self._wipe('random')
+        found = util.load_file(self.path, decode=False)
+        self.assertEqual(5000, len(found))
+        self.assertNotEqual(5000 * b'\1', found)
+        self.assertNotEqual(5000 * b'\0', found)
+
+    def test_wipe_reports_progress(self):
+        self._wipe('zero')
+        events = [c[0][0] for c in self.m_report.call_args_list]
+        self.assertEqual(['progress'], list(set(e.event_type for e in events)))
+        self.assertIn('100%', events[-1].description)
+
+    def test_wipe_bad_mode(self):
+        with self.assertRaises(ValueError):
+            self._wipe('superblock')
+
+
+class TestWipeProgress(CiTestCase):
+
+    @mock.patch('curtin.block.wipe.events.report_event')
+    def test_reports_every_step(self, m_report):
+        progress = wipe.WipeProgress('/dev/sda', 1000, 'zero', step=25)
+        for done in range(0, 1001, 50):
+            progress.update(done)
+        self.assertEqual(4, m_report.call_count)
+
+# vi: ts=4 expandtab syntax=python
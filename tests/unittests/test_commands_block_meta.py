@@ -11,6 +11,8 @@ from unittest.mock import (
 )
 import os
 import random
+import threading
+import time
 import uuid
 
 from curtin.block import dasd
@@ -68,7 +70,8 @@ class TestGetPathToStorageVolume(CiTestCase):
         self.add_patch(
             basepath + 'multipath.get_mpath_id_from_device', 'm_get_mpath_id')
         self.add_patch(
-            basepath + 'udev_all_block_device_properties', 'm_udev_all')
+            'curtin.block.udev.udev_all_block_device_properties',
+            'm_udev_all')
 
     def test_block_lookup_called_with_disk_wwn(self):
         volume = 'mydisk'
@@ -131,6 +134,17 @@ class TestGetPathToStorageVolume(CiTestCase):
         self.assertEqual(0, self.m_lookup.call_count)
         self.assertEqual(path, result)
 
+    def test_partition_waits_for_disk_and_partition(self):
+        path = '/dev/mapper/mpatha'
+        s_cfg = OrderedDict([
+            ('mydisk', {'id': 'mydisk', 'type': 'disk', 'path': path}),
+            ('mypart', {'id': 'mypart', 'type': 'partition', 'number': 1,
+                        'device': 'mydisk'})])
+        result = block_meta.get_path_to_storage_volume('mypart', s_cfg)
+        self.assertEqual(path + '-part1', result)
+        self.assertEqual([call(path), call(path, path + '-part1')],
+                         self.m_devsync.call_args_list)
+
     def test_exception_raise_if_disk_not_found(self):
         volume = 'mydisk'
         wwn = self.random_string()
@@ -426,6 +440,7 @@ class TestBlockMetaSimple(CiTestCase):
                        'mock_block_is_valid_device')
         self.add_patch('curtin.block.lvm.activate_volgroups',
                        'mock_activate_volgroups')
+        self.add_patch('curtin.block.image.write_image', 'mock_write_image')
         # config
         self.add_patch('curtin.config.load_command_config',
                        'mock_config_load')
@@ -445,14 +460,9 @@ class TestBlockMetaSimple(CiTestCase):
 
         block_meta.write_image_to_disk(source, devname)
 
-        write = [
-            'sh', '-c',
-            'wget "$1" --progress=dot:mega -O - | xzcat | dd bs=4M of="$2"',
-            '--', source['uri'], devnode,
-            ]
+        self.mock_write_image.assert_called_with(source, devnode)
         self.mock_block_get_dev_name_entry.assert_called_with(devname)
-        self.mock_subp.assert_has_calls([call(args=write),
-                                         call(['partprobe', devnode]),
+        self.mock_subp.assert_has_calls([call(['partprobe', devnode]),
                                          call(['udevadm', 'trigger', devnode]),
                                          call(['udevadm', 'settle']),
                                          call(['udevadm', 'settle'])])
@@ -471,15 +481,9 @@ class TestBlockMetaSimple(CiTestCase):
 
         block_meta.write_image_to_disk(source, devname)
 
-        write = [
-            'sh', '-c',
-            'wget "$1" --progress=dot:mega -O - | '
-            'tar -xOzf - | dd bs=4M of="$2"',
-            '--', source['uri'], devnode,
-            ]
+        self.mock_write_image.assert_called_with(source, devnode)
         self.mock_block_get_dev_name_entry.assert_called_with(devname)
-        self.mock_subp.assert_has_calls([call(args=write),
-                                         call(['partprobe', devnode]),
+        self.mock_subp.assert_has_calls([call(['partprobe', devnode]),
                                          call(['udevadm', 'trigger', devnode]),
                                          call(['udevadm', 'settle']),
                                          call(['udevadm', 'settle'])])
@@ -498,14 +502,9 @@ class TestBlockMetaSimple(CiTestCase):
 
         block_meta.write_image_to_disk(source, devname)
 
-        write = [
-            'sh', '-c',
-            'cat "$1" | dd bs=4M of="$2"',
-            '--', '/pc.img', devnode,
-            ]
+        self.mock_write_image.assert_called_with(source, devnode)
         self.mock_block_get_dev_name_entry.assert_called_with(devname)
-        self.mock_subp.assert_has_calls([call(args=write),
-                                         call(['partprobe', devnode]),
+        self.mock_subp.assert_has_calls([call(['partprobe', devnode]),
                                          call(['udevadm', 'trigger', devnode]),
                                          call(['udevadm', 'settle']),
                                          call(['udevadm', 'settle'])])
@@ -1804,6 +1803,252 @@ class TestDiskHandler(CiTestCase):
         m_subp.assert_called_once_with(['fdasd', '-c', '/dev/null', path])
 
 
+class TestMetaPrewipe(CiTestCase):
+
+    def setUp(self):
+        super(TestMetaPrewipe, self).setUp()
+        self.add_patch('curtin.commands.block_meta.block.wipe_volume',
+                       'm_wipe')
+        self.add_patch('curtin.commands.block_meta.util.FlockEx',
+                       'm_flock')
+        self.add_patch(
+            'curtin.commands.block_meta.get_path_to_storage_volume',
+            'm_getpath')
+        self.tmpd = self.tmp_dir()
+        self.m_getpath.side_effect = self._getpath
+        self.storage_config = OrderedDict()
+
+    def _getpath(self, volume, storage_config):
+        return os.path.join(self.tmpd, volume)
+
+    def _add(self, create=True, **item):
+        self.storage_config[item['id']] = item
+        if create:
+            util.write_file(os.path.join(self.tmpd, item['id']), '')
+        return item
+
+    def test_plan_groups_by_disk(self):
+        self._add(id='sda', type='disk', wipe='zero', ptable='gpt')
+        self._add(id='sdb', type='disk', wipe='random', ptable='gpt')
+        self._add(id='sdc', type='disk', wipe='zero', ptable='gpt')
+        plan = block_meta.get_prewipe_plan(self.storage_config)
+        self.assertEqual(
+            [os.path.join(self.tmpd, d) for d in ('sda', 'sdb', 'sdc')],
+            list(plan.keys()))
+        self.assertEqual(
+            ['sdb'],
+            [item['id'] for item, _path in plan[os.path.join(self.tmpd,
+                                                             'sdb')]])
+
+    def test_plan_skips_preserved_partitions(self):
+        # preserved partitions are verified by their handler before wiping
+        self._add(id='sdb', type='disk', wipe='random', preserve=True)
+        self._add(id='sdb1', type='partition', device='sdb', number=1,
+                  wipe='zero', preserve=True)
+        self.assertEqual(
+            OrderedDict(), block_meta.get_prewipe_plan(self.storage_config))
+
+    def test_plan_skips_dependent_devices(self):
+        self._add(id='sda', type='disk', wipe='superblock', ptable='gpt')
+        self._add(id='sda1', type='partition', device='sda', number=1,
+                  wipe='zero')
+        self._add(id='sdb', type='disk', wipe='zero', preserve=True)
+        self._add(id='dasda', type='disk', wipe='zero', ptable='vtoc')
+        self._add(id='nvme0', type='disk', wipe='zero',
+                  nvme_controller='nvme-ctrl0')
+        self._add(id='missing', type='disk', wipe='zero', create=False)
+        self._add(id='md0', type='raid', wipe='zero')
+        self.assertEqual(
+            OrderedDict(), block_meta.get_prewipe_plan(self.storage_config))
+
+    def test_prewipe_wipes_and_marks_context(self):
+        self._add(id='sda', type='disk', wipe='zero', ptable='gpt')
+        self._add(id='sdb', type='disk', wipe='random', ptable='gpt')
+        context = block_meta.BlockMetaContext({})
+        block_meta.meta_prewipe(self.storage_config, context, workers=2)
+        self.assertEqual({'sda', 'sdb'}, context.prewiped)
+        self.assertEqual(
+            sorted([call(os.path.join(self.tmpd, 'sda'), mode='zero'),
+                    call(os.path.join(self.tmpd, 'sdb'), mode='random')]),
+            sorted(self.m_wipe.call_args_list))
+        self.assertEqual(
+            sorted([call(os.path.join(self.tmpd, 'sda')),
+                    call(os.path.join(self.tmpd, 'sdb'))]),
+            sorted(self.m_flock.call_args_list))
+
+    def test_prewipe_disabled_by_default(self):
+        self._add(id='sda', type='disk', wipe='zero', ptable='gpt')
+        context = block_meta.BlockMetaContext({})
+        block_meta.meta_prewipe(self.storage_config, context)
+        self.assertEqual(set(), context.prewiped)
+        self.assertEqual(0, self.m_wipe.call_count)
+
+    def test_prewipe_error_raised_after_other_disks(self):
+        self._add(id='sda', type='disk', wipe='zero', ptable='gpt')
+        self._add(id='sdb', type='disk', wipe='zero', ptable='gpt')
+        sda = os.path.join(self.tmpd, 'sda')
+
+        def wipe(path, mode, exclusive=True):
+            if path == sda:
+                raise OSError('wipe failed')
+
+        self.m_wipe.side_effect = wipe
+        context = block_meta.BlockMetaContext({})
+        with self.assertRaises(OSError):
+            block_meta.meta_prewipe(self.storage_config, context, workers=2)
+        self.assertEqual(2, self.m_wipe.call_count)
+        self.assertEqual(set(), context.prewiped)
+
+    @patch('curtin.commands.block_meta.clear_holders.get_holders')
+    def test_disk_handler_skips_prewiped_disk(self, m_get_holders):
+        info = self._add(id='sda', type='disk', wipe='zero', ptable='msdos')
+        m_get_holders.return_value = []
+        context = block_meta.BlockMetaContext({})
+        context.prewiped.add('sda')
+        with patch('curtin.commands.block_meta.util.subp'):
+            block_meta.disk_handler(info, self.storage_config, context)
+        self.assertEqual(0, self.m_wipe.call_count)
+
+
+class TestMetaCustomParallel(CiTestCase):
+
+    def setUp(self):
+        super(TestMetaCustomParallel, self).setUp()
+        self.storage_config = OrderedDict()
+        for item in [
+                {'id': 'sda', 'type': 'disk', 'ptable': 'gpt'},
+                {'id': 'sdb', 'type': 'disk', 'ptable': 'gpt'},
+                {'id': 'sda1', 'type': 'partition', 'device': 'sda'},
+                {'id': 'sda2', 'type': 'partition', 'device': 'sda'},
+                {'id': 'sdb1', 'type': 'partition', 'device': 'sdb'},
+                {'id': 'md0', 'type': 'raid', 'devices': ['sda2', 'sdb1']},
+                {'id': 'sda1-fmt', 'type': 'format', 'volume': 'sda1'},
+                {'id': 'md0-fmt', 'type': 'format', 'volume': 'md0'},
+                {'id': 'md0-mnt', 'type': 'mount', 'device': 'md0-fmt'},
+                {'id': 'sda1-mnt', 'type': 'mount', 'device': 'sda1-fmt'}]:
+            self.storage_config[item['id']] = item
+        self.handled = []
+        self.lock = threading.Lock()
+
+    def _context(self, handler=None):
+        def record(info, storage_config, context):
+            with self.lock:
+                self.handled.append(info['id'])
+            if handler:
+                handler(info)
+
+        return block_meta.BlockMetaContext(
+            {stype: record for stype in ('disk', 'partition', 'raid',
+                                         'format', 'mount')})
+
+    def test_action_graph(self):
+        graph = block_meta.get_action_graph(self.storage_config)
+        self.assertEqual(list(self.storage_config), list(graph))
+        self.assertEqual(set(), graph['sda'])
+        self.assertEqual({'sda'}, graph['sda1'])
+        self.assertEqual({'sda', 'sda1'}, graph['sda2'])
+        self.assertEqual({'sda2', 'sdb1'}, graph['md0'])
+        self.assertEqual({'md0-fmt'}, graph['md0-mnt'])
+        self.assertEqual({'sda1-fmt', 'md0-mnt'}, graph['sda1-mnt'])
+
+    def test_action_graph_disks_wait_for_dasd(self):
+        sconfig = OrderedDict([
+            ('dasd0', {'id': 'dasd0', 'type': 'dasd'}),
+            ('dasda', {'id': 'dasda', 'type': 'disk', 'ptable': 'vtoc'})])
+        self.assertEqual({'dasd0'},
+                         block_meta.get_action_graph(sconfig)['dasda'])
+
+    def test_action_graph_orders_zfs_root_with_mounts(self):
+        sconfig = OrderedDict()
+        for item in [
+                {'id': 'sda', 'type': 'disk', 'ptable': 'gpt'},
+                {'id': 'sdb', 'type': 'disk', 'ptable': 'gpt'},
+                {'id': 'sda1', 'type': 'partition', 'device': 'sda'},
+                {'id': 'sdb1', 'type': 'partition', 'device': 'sdb'},
+                {'id': 'sda1-fmt', 'type': 'format', 'volume': 'sda1'},
+                {'id': 'rpool', 'type': 'zpool', 'pool': 'rpool',
+                 'vdevs': ['sdb1'], 'mountpoint': '/'},
+                {'id': 'rpool-root', 'type': 'zfs', 'pool': 'rpool',
+                 'volume': '/ROOT', 'properties': {'mountpoint': '/'}},
+                {'id': 'sda1-mnt', 'type': 'mount', 'path': '/boot',
+                 'device': 'sda1-fmt'}]:
+            sconfig[item['id']] = item
+        graph = block_meta.get_action_graph(sconfig)
+        self.assertIn('rpool', graph['rpool-root'])
+        self.assertEqual({'sda1-fmt', 'rpool-root'}, graph['sda1-mnt'])
+
+        handled = []
+        context = block_meta.BlockMetaContext(
+            {stype: lambda info, sconfig, context: handled.append(info['id'])
+             for stype in ('disk', 'partition', 'format', 'zpool', 'zfs',
+                           'mount')})
+        block_meta.meta_custom_parallel(sconfig, context, workers=4)
+        self.assertLess(handled.index('rpool-root'),
+                        handled.index('sda1-mnt'))
+
+    def test_action_disks(self):
+        disks = block_meta.get_action_disks(self.storage_config)
+        self.assertEqual({'sda'}, disks['sda1-fmt'])
+        self.assertEqual({'sda', 'sdb'}, disks['md0-mnt'])
+
+    def test_handles_all_items_in_dependency_order(self):
+        block_meta.meta_custom_parallel(self.storage_config, self._context(),
+                                        workers=4)
+        self.assertEqual(sorted(self.storage_config), sorted(self.handled))
+        graph = block_meta.get_action_graph(self.storage_config)
+        for item_id, deps in graph.items():
+            for dep in deps:
+                self.assertLess(self.handled.index(dep),
+                                self.handled.index(item_id))
+
+    def test_independent_disks_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=10)
+
+        def handler(info):
+            if info['type'] == 'disk':
+                barrier.wait()
+
+        block_meta.meta_custom_parallel(
+            self.storage_config, self._context(handler), workers=2)
+        self.assertEqual(['sda', 'sdb'], sorted(self.handled[:2]))
+
+    def test_items_on_one_disk_do_not_overlap(self):
+        active = set()
+        overlaps = []
+
+        def handler(info):
+            disks = block_meta.get_action_disks(self.storage_config)
+            with self.lock:
+                if active & disks[info['id']]:
+                    overlaps.append(info['id'])
+                active.update(disks[info['id']])
+            time.sleep(0.01)
+            with self.lock:
+                active.difference_update(disks[info['id']])
+
+        block_meta.meta_custom_parallel(
+            self.storage_config, self._context(handler), workers=4)
+        self.assertEqual([], overlaps)
+
+    def test_error_stops_dependents(self):
+        def handler(info):
+            if info['id'] == 'sda1':
+                raise RuntimeError('sda1 failed')
+
+        with self.assertRaisesRegex(RuntimeError, 'sda1 failed'):
+            block_meta.meta_custom_parallel(
+                self.storage_config, self._context(handler), workers=1)
+        self.assertNotIn('sda1-fmt', self.handled)
+        self.assertNotIn('sda2', self.handled)
+
+    def test_unknown_type_raises_before_handling(self):
+        self.storage_config['foo'] = {'id': 'foo', 'type': 'foo'}
+        with self.assertRaises(ValueError):
+            block_meta.meta_custom_parallel(
+                self.storage_config, self._context(), workers=2)
+        self.assertEqual([], self.handled)
+
+
 class TestLvmVolgroupHandler(CiTestCase):
 
     def setUp(self):
@@ -4109,4 +4354,47 @@ class TestGetDevicePathsFromStorageConfig(CiTestCase):
             self.m_exists.call_args_list)
 
 
+class TestDevsync(CiTestCase):
+
+    def setUp(self):
+        super(TestDevsync, self).setUp()
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(basepath + 'util.subp', 'm_subp')
+        self.add_patch(basepath + 'udevadm_settle', 'm_settle')
+        self.add_patch(basepath + 'wait_for_device', 'm_wait')
+
+    def test_settles_after_rereading_table(self):
+        """the old partition nodes pass a per device check."""
+        block_meta.devsync('/dev/sda')
+        self.assertEqual(
+            [call(['partprobe', '/dev/sda'], rcs=[0, 1])],
+            self.m_subp.call_args_list)
+        self.m_settle.assert_called_once_with()
+        self.m_wait.assert_called_with(
+            '/dev/sda', timeout=block_meta.DEVSYNC_TIMEOUT)
+
+    def test_waits_for_partition(self):
+        block_meta.devsync('/dev/sda', '/dev/sda1')
+        self.assertEqual(
+            [call(['partprobe', '/dev/sda'], rcs=[0, 1])],
+            self.m_subp.call_args_list)
+        self.assertEqual(
+            [call(path, timeout=block_meta.DEVSYNC_TIMEOUT)
+             for path in ('/dev/sda', '/dev/sda1')],
+            self.m_wait.call_args_list)
+
+    def test_missing_partition_raises_oserror(self):
+        self.m_wait.side_effect = [None, OSError('Timeout exceeded')]
+        with self.assertRaises(OSError) as context_manager:
+            block_meta.devsync('/dev/sda', '/dev/sda1')
+        self.assertIn('/dev/sda1', str(context_manager.exception))
+
+    def test_missing_device_raises_oserror(self):
+        self.m_wait.side_effect = OSError('Timeout exceeded')
+        with self.assertRaises(OSError) as context_manager:
+            block_meta.devsync('/dev/sda')
+        self.assertIn('Failed to find device at path',
+                      str(context_manager.exception))
+
+
 # vi: ts=4 expandtab syntax=python
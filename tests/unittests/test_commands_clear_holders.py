@@ -19,6 +19,13 @@ class TestClearHolders(CiTestCase):
         clear_holders.POPULATE_SUBCMD(parser)
         args = parser.parse_args(argv)
         self.assertEqual(list, type(args.devices))
+        self.assertEqual(1, args.workers)
+
+    def test_argument_parsing_workers(self):
+        parser = argparse.ArgumentParser()
+        clear_holders.POPULATE_SUBCMD(parser)
+        args = parser.parse_args(['--workers', '4', '/dev/vda'])
+        self.assertEqual(4, args.workers)
 
 
 # vi: ts=4 expandtab syntax=python
@@ -314,6 +314,23 @@ class TestCreateTar(CiTestCase):
         self.assertNotIn(
             mock.call(absent_log, self.tardir), self.m_copy.call_args_list)
 
+    def test_create_log_tarfile_copies_subp_profile(self):
+        """create_log_tarfile copies the subp profile when enabled."""
+        self.add_patch('curtin.util.subp', 'mock_subp')
+        tarfile = self.tmp_path('my.tar', _dir=self.new_root)
+        log1 = self.tmp_path('some.log', _dir=self.new_root)
+        write_file(log1, 'log content')
+        summary = self.tmp_path('subp-profile.txt', _dir=self.new_root)
+        write_file(summary, 'summary')
+        config = {'install': {'log_file': log1, 'subp_profile': True}}
+        self.add_patch('shutil.copy', 'm_copy')
+        with mock.patch('sys.stderr'):
+            with mock.patch('curtin.commands.collect_logs.datetime') as m_dt:
+                m_dt.utcnow.return_value = self.utcnow
+                collect_logs.create_log_tarfile(tarfile, config=config)
+        self.assertIn(
+            mock.call(summary, self.tardir), self.m_copy.call_args_list)
+
     def test_create_log_tarfile_redacts_maas_credentials(self):
         """create_log_tarfile redacts sensitive maas credentials configured."""
         self.add_patch('curtin.util.subp', 'mock_subp')
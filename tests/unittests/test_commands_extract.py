@@ -1,9 +1,18 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
+import hashlib
+import io
 import os
+import shutil
+import subprocess
+import tarfile
+import threading
+import time
+from unittest import mock, skipIf
 
-from .helpers import CiTestCase
+from .helpers import CiTestCase, skipUnlessBenchmark
 
 from curtin import util
+from curtin.commands import extract
 from curtin.commands.extract import (
     extract_source,
     _get_image_stack,
@@ -50,7 +59,7 @@ class MountTracker:
 
 class ExtractTestCase(CiTestCase):
 
-    def _fake_download(self, url, path, retries=0):
+    def _fake_download(self, url, path, retries=0, reporthook=None):
         self.downloads.append(os.path.abspath(path))
         with open(path, "w") as fp:
             fp.write("fake content from " + url + "\n")
@@ -60,6 +69,9 @@ class ExtractTestCase(CiTestCase):
         self.downloads = []
         self.add_patch("curtin.commands.extract.url_helper.download",
                        "m_download", side_effect=self._fake_download)
+        # no sha256 is served next to the images
+        self.add_patch("curtin.commands.extract.url_helper.geturl",
+                       "m_geturl", side_effect=UrlError(None, code=404))
         self.add_patch("curtin.commands.extract.copy_to_target",
                        "m_copy_to_target")
 
@@ -134,6 +146,124 @@ class ExtractTestCase(CiTestCase):
         self.assert_mounted_and_extracted(mount_tracker, fnames, target)
 
 
+class TestExtractRootTgzUrl(CiTestCase):
+
+    def setUp(self):
+        super(TestExtractRootTgzUrl, self).setUp()
+        self.add_patch('curtin.commands.extract.tar_xattr_opts',
+                       'm_xattr_opts', return_value=[])
+        self.tmp = self.tmp_dir()
+        self.target = os.path.join(self.tmp, 'target')
+        os.mkdir(self.target)
+
+    def _tarball(self, compress_cmd=None):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            for (name, content) in (('etc/hostname', b'curtin\n'),
+                                    ('usr/bin/true', 100000 * b'x')):
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+        content = buf.getvalue()
+        if compress_cmd:
+            content = subprocess.check_output(compress_cmd, input=content)
+        path = os.path.join(self.tmp, 'root.tar')
+        util.write_file(path, content, omode='wb')
+        return path
+
+    def _assert_extracted(self):
+        self.assertEqual('curtin\n', util.load_file(
+            os.path.join(self.target, 'etc/hostname')))
+        self.assertEqual(100000, os.path.getsize(
+            os.path.join(self.target, 'usr/bin/true')))
+
+    def test_uncompressed(self):
+        extract.extract_root_tgz_url(self._tarball(), self.target)
+        self._assert_extracted()
+
+    def test_file_url(self):
+        extract.extract_root_tgz_url('file://' + self._tarball(['gzip']),
+                                     self.target)
+        self._assert_extracted()
+
+    def test_xz(self):
+        extract.extract_root_tgz_url(self._tarball(['xz']), self.target)
+        self._assert_extracted()
+
+    def test_bz2(self):
+        extract.extract_root_tgz_url(self._tarball(['bzip2']), self.target)
+        self._assert_extracted()
+
+    @skipIf(not shutil.which('zstd'), 'zstd not available')
+    def test_zst(self):
+        extract.extract_root_tgz_url(self._tarball(['zstd']), self.target)
+        self._assert_extracted()
+
+    @mock.patch('curtin.block.image.url_helper.UrlReader')
+    def test_url(self, m_reader):
+        with open(self._tarball(['gzip']), 'rb') as fp:
+            m_reader.return_value.read.side_effect = (
+                io.BytesIO(fp.read()).read)
+        m_reader.return_value.size = None
+        extract.extract_root_tgz_url('http://host/root.tar.gz', self.target)
+        self._assert_extracted()
+        m_reader.return_value.close.assert_called_with()
+
+    def test_corrupt_raises(self):
+        path = os.path.join(self.tmp, 'root.tar.gz')
+        util.write_file(path, b'\x1f\x8b' + 1000 * b'x', omode='wb')
+        with self.assertRaises(util.ProcessExecutionError):
+            extract.extract_root_tgz_url(path, self.target)
+
+    def test_detect_compression(self):
+        for (header, compression) in ((b'\x1f\x8b\x08\x00', 'gz'),
+                                      (b'BZh91AY', 'bz2'),
+                                      (b'\xfd7zXZ\x00\x00', 'xz'),
+                                      (b'\x28\xb5\x2f\xfd\x04', 'zst'),
+                                      (b'etc/\x00\x00', None),
+                                      (b'', None)):
+            self.assertEqual(compression,
+                             extract.detect_compression(header))
+
+    @mock.patch('curtin.commands.extract.util.which')
+    def test_decompress_cmd_prefers_parallel(self, m_which):
+        m_which.side_effect = lambda cmd: cmd in ('pigz', 'gzip', 'xz')
+        self.assertEqual(['pigz', '-dc'], extract.decompress_cmd('gz'))
+        self.assertEqual(['xz', '-dc', '-T0'], extract.decompress_cmd('xz'))
+        with self.assertRaisesRegex(ValueError, 'zstd'):
+            extract.decompress_cmd('zst')
+
+    @skipUnlessBenchmark()
+    def test_benchmark_extract(self):
+        """Compare smtar with the decompressor pipeline on an xz root
+        tarball of 64 files of 2MiB."""
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            for i in range(64):
+                content = (os.urandom(1024) + bytes(1024)) * 1024
+                info = tarfile.TarInfo('usr/lib/file%d' % i)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+        path = os.path.join(self.tmp, 'root.tar.xz')
+        util.write_file(path, subprocess.check_output(
+            ['xz', '-T0', '-1'], input=buf.getvalue()), omode='wb')
+        smtar = os.path.join(os.path.dirname(__file__), '..', '..',
+                             'helpers', 'smtar')
+
+        start = time.monotonic()
+        subprocess.check_call(['sh', '-c', 'cat "$1" | "$3" -C "$2" -Sxpf -',
+                               '--', path, self.target, smtar])
+        shell = time.monotonic() - start
+        shutil.rmtree(self.target)
+        os.mkdir(self.target)
+
+        start = time.monotonic()
+        extract.extract_root_tgz_url(path, self.target)
+        native = time.monotonic() - start
+        print('\nextract 128MiB xz tarball on %d cpus: smtar %.2fs, '
+              'pipeline %.2fs' % (os.cpu_count(), shell, native))
+
+
 class TestExtractSourceCp(ExtractTestCase):
     """Test extract_source with cp sources."""
 
@@ -402,7 +532,8 @@ class TestExtractSourceLayeredFsImageUrl(ExtractTestCase):
         target = self.random_string()
         myurl = "http://example.io/minimal.standard.debug.squashfs"
 
-        def fail_download_minimal_standard(url, path, retries=0):
+        def fail_download_minimal_standard(url, path, retries=0,
+                                           reporthook=None):
             if url == "http://example.io/minimal.standard.squashfs":
                 raise UrlError(url, 404, "Couldn't download",
                                None, None)
@@ -420,7 +551,8 @@ class TestExtractSourceLayeredFsImageUrl(ExtractTestCase):
         target = self.random_string()
         myurl = "http://example.io/minimal.standard.debug.squashfs"
 
-        def empty_download_minimal_standard(url, path, retries=0):
+        def empty_download_minimal_standard(url, path, retries=0,
+                                            reporthook=None):
             if url == "http://example.io/minimal.standard.squashfs":
                 self.downloads.append(os.path.abspath(path))
                 with open(path, "w") as fp:
@@ -434,12 +566,142 @@ class TestExtractSourceLayeredFsImageUrl(ExtractTestCase):
             {'type': 'fsimage-layered', 'uri': myurl},
             target)
         self.assertEqual(0, self.m_copy_to_target.call_count)
-        self.assertEqual(3, self.m_download.call_count)
-        for i, image_url in enumerate(["minimal.squashfs",
-                                       "minimal.standard.squashfs",
-                                       "minimal.standard.debug.squashfs"]):
-            self.assertEqual("http://example.io/" + image_url,
-                             self.m_download.call_args_list[i][0][0])
+        # the layers download concurrently, the failure may cancel the
+        # download of the top layer
+        downloaded = set(c[0][0] for c in self.m_download.call_args_list)
+        self.assertLessEqual(
+            set(["http://example.io/minimal.squashfs",
+                 "http://example.io/minimal.standard.squashfs"]),
+            downloaded)
+        self.assertLessEqual(
+            downloaded,
+            set(["http://example.io/minimal.squashfs",
+                 "http://example.io/minimal.standard.squashfs",
+                 "http://example.io/minimal.standard.debug.squashfs"]))
+
+    def test_remote_file_multiple_concurrent(self):
+        """The layers download at once, the base layer is mounted before
+        the upper layers are downloaded."""
+        mount_tracker = self.track_mounts()
+        target = self.random_string()
+        myurl = "http://example.io/minimal.standard.debug.squashfs"
+        barrier = threading.Barrier(2, timeout=10)
+        mounted = threading.Event()
+
+        def download(url, path, retries=0, reporthook=None):
+            if url == "http://example.io/minimal.standard.squashfs":
+                # waits for the top layer download to start
+                barrier.wait()
+            elif url == "http://example.io/minimal.standard.debug.squashfs":
+                barrier.wait()
+                self.assertTrue(mounted.wait(timeout=10))
+            return self._fake_download(url, path, retries)
+
+        def mount(device, mountpoint, options=None, type=None):
+            mount_tracker.mount(device, mountpoint, options, type)
+            mounted.set()
+
+        self.m_download.side_effect = download
+        self.add_patch('curtin.commands.extract.mount', new=mount)
+        extract_source({'type': 'fsimage-layered', 'uri': myurl}, target)
+        self.assertEqual(4, len(mount_tracker.mounts))
+
+    def test_remote_file_failure_aborts_downloads(self):
+        """A failed layer stops the downloads of the other layers."""
+        self.track_mounts()
+        target = self.random_string()
+        myurl = "http://example.io/minimal.standard.debug.squashfs"
+        aborted = []
+        # the failure only fires once every layer download has started
+        barrier = threading.Barrier(3, timeout=10)
+
+        def download(url, path, retries=0, reporthook=None):
+            barrier.wait()
+            if url == "http://example.io/minimal.squashfs":
+                raise UrlError(url, 404, "Couldn't download", None, None)
+            deadline = time.monotonic() + 10
+            try:
+                while time.monotonic() < deadline:
+                    reporthook(0, 1, None)
+                    time.sleep(0.01)
+            except RuntimeError:
+                aborted.append(url)
+                raise
+            return self._fake_download(url, path, retries)
+        self.m_download.side_effect = download
+
+        start = time.monotonic()
+        with self.assertRaises(UrlError):
+            extract_source({'type': 'fsimage-layered', 'uri': myurl}, target)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(
+            set(["http://example.io/minimal.standard.squashfs", myurl]),
+            set(aborted))
+
+    def test_remote_file_sha256_verified(self):
+        mount_tracker = self.track_mounts()
+        target = self.random_string()
+        myurl = "http://example.io/minimal.squashfs"
+        content = "fake content from " + myurl + "\n"
+        self.m_geturl.side_effect = None
+        self.m_geturl.return_value = (
+            hashlib.sha256(content.encode()).hexdigest() +
+            "  minimal.squashfs\n").encode()
+
+        extract_source({'type': 'fsimage-layered', 'uri': myurl}, target)
+
+        self.m_geturl.assert_called_with(myurl + ".sha256")
+        self.assert_downloaded_and_mounted_and_extracted(
+            mount_tracker, [myurl], target)
+
+    def test_remote_file_sha256_mismatch(self):
+        self.track_mounts()
+        target = self.random_string()
+        self.m_geturl.side_effect = None
+        self.m_geturl.return_value = (64 * "0" + "\n").encode()
+
+        with self.assertRaisesRegex(ValueError, "expected 0000"):
+            extract_source(
+                {'type': 'fsimage-layered',
+                 'uri': "http://example.io/minimal.standard.squashfs"},
+                target)
+        self.assertEqual(0, self.m_copy_to_target.call_count)
+
+    def test_remote_file_sha256_server_error(self):
+        self.track_mounts()
+        self.add_patch('curtin.commands.extract.time.sleep', 'm_sleep')
+        self.m_geturl.side_effect = UrlError(None, code=500)
+        with self.assertRaises(UrlError):
+            extract_source(
+                {'type': 'fsimage-layered',
+                 'uri': "http://example.io/minimal.squashfs"},
+                self.random_string())
+        self.assertEqual(0, self.m_download.call_count)
+        self.assertEqual(len(extract.LAYER_SHA256_RETRIES) + 1,
+                         self.m_geturl.call_count)
+        self.assertEqual(
+            [mock.call(naptime) for naptime in extract.LAYER_SHA256_RETRIES],
+            self.m_sleep.call_args_list)
+
+    def test_remote_file_sha256_retried(self):
+        self.add_patch('curtin.commands.extract.time.sleep', 'm_sleep')
+        self.m_geturl.side_effect = [
+            UrlError(None, code=None), (64 * "a" + "\n").encode()]
+        self.assertEqual(64 * "a", extract._layer_sha256(
+            "http://example.io/minimal.squashfs"))
+        self.assertEqual(1, self.m_sleep.call_count)
+
+    def test_remote_file_sha256_forbidden_raises(self):
+        self.add_patch('curtin.commands.extract.time.sleep', 'm_sleep')
+        self.m_geturl.side_effect = UrlError(None, code=403)
+        with self.assertRaises(UrlError):
+            extract._layer_sha256("http://example.io/minimal.squashfs")
+
+    def test_remote_file_sha256_url_with_query(self):
+        self.assertIsNone(extract._layer_sha256(
+            "http://example.io/minimal.squashfs?token=x"))
+        self.m_geturl.assert_called_with(
+            "http://example.io/minimal.squashfs.sha256?token=x")
 
 
 class TestGetImageStack(CiTestCase):
@@ -4,11 +4,14 @@ import copy
 import json
 from unittest import mock
 import os
+import subprocess
+import time
 
 from curtin import config
+from curtin import profiling
 from curtin.commands import install
 from curtin.util import ensure_dir, write_file
-from .helpers import CiTestCase
+from .helpers import CiTestCase, skipUnlessBenchmark
 from collections import namedtuple
 
 
@@ -138,6 +141,39 @@ class TestCmdInstall(CiTestCase):
             [mock.call(self.logfile, target_dir, '/root/curtin-install.log')],
             self.m_copy_log.call_args_list)
 
+    def test_curtin_error_writes_subp_profile_before_tarfile(self):
+        """With subp_profile, the profile summary is written before the
+        error tarfile is created."""
+        working_dir = self.tmp_path('working', _dir=self.new_root)
+        ensure_dir(working_dir)
+        self.addCleanup(profiling.disable)
+        myargs = FakeArgs(
+            config={'install': {'log_file': self.logfile,
+                                'subp_profile': True}},
+            source=['dd-raw:https://localhost/raw_images/centos-6-3.img',
+                    'dd-raw:https://localhost/cant/provide/two/images.img'],
+            reportstack=FakeReportStack())
+        (records, summary) = profiling.profile_paths(self.logfile)
+
+        def create_log_tarfile(tarfile, cfg):
+            self.assertTrue(os.path.exists(summary))
+        self.add_patch(
+            'curtin.commands.collect_logs.create_log_tarfile', 'm_tar',
+            side_effect=create_log_tarfile)
+        self.add_patch(
+            'curtin.commands.install.copy_install_log', 'm_copy_log')
+        self.add_patch(
+            'curtin.commands.install.tempfile.mkdtemp', 'm_mkdtemp',
+            return_value=working_dir)
+        self.add_patch(
+            'curtin.commands.install.profiling.write_summary', 'm_summary',
+            side_effect=profiling.write_summary)
+        with self.assertRaises(ValueError):
+            install.cmd_install(myargs)
+        self.assertEqual(records, os.environ[profiling.PROFILE_ENV])
+        self.assertEqual(1, self.m_tar.call_count)
+        self.m_summary.assert_called_once_with(records, summary)
+
     def test_curtin_error_tarfile_not_created_when_skip_error_tarfile(self):
         """When error_tarfile is None, no tarfile is created."""
         working_dir = self.tmp_path('working', _dir=self.new_root)
@@ -266,3 +302,105 @@ class TestWorkingDir(CiTestCase):
             with self.assertRaises(ValueError):
                 install.WorkingDir.import_existing(
                         {"install": {"resume_data": resume_data_path}})
+
+
+class TestOutputTail(CiTestCase):
+
+    def test_keeps_everything_under_limit(self):
+        tail = install.OutputTail(10)
+        tail.append(b"abc")
+        tail.append(b"def")
+        self.assertEqual(b"abcdef", tail.getvalue())
+
+    def test_keeps_only_last_limit_bytes(self):
+        tail = install.OutputTail(5)
+        for chunk in (b"abc", b"defg", b"hi", b"jklm"):
+            tail.append(chunk)
+        self.assertEqual(b"jklm", tail.getvalue()[-4:])
+        self.assertEqual(b"ijklm", tail.getvalue())
+        self.assertLess(tail.size, 5 + 4)
+
+
+class TestStageRun(CiTestCase):
+
+    def setUp(self):
+        super(TestStageRun, self).setUp()
+        self.logfile = self.tmp_path('install.log')
+        self.stdout = []
+
+    def _stage(self, commands, **kwargs):
+        stage = install.Stage('test', commands, os.environ.copy(),
+                              logfile=self.logfile, **kwargs)
+        stage.write_stdout = self.stdout.append
+        self.addCleanup(stage.install_log.close)
+        return stage
+
+    def test_output_copied_to_stdout_and_log(self):
+        """Stage output is written to stdout and the install log."""
+        stage = self._stage({'01': ['sh', '-c', 'echo hello; echo world']},
+                            read_size=4)
+        stage.run()
+        self.assertEqual(b"hello\nworld\n", b"".join(self.stdout))
+        with open(self.logfile, 'rb') as fp:
+            self.assertEqual(b"hello\nworld\n", fp.read())
+
+    def test_failed_command_reports_output_tail(self):
+        """Failing commands raise with the last capture_limit bytes."""
+        stage = self._stage(
+            {'01': ['sh', '-c', 'echo 0123456789; exit 3']}, capture_limit=4)
+        with self.assertRaises(install.util.ProcessExecutionError) as exc:
+            stage.run()
+        self.assertEqual(3, exc.exception.exit_code)
+        self.assertEqual("789", exc.exception.stdout.strip())
+        with open(self.logfile, 'rb') as fp:
+            self.assertEqual(b"0123456789\n", fp.read())
+
+
+class TestStageRunBenchmark(CiTestCase):
+
+    @skipUnlessBenchmark()
+    def test_stage_output_throughput(self):
+        """Pipe several hundred MB through a stage and report MB/s."""
+        size_mb = int(os.environ.get('CURTIN_BENCHMARK_STAGE_MB', '256'))
+        # the per-byte loop is quadratic, only feed it a small sample
+        legacy_kb = int(os.environ.get('CURTIN_BENCHMARK_STAGE_LEGACY_KB',
+                                       '128'))
+        logfile = self.tmp_path('install.log')
+        devnull = open(os.devnull, 'wb')
+        self.addCleanup(devnull.close)
+
+        def write_stdout(data):
+            devnull.write(data)
+            devnull.flush()
+
+        def legacy_run(stage, cmd):
+            # the per-byte loop Stage.run used before chunked reads
+            sp = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT)
+            output = b""
+            while True:
+                data = sp.stdout.read(1)
+                if not data and sp.poll() is not None:
+                    break
+                stage.write(data)
+                stage.flush()
+                output += data
+
+        def timed(size, func):
+            start = time.monotonic()
+            func()
+            return size / (time.monotonic() - start)
+
+        cmd = ['sh', '-c', 'head -c %dM /dev/zero' % size_mb]
+        stage = install.Stage('bench', {'01': cmd}, os.environ.copy(),
+                              logfile=logfile)
+        self.addCleanup(stage.install_log.close)
+        stage.write_stdout = write_stdout
+        chunked = timed(size_mb, stage.run)
+
+        cmd = ['sh', '-c', 'head -c %dK /dev/zero' % legacy_kb]
+        legacy = timed(legacy_kb / 1024, lambda: legacy_run(stage, cmd))
+        print("stage output: chunked %.1f MB/s (%d MB), per-byte %.1f MB/s "
+              "(%d KB), %.0fx" % (chunked, size_mb, legacy, legacy_kb,
+                                  chunked / legacy))
+        self.assertGreater(chunked, legacy)
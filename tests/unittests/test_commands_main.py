@@ -0,0 +1,120 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import os
+import subprocess
+import sys
+from unittest import mock
+
+from curtin.commands import main
+from .helpers import CiTestCase, skipUnlessBenchmark
+
+# cumulative microseconds importing the modules run by 'curtin version' may
+# take in test_benchmark_import_time
+IMPORT_TIME_BUDGET = 150000
+# the same, loose enough for test_version_import_budget to run on any
+# machine
+IMPORT_TIME_LOOSE_BUDGET = 2000000
+# command modules that running 'curtin version' may import
+VERSION_COMMAND_MODULES = set([
+    'curtin.commands', 'curtin.commands.main', 'curtin.commands.version'])
+# heavy modules that running 'curtin version' must not import
+HEAVY_MODULES = set([
+    'curtin.commands.block_meta', 'curtin.commands.curthooks',
+    'curtin.commands.apt_config', 'curtin.net', 'curtin.block',
+    'curtin.url_helper'])
+
+
+def _importtime(*args):
+    """Run curtin with args under python -X importtime.
+
+    Returns a list of (module, cumulative microseconds, depth) of the
+    modules imported.
+    """
+    topdir = os.path.dirname(os.path.dirname(main.__file__))
+    env = dict(os.environ,
+               PYTHONPATH=os.path.dirname(topdir) + os.pathsep +
+               os.environ.get('PYTHONPATH', ''))
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'curtin'] + list(args),
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    imports = []
+    for line in proc.stderr.decode().splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        (_, cumulative, name) = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(cumulative), depth))
+    return imports
+
+
+class TestMain(CiTestCase):
+
+    def setUp(self):
+        super(TestMain, self).setUp()
+        environ = mock.patch.dict(os.environ)
+        environ.start()
+        self.addCleanup(environ.stop)
+        # keep the logging of the other tests as it is
+        self.add_patch('curtin.log.basicConfig', 'm_basic_config')
+
+    def _run(self, argv, add_subcmd=None):
+        """Run main with argv, return the subcommands added with
+        add_subcmd and the exit code."""
+        with mock.patch.object(main, 'add_subcmd',
+                               side_effect=add_subcmd) as m_add_subcmd:
+            with mock.patch('sys.stdout'):
+                with self.assertRaises(SystemExit) as context_manager:
+                    main.main(argv)
+        return ([call[0][1] for call in m_add_subcmd.call_args_list],
+                context_manager.exception.code)
+
+    def test_only_selected_subcommand_imported(self):
+        self.assertEqual(
+            (['version'], 0), self._run(['version'], main.add_subcmd))
+
+    def test_main_options_before_subcommand(self):
+        self.assertEqual(
+            (['version'], 0),
+            self._run(['-v', '--set', 'showtrace=1', 'version'],
+                      main.add_subcmd))
+
+    def test_no_subcommand_adds_all(self):
+        self.assertEqual(
+            (main.SUB_COMMAND_MODULES, 1),
+            self._run([], lambda subps, subcmd: subps.add_parser(subcmd)))
+
+    def test_maybe_install_deps_returns_subcommand(self):
+        self.assertEqual(
+            'block-meta', main.maybe_install_deps(['-v', 'block-meta', '-h']))
+        self.assertIsNone(main.maybe_install_deps(['--verbose=x']))
+        self.assertIsNone(main.maybe_install_deps([]))
+
+    def test_version_imports_no_other_command(self):
+        """Running a subcommand imports only its own command module."""
+        modules = set(name for (name, _, _) in _importtime('version')
+                      if name.startswith('curtin.commands'))
+        self.assertEqual(VERSION_COMMAND_MODULES, modules)
+
+    def test_version_import_budget(self):
+        """'curtin version' imports none of the heavy modules and stays
+        within a loose time budget."""
+        imports = _importtime('version')
+        self.assertEqual(
+            set(), HEAVY_MODULES & set(name for (name, _, _) in imports))
+        self.assertLess(
+            sum(cumulative for (_, cumulative, depth) in imports
+                if depth == 0),
+            IMPORT_TIME_LOOSE_BUDGET)
+
+    @skipUnlessBenchmark()
+    def test_benchmark_import_time(self):
+        """The modules imported by 'curtin version' take less than
+        IMPORT_TIME_BUDGET to import."""
+        total = sum(cumulative for (_, cumulative, depth)
+                    in _importtime('version') if depth == 0)
+        print('\ncurtin version imports: %.1fms' % (total / 1000))
+        self.assertLess(total, IMPORT_TIME_BUDGET)
+
+# vi: ts=4 expandtab syntax=python
@@ -0,0 +1,89 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import json
+from unittest import mock
+
+from curtin.commands import trace_diff
+from curtin.util import write_file
+from .helpers import CiTestCase
+
+
+def _complete(name, dur):
+    return {'name': name.rpartition('/')[2], 'ph': 'X', 'ts': 0,
+            'dur': int(dur * 1e6), 'args': {'name': name}}
+
+
+class TestLoadTrace(CiTestCase):
+
+    def test_unterminated_array(self):
+        path = self.tmp_path('trace.json')
+        write_file(path, '[\n{"ph": "X", "name": "a"},\n')
+        self.assertEqual([{'ph': 'X', 'name': 'a'}],
+                         trace_diff.load_trace(path))
+
+    def test_terminated_array(self):
+        path = self.tmp_path('trace.json')
+        write_file(path, '[{"ph": "X", "name": "a"}]')
+        self.assertEqual([{'ph': 'X', 'name': 'a'}],
+                         trace_diff.load_trace(path))
+
+    def test_object_format(self):
+        path = self.tmp_path('trace.json')
+        write_file(path, '{"traceEvents": [{"ph": "X", "name": "a"}]}')
+        self.assertEqual([{'ph': 'X', 'name': 'a'}],
+                         trace_diff.load_trace(path))
+
+
+class TestDiffTraces(CiTestCase):
+
+    old = [_complete('cmd-install', 100), _complete('cmd-install/a', 10),
+           _complete('cmd-install/b', 50), _complete('cmd-install/b', 5),
+           _complete('cmd-install/gone', 1),
+           {'name': 'process_name', 'ph': 'M', 'args': {'name': 'x'}}]
+    new = [_complete('cmd-install', 80), _complete('cmd-install/a', 12),
+           _complete('cmd-install/b', 35), _complete('cmd-install/added', 3)]
+
+    def test_event_durations_summed(self):
+        self.assertEqual(
+            {'cmd-install': (100.0, 1), 'cmd-install/a': (10.0, 1),
+             'cmd-install/b': (55.0, 2), 'cmd-install/gone': (1.0, 1)},
+            trace_diff.event_durations(self.old))
+
+    def test_sorted_by_change(self):
+        self.assertEqual(
+            [('cmd-install', 100.0, 80.0),
+             ('cmd-install/b', 55.0, 35.0),
+             ('cmd-install/added', None, 3.0),
+             ('cmd-install/a', 10.0, 12.0),
+             ('cmd-install/gone', 1.0, None)],
+            trace_diff.diff_traces(self.old, self.new))
+
+    def test_format_diff(self):
+        lines = trace_diff.format_diff(
+            [('cmd-install', 100.0, 80.0),
+             ('cmd-install/added', None, 3.0)]).splitlines()
+        self.assertEqual(
+            ['event', 'old(s)', 'new(s)', 'delta(s)', 'delta%'],
+            lines[0].split())
+        self.assertEqual(
+            ['cmd-install', '100.000', '80.000', '-20.000', '-20.0'],
+            lines[1].split())
+        self.assertEqual(
+            ['cmd-install/added', '-', '3.000', '+3.000', '-'],
+            lines[2].split())
+
+    def test_main_filters_rows(self):
+        old = self.tmp_path('old.json')
+        new = self.tmp_path('new.json')
+        write_file(old, json.dumps(self.old))
+        write_file(new, json.dumps(self.new))
+        args = mock.Mock(old=old, new=new, top=2, min_delta=5.0, json=True)
+        with mock.patch('sys.stdout') as m_stdout:
+            with self.assertRaises(SystemExit):
+                trace_diff.trace_diff_main(args)
+        self.assertEqual(
+            [{'name': 'cmd-install', 'old': 100.0, 'new': 80.0},
+             {'name': 'cmd-install/b', 'old': 55.0, 'new': 35.0}],
+            json.loads(m_stdout.write.call_args[0][0]))
+
+# vi: ts=4 expandtab syntax=python
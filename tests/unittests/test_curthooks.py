@@ -82,6 +82,20 @@ class TestCurthooksInstallKernel(CiTestCase):
 
             self.mock_instpkg.assert_has_calls(inst_calls)
 
+    def test__skips_flash_kernel_packages_already_installed(self):
+        kernel_package = self.kernel_cfg.get('kernel', {}).get('package', {})
+        self.mock_get_flash_kernel_pkgs.return_value = 'u-boot-tools'
+
+        with patch.dict(os.environ, clear=True):
+            curthooks.install_kernel(self.kernel_cfg, self.target,
+                                     fk_packages=['u-boot-tools'])
+
+            env = {'FK_FORCE': 'yes', 'FK_FORCE_CONTAINER': 'yes'}
+
+            self.mock_instpkg.assert_called_once_with(
+                [kernel_package], target=self.target, env=env)
+            self.mock_get_flash_kernel_pkgs.assert_not_called()
+
     def test__installs_kernel_package(self):
         kernel_package = self.kernel_cfg.get('kernel', {}).get('package', {})
         self.mock_get_flash_kernel_pkgs.return_value = None
@@ -554,6 +568,57 @@ class TestInstallMissingPkgs(CiTestCase):
                 expected_pkgs, target=target, osfamily=distro.DISTROS.redhat)
 
 
+class TestInstallPackagePlan(CiTestCase):
+    def setUp(self):
+        super(TestInstallPackagePlan, self).setUp()
+        ccc = 'curtin.commands.curthooks'
+        self.add_patch(ccc + '.get_missing_packages', 'mock_missing')
+        self.add_patch(ccc + '.get_flash_kernel_pkgs', 'mock_fk')
+        self.add_patch(ccc + '.get_kernel_package', 'mock_kernel')
+        self.add_patch('curtin.distro.install_packages',
+                       'mock_install_packages')
+        self.add_patch('curtin.util.load_command_environment',
+                       'mock_load_cmd_env')
+        self.mock_missing.return_value = set()
+        self.mock_fk.return_value = None
+        self.target = "not-a-real-target"
+
+    @patch.object(events, 'ReportEventStack')
+    def test_installs_nothing_if_nothing_needed(self, mock_events):
+        self.assertEqual([], curthooks.install_package_plan({}, self.target))
+        self.mock_install_packages.assert_not_called()
+
+    @patch.object(events, 'ReportEventStack')
+    def test_single_transaction_without_kernel(self, mock_events):
+        """the kernel is installed later, after the storage config."""
+        self.mock_missing.return_value = set(['mdadm', 'grub-pc'])
+        self.mock_fk.return_value = 'u-boot-tools'
+        self.assertEqual(['u-boot-tools'],
+                         curthooks.install_package_plan({}, self.target))
+        self.mock_kernel.assert_not_called()
+        self.mock_install_packages.assert_called_once_with(
+            ['grub-pc', 'mdadm', 'u-boot-tools'],
+            target=self.target, osfamily=distro.DISTROS.debian)
+
+    @patch.object(events, 'ReportEventStack')
+    def test_no_flash_kernel_packages_with_kernel_null(self, mock_events):
+        self.mock_missing.return_value = set(['mdadm'])
+        self.mock_fk.return_value = 'u-boot-tools'
+        curthooks.install_package_plan({'kernel': None}, self.target)
+        self.mock_install_packages.assert_called_once_with(
+            ['mdadm'], target=self.target, osfamily=distro.DISTROS.debian)
+
+    @patch.object(events, 'ReportEventStack')
+    def test_no_flash_kernel_packages_on_non_debian(self, mock_events):
+        self.mock_missing.return_value = set(['mdadm'])
+        self.mock_fk.return_value = 'u-boot-tools'
+        curthooks.install_package_plan({}, self.target,
+                                       osfamily=distro.DISTROS.redhat)
+        self.mock_fk.assert_not_called()
+        self.mock_install_packages.assert_called_once_with(
+            ['mdadm'], target=self.target, osfamily=distro.DISTROS.redhat)
+
+
 class TestSetupZipl(CiTestCase):
 
     def setUp(self):
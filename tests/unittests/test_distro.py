@@ -395,6 +395,64 @@ class TestAptInstall(CiTestCase):
         m_subp.assert_not_called()
 
 
+class TestAptUpdate(CiTestCase):
+
+    def setUp(self):
+        super(TestAptUpdate, self).setUp()
+        self.target = self.tmp_dir()
+        self.sources = os.path.join(self.target, 'etc/apt/sources.list')
+        util.write_file(self.sources, 'deb http://archive/ubuntu jammy main')
+        self.add_patch('curtin.util.subp', 'm_subp')
+        self.add_patch('curtin.distro.APT_INDEX', 'm_index',
+                       new=distro.AptIndexTracker())
+
+    @mock.patch.object(util.ChrootableTarget, "__enter__", new=lambda a: a)
+    def test_apt_update_skipped_if_sources_unchanged(self):
+        distro.apt_update(target=self.target)
+        distro.apt_update(target=self.target)
+        self.assertEqual(1, self.m_subp.call_count)
+        self.assertEqual(1, distro.APT_INDEX.stats()['updates'])
+        self.assertEqual(1, distro.APT_INDEX.stats()['skipped'])
+
+    @mock.patch.object(util.ChrootableTarget, "__enter__", new=lambda a: a)
+    def test_apt_update_runs_if_sources_changed(self):
+        distro.apt_update(target=self.target)
+        util.write_file(os.path.join(self.target,
+                                     'etc/apt/sources.list.d/ppa.list'),
+                        'deb http://ppa/ubuntu jammy main')
+        distro.apt_update(target=self.target)
+        self.assertEqual(2, self.m_subp.call_count)
+
+    @mock.patch.object(util.ChrootableTarget, "__enter__", new=lambda a: a)
+    def test_apt_update_runs_after_sources_changed(self):
+        distro.apt_update(target=self.target)
+        distro.apt_sources_changed(target=self.target)
+        distro.apt_update(target=self.target)
+        self.assertEqual(2, self.m_subp.call_count)
+
+    @mock.patch.object(util.ChrootableTarget, "__enter__", new=lambda a: a)
+    def test_apt_update_force(self):
+        distro.apt_update(target=self.target)
+        distro.apt_update(target=self.target, force=True)
+        self.assertEqual(2, self.m_subp.call_count)
+
+    @mock.patch.object(util.ChrootableTarget, "__enter__", new=lambda a: a)
+    def test_apt_update_not_recorded_on_failure(self):
+        self.m_subp.side_effect = util.ProcessExecutionError()
+        with self.assertRaises(util.ProcessExecutionError):
+            distro.apt_update(target=self.target)
+        self.m_subp.side_effect = None
+        distro.apt_update(target=self.target)
+        self.assertEqual(2, self.m_subp.call_count)
+
+    @mock.patch.object(util.ChrootableTarget, "__enter__", new=lambda a: a)
+    def test_apt_update_always_runs_without_sources(self):
+        os.unlink(self.sources)
+        distro.apt_update(target=self.target)
+        distro.apt_update(target=self.target)
+        self.assertEqual(2, self.m_subp.call_count)
+
+
 class TestYumInstall(CiTestCase):
 
     @mock.patch.object(util.ChrootableTarget, "__enter__", new=lambda a: a)
@@ -0,0 +1,174 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import os
+import threading
+import time
+
+from curtin import profiling
+from curtin import util
+from curtin.reporter import events
+from .helpers import CiTestCase, skipUnlessBenchmark
+
+
+class TestCommandName(CiTestCase):
+
+    def test_plain_command(self):
+        self.assertEqual(
+            'udevadm', profiling.command_name(['/usr/bin/udevadm', 'settle']))
+
+    def test_wrappers_skipped(self):
+        self.assertEqual('apt-get', profiling.command_name(
+            ['unshare', '--fork', '--pid', '--', 'chroot', '/target',
+             'apt-get', 'install']))
+
+    def test_shell_command(self):
+        self.assertEqual(
+            'lsblk', profiling.command_name(['sh', '-c', 'lsblk -J | cat']))
+
+    def test_empty(self):
+        self.assertEqual('', profiling.command_name([]))
+
+
+class TestProfileSubp(CiTestCase):
+
+    allowed_subp = True
+
+    def setUp(self):
+        super(TestProfileSubp, self).setUp()
+        self.add_patch(
+            'curtin.util._get_unshare_pid_args', 'm_unshare', return_value=[])
+        self.records = self.tmp_path('subp-profile.jsonl')
+        self.addCleanup(profiling.disable)
+
+    def test_disabled_records_nothing(self):
+        profiling.disable()
+        util.subp(['true'])
+        self.assertFalse(os.path.exists(self.records))
+
+    def test_records_command(self):
+        profiling.enable(self.records)
+        with events.ReportEventStack(
+                'outer', 'outer', reporting_enabled=False):
+            util.subp(['true'])
+            util.subp(['false'], rcs=[1])
+        util.subp(['sh', '-c', 'true'], shell=False)
+        records = profiling.load_records(self.records)
+        self.assertEqual(['true', 'false', 'true'],
+                         [r['cmd'] for r in records])
+        self.assertEqual([0, 1, 0], [r['rc'] for r in records])
+        self.assertEqual(['outer', 'outer', None],
+                         [r['stack'] for r in records])
+        for entry in records:
+            self.assertGreater(entry['duration'], 0)
+            self.assertGreater(entry['maxrss'], 0)
+            self.assertIn('cpu', entry)
+
+    def test_failed_command_recorded(self):
+        profiling.enable(self.records)
+        with self.assertRaises(util.ProcessExecutionError):
+            util.subp(['false'])
+        self.assertEqual(
+            [1], [r['rc'] for r in profiling.load_records(self.records)])
+
+    def test_child_process_inherits_profile(self):
+        profiling.enable(self.records)
+        self.assertEqual(self.records, os.environ[profiling.PROFILE_ENV])
+
+    def test_nested_stacks(self):
+        profiling.enable(self.records)
+        with events.ReportEventStack(
+                'outer', 'outer', reporting_enabled=False) as outer:
+            with events.ReportEventStack('inner', 'inner', parent=outer):
+                util.subp(['true'])
+            self.assertEqual('outer', events.current_stack_name())
+        self.assertEqual(
+            ['outer/inner'],
+            [r['stack'] for r in profiling.load_records(self.records)])
+
+    def test_stacks_per_thread(self):
+        profiling.enable(self.records)
+
+        def run():
+            util.subp(['true'])
+        with events.ReportEventStack(
+                'outer', 'outer', reporting_enabled=False):
+            for target in (run, events.inherit_stack(run)):
+                thread = threading.Thread(target=target)
+                thread.start()
+                thread.join()
+            self.assertEqual('outer', events.current_stack_name())
+        self.assertEqual(
+            [None, 'outer'],
+            [r['stack'] for r in profiling.load_records(self.records)])
+        self.assertIsNone(events.current_stack_name())
+
+    @skipUnlessBenchmark()
+    def test_benchmark_overhead(self):
+        """Time 200 runs of true with profiling disabled and enabled."""
+        times = []
+        for enable in (False, True):
+            if enable:
+                profiling.enable(self.records)
+            start = time.monotonic()
+            for i in range(200):
+                util.subp(['true'])
+            times.append(time.monotonic() - start)
+        print('\n200 subp: disabled %.3fs, enabled %.3fs' % tuple(times))
+
+
+class TestSummary(CiTestCase):
+
+    records = [
+        {'cmd': 'udevadm', 'duration': 1.0, 'rc': 0, 'stack': 'a',
+         'cpu': 0.1, 'maxrss': 100},
+        {'cmd': 'udevadm', 'duration': 2.0, 'rc': 1, 'stack': 'b',
+         'cpu': 0.2, 'maxrss': 300},
+        {'cmd': 'apt-get', 'duration': 5.0, 'rc': 0, 'stack': 'b'},
+    ]
+
+    def test_aggregate_by_command(self):
+        self.assertEqual({
+            'udevadm': {'count': 2, 'failures': 1, 'duration': 3.0,
+                        'cpu': 0.1 + 0.2, 'maxrss': 300},
+            'apt-get': {'count': 1, 'failures': 0, 'duration': 5.0,
+                        'cpu': 0.0, 'maxrss': 0}},
+            profiling.aggregate(self.records))
+
+    def test_aggregate_by_stack(self):
+        totals = profiling.aggregate(self.records, key='stack')
+        self.assertEqual({'a': 1.0, 'b': 7.0},
+                         {k: v['duration'] for (k, v) in totals.items()})
+
+    def test_summary_sorted(self):
+        lines = profiling.format_summary(self.records).splitlines()
+        self.assertEqual('3 commands, 8.000s total', lines[0])
+        by_time = lines.index('Top commands by total time:')
+        self.assertTrue(lines[by_time + 2].startswith('apt-get '))
+        by_count = lines.index('Top commands by count:')
+        self.assertTrue(lines[by_count + 2].startswith('udevadm '))
+        by_event = lines.index('Top events by total time:')
+        self.assertTrue(lines[by_event + 2].startswith('b '))
+
+    def test_summary_top(self):
+        lines = profiling.format_summary(self.records, top=1).splitlines()
+        by_time = lines.index('Top commands by total time:')
+        self.assertEqual('', lines[by_time + 3])
+
+    def test_write_summary(self):
+        records = self.tmp_path('subp-profile.jsonl')
+        summary = self.tmp_path('subp-profile.txt')
+        self.assertFalse(profiling.write_summary(records, summary))
+        with open(records, 'w') as fp:
+            fp.write('{"cmd": "true", "duration": 0.5, "rc": 0}\n{"cmd"')
+        self.assertTrue(profiling.write_summary(records, summary))
+        with open(summary) as fp:
+            self.assertTrue(
+                fp.read().startswith('1 commands, 0.500s total\n'))
+
+    def test_profile_paths(self):
+        self.assertEqual(
+            ('/var/log/curtin/subp-profile.jsonl',
+             '/var/log/curtin/subp-profile.txt'),
+            profiling.profile_paths('/var/log/curtin/install.log'))
+
+# vi: ts=4 expandtab syntax=python
@@ -6,6 +6,9 @@ from __future__ import (
     unicode_literals,
     )
 
+import json
+import threading
+import time
 from unittest.mock import patch
 
 from curtin.reporter.legacy import (
@@ -22,8 +25,9 @@ from curtin.reporter.legacy.maas import (
 from curtin import reporter
 from curtin.reporter import handlers
 from curtin import url_helper
+from curtin.commands import trace_diff
 from curtin.reporter import events
-from .helpers import CiTestCase
+from .helpers import CiTestCase, skipUnlessBenchmark
 
 import base64
 import os
@@ -204,4 +208,264 @@ class TestReporter(CiTestCase):
             url='127.0.0.1:8000', data=event.as_dict(),
             headers=webhook_handler.headers, retries=None)
 
+
+@patch('curtin.url_helper.OauthUrlHelper')
+class TestWebHookHandlerAsync(CiTestCase):
+
+    def _handler(self, **kwargs):
+        handler = handlers.WebHookHandler('127.0.0.1:8000', level='INFO',
+                                          asynchronous=True, **kwargs)
+        self.addCleanup(handler.flush)
+        self.posted = []
+
+        def geturl(url, data, headers, retries):
+            self.posted.append(data)
+        handler.oauth_helper.geturl.side_effect = geturl
+        return handler
+
+    def _event(self, name, event_type=events.START_EVENT_TYPE):
+        return events.ReportingEvent(event_type, name, 'desc')
+
+    def test_publish_does_not_wait_for_post(self, m_helper):
+        handler = self._handler()
+        release = threading.Event()
+        handler.oauth_helper.geturl.side_effect = (
+            lambda **kwargs: release.wait(10))
+        start = time.monotonic()
+        for i in range(3):
+            handler.publish_event(self._event('ev%d' % i))
+        self.assertLess(time.monotonic() - start, 1)
+        release.set()
+        handler.flush()
+        self.assertEqual(0, handler.queue_depth)
+        self.assertEqual(3, handler.oauth_helper.geturl.call_count)
+        self.assertEqual(3, handler.stats['sent'])
+        self.assertGreater(handler.stats['max_latency'], 0)
+
+    def test_events_posted_in_order(self, m_helper):
+        handler = self._handler()
+        evs = [self._event('ev%d' % i) for i in range(20)]
+        for ev in evs:
+            handler.publish_event(ev)
+        handler.flush()
+        self.assertEqual([ev.as_dict() for ev in evs], self.posted)
+
+    def _hold_sender(self, handler):
+        """Make the sender wait in its next post until the returned event
+        is set, return once it does."""
+        (entered, release) = (threading.Event(), threading.Event())
+
+        def geturl(url, data, headers, retries):
+            self.posted.append(data)
+            entered.set()
+            release.wait(10)
+        handler.oauth_helper.geturl.side_effect = geturl
+        handler.publish_event(self._event('first'))
+        self.assertTrue(entered.wait(10))
+        return release
+
+    def test_batches_posted_as_list(self, m_helper):
+        handler = self._handler(batch_size=10)
+        release = self._hold_sender(handler)
+        evs = [self._event('ev%d' % i) for i in range(5)]
+        for ev in evs:
+            handler.publish_event(ev)
+        release.set()
+        handler.flush()
+        self.assertEqual([ev.as_dict() for ev in evs],
+                         json.loads(self.posted[-1].decode()))
+        self.assertEqual(6, handler.stats['sent'])
+        self.assertEqual(2, handler.stats['posts'])
+
+    def test_batches_rejected_posted_one_by_one(self, m_helper):
+        handler = self._handler(batch_size=10)
+        evs = [self._event('ev%d' % i) for i in range(5)]
+
+        def geturl(url, data, headers, retries):
+            if isinstance(data, bytes):
+                raise url_helper.UrlError(None, code=400)
+            self.posted.append(data)
+        handler.oauth_helper.geturl.side_effect = geturl
+        handler._send([(time.monotonic(), ev) for ev in evs])
+        self.assertEqual([ev.as_dict() for ev in evs], self.posted)
+        self.assertEqual(1, handler.batch_size)
+
+    def test_failed_batch_posted_one_by_one(self, m_helper):
+        handler = self._handler(batch_size=10)
+        evs = [self._event('ev%d' % i) for i in range(3)]
+
+        def geturl(url, data, headers, retries):
+            if isinstance(data, bytes):
+                raise url_helper.UrlError(None, code=503)
+            if data['name'] == 'ev1':
+                raise url_helper.UrlError(None, code=None)
+            self.posted.append(data)
+        handler.oauth_helper.geturl.side_effect = geturl
+        handler._send([(time.monotonic(), ev) for ev in evs])
+        self.assertEqual([evs[0].as_dict(), evs[2].as_dict()], self.posted)
+        self.assertEqual(2, handler.stats['sent'])
+        self.assertEqual(1, handler.stats['failed'])
+        self.assertEqual(10, handler.batch_size)
+
+    def test_flush_timeout(self, m_helper):
+        handler = self._handler()
+        release = self._hold_sender(handler)
+        self.addCleanup(release.set)
+        start = time.monotonic()
+        handler.flush(timeout=0.1)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(0, handler.stats['sent'])
+
+    def test_progress_events_coalesced(self, m_helper):
+        handler = self._handler()
+        items = [(0, self._event('a', events.PROGRESS_EVENT_TYPE)),
+                 (0, self._event('start')),
+                 (0, self._event('a', events.PROGRESS_EVENT_TYPE)),
+                 (0, self._event('b', events.PROGRESS_EVENT_TYPE))]
+        self.assertEqual([items[1], items[2], items[3]],
+                         handler._coalesce(items))
+        self.assertEqual(1, handler.stats['coalesced'])
+
+    def test_progress_dropped_when_queue_full(self, m_helper):
+        handler = self._handler(queue_size=1)
+        release = self._hold_sender(handler)
+        handler.publish_event(self._event('queued'))
+        handler.publish_event(self._event('p', events.PROGRESS_EVENT_TYPE))
+        self.assertEqual(1, handler.stats['dropped'])
+        release.set()
+        handler.flush()
+        self.assertEqual(2, handler.stats['sent'])
+
+    def test_failed_posts_counted(self, m_helper):
+        handler = self._handler()
+        handler.oauth_helper.geturl.side_effect = (
+            url_helper.UrlError(None, code=500))
+        handler.publish_event(self._event('start'))
+        handler.flush()
+        self.assertEqual(1, handler.stats['failed'])
+
+    def test_reporter_flush(self, m_helper):
+        handler = self._handler()
+        with patch.object(reporter.instantiated_handler_registry,
+                          '_items', {'hook': handler}):
+            handler.publish_event(self._event('start'))
+            with patch.object(handler, 'flush') as m_flush:
+                reporter.flush()
+        m_flush.assert_called_with()
+
+    @skipUnlessBenchmark()
+    def test_benchmark_publish(self, m_helper):
+        """Time publishing 200 events to an endpoint taking 10ms a post,
+        synchronously and asynchronously."""
+        times = []
+        for asynchronous in (False, True):
+            handler = handlers.WebHookHandler(
+                '127.0.0.1:8000', asynchronous=asynchronous, batch_size=20)
+            handler.oauth_helper.geturl.side_effect = (
+                lambda **kwargs: time.sleep(0.01))
+            start = time.monotonic()
+            for i in range(200):
+                handler.publish_event(self._event('ev%d' % i))
+            times.append(time.monotonic() - start)
+            handler.flush()
+        print('\npublish 200 events: synchronous %.2fs, asynchronous '
+              '%.3fs' % tuple(times))
+
+
+class TestProgressReporter(CiTestCase):
+
+    @patch('curtin.reporter.events.report_event')
+    def test_reports_once_per_step(self, m_report):
+        with patch.dict(os.environ, {'CURTIN_REPORTSTACK': 'cmd-install'}):
+            progress = events.ProgressReporter('wipe-sda', 'wiping', 25)
+        reported = []
+        for done in range(0, 101, 10):
+            if progress.due(done):
+                reported.append(done)
+                progress.report_progress('%d%%' % done)
+        self.assertEqual([30, 50, 80, 100], reported)
+        event = m_report.call_args[0][0]
+        self.assertEqual('cmd-install/wipe-sda', event.name)
+        self.assertEqual(events.PROGRESS_EVENT_TYPE, event.event_type)
+        self.assertEqual('wiping: 100%', event.description)
+
+
+class TestTraceHandler(CiTestCase):
+
+    def setUp(self):
+        super(TestTraceHandler, self).setUp()
+        self.path = self.tmp_path('trace.json')
+
+    def _publish(self, handler, event_type, name, timestamp):
+        if event_type == events.FINISH_EVENT_TYPE:
+            event = events.FinishReportingEvent(name, 'desc ' + name)
+        else:
+            event = events.ReportingEvent(event_type, name, 'desc ' + name)
+        event.timestamp = timestamp
+        handler.publish_event(event)
+
+    def test_complete_events_with_parent(self):
+        handler = handlers.TraceHandler(self.path, append=False)
+        self._publish(handler, events.START_EVENT_TYPE, 'cmd-install', 10.0)
+        self._publish(handler, events.START_EVENT_TYPE,
+                      'cmd-install/stage-early', 10.5)
+        self._publish(handler, events.PROGRESS_EVENT_TYPE,
+                      'cmd-install/stage-early', 11.0)
+        self._publish(handler, events.FINISH_EVENT_TYPE,
+                      'cmd-install/stage-early', 12.0)
+        self._publish(handler, events.FINISH_EVENT_TYPE, 'cmd-install', 13.0)
+        trace = trace_diff.load_trace(self.path)
+        self.assertEqual(
+            {'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+             'args': {'name': 'cmd-install'}}, trace[0])
+        self.assertEqual(['i', 'X', 'X'], [e['ph'] for e in trace[1:]])
+        self.assertEqual(11000000, trace[1]['ts'])
+        (stage, install) = trace[2:]
+        self.assertEqual(
+            ('stage-early', 10500000, 1500000),
+            (stage['name'], stage['ts'], stage['dur']))
+        self.assertEqual(
+            {'name': 'cmd-install/stage-early', 'parent': 'cmd-install',
+             'description': 'desc cmd-install/stage-early',
+             'result': 'SUCCESS'}, stage['args'])
+        self.assertEqual(
+            ('cmd-install', 10000000, 3000000, ''),
+            (install['name'], install['ts'], install['dur'],
+             install['args']['parent']))
+
+    def test_new_trace_truncates(self):
+        with open(self.path, 'w') as fp:
+            fp.write('[\n{"ph": "X", "name": "old"},\n')
+        handler = handlers.TraceHandler(self.path, append=False)
+        self._publish(handler, events.START_EVENT_TYPE, 'cmd-install', 1.0)
+        self._publish(handler, events.FINISH_EVENT_TYPE, 'cmd-install', 2.0)
+        self.assertEqual(['process_name', 'cmd-install'],
+                         [e['name'] for e in trace_diff.load_trace(self.path)])
+
+    def test_child_command_appends(self):
+        first = handlers.TraceHandler(self.path, append=False)
+        self._publish(first, events.START_EVENT_TYPE, 'cmd-install', 1.0)
+        with patch.dict(os.environ, {'CURTIN_REPORTSTACK': 'cmd-install'}):
+            second = handlers.TraceHandler(self.path)
+        self.assertTrue(second.append)
+        self._publish(second, events.START_EVENT_TYPE,
+                      'cmd-install/cmd-extract', 2.0)
+        self._publish(second, events.FINISH_EVENT_TYPE,
+                      'cmd-install/cmd-extract', 3.0)
+        self._publish(first, events.FINISH_EVENT_TYPE, 'cmd-install', 4.0)
+        trace = trace_diff.load_trace(self.path)
+        self.assertEqual(
+            ['process_name', 'process_name', 'cmd-extract', 'cmd-install'],
+            [e['name'] for e in trace])
+
+    def test_top_level_command_starts_new_trace(self):
+        with patch.dict(os.environ):
+            os.environ.pop('CURTIN_REPORTSTACK', None)
+            self.assertFalse(handlers.TraceHandler(self.path).append)
+
+    def test_registered(self):
+        self.assertEqual(
+            handlers.TraceHandler,
+            handlers.available_handlers.registered_items['trace'])
+
 # vi: ts=4 expandtab syntax=python
@@ -1,7 +1,12 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
+from collections import OrderedDict
 import copy
 import json
-from .helpers import CiTestCase, skipUnlessJsonSchema
+import random
+import re
+import time
+from unittest import mock
+from .helpers import CiTestCase, skipUnlessBenchmark, skipUnlessJsonSchema
 from curtin import storage_config
 from curtin.storage_config import ProbertParser as baseparser
 from curtin.storage_config import (BcacheParser, BlockdevParser, DasdParser,
@@ -67,6 +72,47 @@ class TestStorageConfigSchema(CiTestCase):
         config = {'config': [disk], 'version': 1}
         storage_config.validate_config(config)
 
+    @skipUnlessJsonSchema()
+    def test_schema_accepts_wipe_workers(self):
+        disk = {
+            "id": "disk-vdc",
+            "path": "/dev/vdc",
+            "type": "disk",
+        }
+        config = {'config': [disk], 'version': 1, 'wipe_workers': 4}
+        storage_config.validate_config(config)
+
+    @skipUnlessJsonSchema()
+    def test_schema_accepts_parallel_workers(self):
+        disk = {
+            "id": "disk-vdc",
+            "path": "/dev/vdc",
+            "type": "disk",
+        }
+        config = {'config': [disk], 'version': 1, 'parallel_workers': 4}
+        storage_config.validate_config(config)
+
+    @skipUnlessJsonSchema()
+    def test_schema_accepts_clear_holders_workers(self):
+        disk = {
+            "id": "disk-vdc",
+            "path": "/dev/vdc",
+            "type": "disk",
+        }
+        config = {'config': [disk], 'version': 1, 'clear_holders_workers': 2}
+        storage_config.validate_config(config)
+
+    @skipUnlessJsonSchema()
+    def test_schema_rejects_negative_wipe_workers(self):
+        disk = {
+            "id": "disk-vdc",
+            "path": "/dev/vdc",
+            "type": "disk",
+        }
+        config = {'config': [disk], 'version': 1, 'wipe_workers': -1}
+        with self.assertRaises(ValueError):
+            storage_config.validate_config(config)
+
     @skipUnlessJsonSchema()
     def test_format_schema_arbitrary_fstype_if_preserve(self):
         format = {
@@ -105,6 +151,67 @@ class TestStorageConfigSchema(CiTestCase):
             storage_config.validate_config(config)
 
 
+class TestGetItemReferences(CiTestCase):
+
+    def test_single_and_list_references(self):
+        self.assertEqual(['sda'], storage_config.get_item_references(
+            {'id': 'sda1', 'type': 'partition', 'device': 'sda'}))
+        self.assertEqual(['sda1', 'sdb1', 'sdc1'],
+                         storage_config.get_item_references(
+            {'id': 'md0', 'type': 'raid', 'devices': ['sda1', 'sdb1'],
+             'spare_devices': ['sdc1']}))
+
+    def test_no_references(self):
+        self.assertEqual([], storage_config.get_item_references(
+            {'id': 'sda', 'type': 'disk', 'ptable': 'gpt'}))
+        self.assertEqual([], storage_config.get_item_references(
+            {'id': 'img', 'type': 'image', 'path': '/tmp/img'}))
+
+
+class TestValidateConfig(CiTestCase):
+
+    @skipUnlessJsonSchema()
+    def test_validators_are_cached(self):
+        disk = {'id': 'sda', 'type': 'disk', 'path': '/dev/sda'}
+        storage_config.validate_config({'config': [disk], 'version': 1})
+        validator = storage_config._VALIDATORS['disk']
+        storage_config.validate_config(disk)
+        self.assertIs(validator, storage_config._VALIDATORS['disk'])
+
+    @skipUnlessJsonSchema()
+    def test_single_item(self):
+        storage_config.validate_config(
+            {'id': 'sda', 'type': 'disk', 'path': '/dev/sda'})
+        with self.assertRaisesRegex(ValueError, "'volume' is a required"):
+            storage_config.validate_config(
+                {'id': 'fmt', 'type': 'format', 'fstype': 'ext4'})
+
+    @skipUnlessJsonSchema()
+    def test_all_item_errors_are_reported(self):
+        config = {'version': 1, 'config': [
+            {'id': 'sda', 'type': 'disk', 'path': '/dev/sda'},
+            {'id': 'fmt', 'type': 'format', 'fstype': 'ext4'},
+            {'id': 'mnt', 'type': 'mount', 'device': 'fmt', 'bogus': 1},
+            {'id': 'what', 'type': 'what'}]}
+        with self.assertRaises(ValueError) as ctx:
+            storage_config.validate_config(config, sourcefile='my.yaml')
+        msg = str(ctx.exception)
+        self.assertIn("'volume' is a required property in my.yaml", msg)
+        self.assertIn("'bogus' was unexpected", msg)
+        self.assertIn("Unknown storage type: what", msg)
+
+    @skipUnlessJsonSchema()
+    def test_top_level_errors(self):
+        disk = {'id': 'sda', 'type': 'disk', 'path': '/dev/sda'}
+        with self.assertRaisesRegex(ValueError, 'Unexpected value'):
+            storage_config.validate_config({'config': [disk], 'version': 3})
+        with self.assertRaisesRegex(ValueError, "'version' is a required"):
+            storage_config.validate_config({'config': [disk]})
+        with self.assertRaisesRegex(ValueError, "'type' is a required"):
+            storage_config.validate_config(
+                {'config': [{'id': 'sda'}], 'version': 1})
+
+
 class TestProbertParser(CiTestCase):
 
     invalid_inputs = [None, '', {}, [], set()]
@@ -1000,6 +1107,121 @@ class TestZfsParser(CiTestCase):
         self.assertEqual(4, len(zfs))
 
 
+def _scaled_probe_data(datafile, copies):
+    """ Probe data with copies of every disk, partition, filesystem, lvm
+        device and mount of datafile, renamed so they do not collide. """
+    text = json.dumps(_get_data(datafile))
+    ndm = len(re.findall(r'"/dev/dm-\d+":', text))
+    scaled = {}
+    for copy_nr in range(copies):
+        def rename_dm(match):
+            return 'dm-%d' % (int(match.group(1)) + copy_nr * ndm)
+        renamed = re.sub(r'\b(vd[a-z]|vg\d+|ubuntu-vg|ubuntu--vg)',
+                         r'\1x%d' % copy_nr, text)
+        renamed = re.sub(r'dm-(\d+)', rename_dm, renamed)
+        for key, value in json.loads(renamed).items():
+            if isinstance(value, list):
+                scaled.setdefault(key, []).extend(value)
+            elif isinstance(value, dict):
+                for subkey, subvalue in value.items():
+                    if isinstance(subvalue, dict):
+                        scaled.setdefault(key, {}).setdefault(
+                            subkey, {}).update(subvalue)
+                    else:
+                        scaled.setdefault(key, {})[subkey] = subvalue
+    return scaled
+
+
+class _LinearProbeDataIndex(storage_config.ProbeDataIndex):
+    """ The lookups the parsers did before ProbeDataIndex. """
+
+    def lookup_devname(self, devname):
+        if devname in self.blockdev_data:
+            return devname
+        for bd_key, bdata in self.blockdev_data.items():
+            if devname in bdata.get('DEVLINKS', '').split():
+                return bd_key
+        return None
+
+    def partition_entry(self, parent_devname, devname):
+        ptable = self.blockdev_data[parent_devname]['partitiontable']
+        for pentry in ptable['partitions']:
+            if self.lookup_devname(pentry['node']) == devname:
+                return pentry
+        return None
+
+
+def _parse_all(probe_data, index):
+    configs = []
+    for parser in (BlockdevParser, FilesystemParser, LvmParser, MountParser):
+        configs.extend(parser(probe_data, index=index).parse()[0])
+    return configs
+
+
+class TestProbeDataIndex(CiTestCase):
+
+    def setUp(self):
+        super(TestProbeDataIndex, self).setUp()
+        self.probe_data = _get_data('probert_storage_lvm.json')
+        self.index = storage_config.ProbeDataIndex(self.probe_data)
+
+    def test_lookup_devname_devlinks(self):
+        self.assertEqual('/dev/vda', self.index.lookup_devname('/dev/vda'))
+        for bd_key, bdata in self.probe_data['blockdev'].items():
+            for link in bdata.get('DEVLINKS', '').split():
+                self.assertEqual(
+                    _LinearProbeDataIndex(self.probe_data).lookup_devname(
+                        link), self.index.lookup_devname(link))
+        self.assertIsNone(self.index.lookup_devname('/dev/nothere'))
+        self.assertIsNone(self.index.lookup_devname(None))
+
+    def test_partition_entry(self):
+        entry = self.index.partition_entry('/dev/vda', '/dev/vda5')
+        self.assertEqual('/dev/vda5', entry['node'])
+        self.assertIsNone(self.index.partition_entry('/dev/vda', '/dev/vdb'))
+        self.assertIsNone(self.index.partition_entry('/dev/vdb', '/dev/vdb'))
+
+    def test_parsers_share_index(self):
+        parsers = [parser(self.probe_data, index=self.index)
+                   for parser in (BlockdevParser, LvmParser)]
+        self.assertEqual([self.index, self.index],
+                         [parser.index for parser in parsers])
+
+    @skipUnlessJsonSchema()
+    def test_scaled_probe_data_parses_like_linear_lookups(self):
+        probe_data = _scaled_probe_data('probert_storage_lvm.json', 3)
+        configs = _parse_all(probe_data, self.index.__class__(probe_data))
+        self.assertEqual(
+            _parse_all(probe_data, _LinearProbeDataIndex(probe_data)),
+            configs)
+        self.assertEqual(
+            12, len([cfg for cfg in configs if cfg['type'] == 'disk']))
+
+
+class TestProbeDataIndexBenchmark(CiTestCase):
+
+    @skipUnlessBenchmark()
+    def test_hundreds_of_disks(self):
+        probe_data = _scaled_probe_data('probert_storage_lvm.json', 100)
+        timings = {}
+        results = {}
+        # time the lookups, not the schema validation of each entry
+        with mock.patch('curtin.storage_config.validate_config'):
+            for name, index_cls in (
+                    ('indexed', storage_config.ProbeDataIndex),
+                    ('linear', _LinearProbeDataIndex)):
+                start = time.monotonic()
+                results[name] = _parse_all(probe_data, index_cls(probe_data))
+                timings[name] = time.monotonic() - start
+        print('\nparsed %d blockdevs: indexed %.2fs, linear %.2fs' %
+              (len(probe_data['blockdev']), timings['indexed'],
+               timings['linear']))
+        self.assertEqual(results['linear'], results['indexed'])
+        start = time.monotonic()
+        storage_config.extract_storage_config(probe_data)
+        print('extract_storage_config %.2fs' % (time.monotonic() - start))
+
+
 class TestExtractStorageConfig(CiTestCase):
 
     def setUp(self):
@@ -1172,6 +1394,151 @@ class TestExtractStorageConfig(CiTestCase):
                     part['path'].startswith('/dev/mapper/ventoy-part'))
 
 
+def _synthetic_storage_config(ndisks, seed=0):
+    """ A shuffled storage config of ndisks disks carrying mounted formats,
+        raids, lvm, dm_crypt, zfs and bcache devices. """
+    configs = []
+
+    def add(**cfg):
+        configs.append(cfg)
+        return cfg['id']
+
+    def fmt_mount(volume, path):
+        fmt = add(id='fmt-' + volume, type='format', fstype='ext4',
+                  volume=volume)
+        add(id='mnt-' + volume, type='mount', path=path, device=fmt)
+
+    parts = {}
+    for d in range(ndisks):
+        disk = add(id='disk-%d' % d, type='disk', ptable='gpt',
+                   serial='serial-%d' % d)
+        for number in range(1, 8):
+            parts[d, number] = add(id='%s-part%d' % (disk, number),
+                                   type='partition', number=number,
+                                   device=disk, size='1G')
+        fmt_mount(parts[d, 1], '/srv/%d' % d)
+        crypt = add(id='crypt-%d' % d, type='dm_crypt',
+                    volume=parts[d, 4], key='passw0rd',
+                    dm_name='crypt%d' % d)
+        fmt_mount(crypt, '/crypt/%d' % d)
+        bcache = add(id='bcache-%d' % d, type='bcache', name='bcache%d' % d,
+                     backing_device=parts[d, 6], cache_device=parts[d, 7])
+        fmt_mount(bcache, '/cache/%d' % d)
+
+    for g in range(0, ndisks - 3, 4):
+        members = range(g, g + 4)
+        raid = add(id='md-%d' % g, type='raid', name='md%d' % g,
+                   raidlevel=5,
+                   devices=[parts[d, 2] for d in members])
+        fmt_mount(raid, '/raid/%d' % g)
+        vg = add(id='vg-%d' % g, type='lvm_volgroup', name='vg%d' % g,
+                 devices=[parts[d, 3] for d in members])
+        for lv in range(4):
+            lv_id = add(id='lv-%d-%d' % (g, lv), type='lvm_partition',
+                        name='lv%d' % lv, volgroup=vg)
+            fmt_mount(lv_id, '/lv/%d/%d' % (g, lv))
+        pool = add(id='zpool-%d' % g, type='zpool', pool='pool%d' % g,
+                   mountpoint='/', vdevs=[parts[d, 5] for d in members])
+        for ds in range(4):
+            add(id='zfs-%d-%d' % (g, ds), type='zfs', pool=pool,
+                volume='/ds%d' % ds)
+
+    random.Random(seed).shuffle(configs)
+    return configs
+
+
+def _tree_sorted_storage_config(configs):
+    """ Sort configs the way extract_storage_config used to. """
+    final_config = {'storage': {'version': 2, 'config': configs}}
+    return storage_config.merge_config_trees_to_list(
+        [storage_config.get_config_tree(cfg['id'], final_config)
+         for cfg in configs])
+
+
+class TestSortStorageConfig(CiTestCase):
+
+    def test_matches_config_tree_order(self):
+        configs = _synthetic_storage_config(16)
+        self.assertEqual(_tree_sorted_storage_config(configs),
+                         storage_config.sort_storage_config(configs))
+
+    def test_item_dependency_sets(self):
+        configs = _synthetic_storage_config(4)
+        sconfig = OrderedDict((cfg['id'], cfg) for cfg in configs)
+        deps = storage_config.get_item_dependency_sets(sconfig)
+        for item_id in ('mnt-md-0', 'lv-0-1', 'zfs-0-3', 'mnt-bcache-2'):
+            self.assertEqual(
+                set(storage_config.find_item_dependencies(item_id, sconfig)),
+                deps[item_id])
+
+    def test_duplicate_id_keeps_last_config_at_first_position(self):
+        configs = [{'id': 'sda', 'type': 'disk', 'ptable': 'gpt'},
+                   {'id': 'sdb', 'type': 'disk'},
+                   {'id': 'sda', 'type': 'disk', 'ptable': 'msdos'}]
+        self.assertEqual(
+            [configs[2], configs[1]],
+            storage_config.sort_storage_config(configs))
+
+    def test_invalid_dependency_raises(self):
+        configs = [{'id': 'sda', 'type': 'disk'},
+                   {'id': 'fmt', 'type': 'format', 'volume': 'sda1'}]
+        with self.assertRaises(ValueError):
+            storage_config.sort_storage_config(configs)
+
+    def test_dependency_cycle_raises(self):
+        configs = [{'id': 'md0', 'type': 'raid', 'devices': ['md1']},
+                   {'id': 'md1', 'type': 'raid', 'devices': ['md0']}]
+        with self.assertRaises(ValueError):
+            storage_config.sort_storage_config(configs)
+
+
+class TestSortStorageConfigBenchmark(CiTestCase):
+
+    @skipUnlessBenchmark()
+    def test_10k_items(self):
+        configs = _synthetic_storage_config(472)
+        self.assertLessEqual(10000, len(configs))
+        start = time.monotonic()
+        result = storage_config.sort_storage_config(configs)
+        indexed = time.monotonic() - start
+        start = time.monotonic()
+        expected = _tree_sorted_storage_config(configs)
+        trees = time.monotonic() - start
+        print('\nsorted %d items: indexed %.2fs, config trees %.2fs' %
+              (len(configs), indexed, trees))
+        self.assertEqual(expected, result)
+
+
+class TestValidateConfigBenchmark(CiTestCase):
+
+    @skipUnlessBenchmark()
+    @skipUnlessJsonSchema()
+    def test_10k_items(self):
+        import jsonschema
+        config = {'version': 2, 'config': _synthetic_storage_config(472)}
+        start = time.monotonic()
+        storage_config.validate_config(config)
+        cached = time.monotonic() - start
+        start = time.monotonic()
+        jsonschema.validate(config, storage_config.STORAGE_CONFIG_SCHEMA)
+        whole = time.monotonic() - start
+        print('\nvalidated %d items: cached %.2fs, whole schema %.2fs' %
+              (len(config['config']), cached, whole))
+
+        items = config['config'][:1000]
+        start = time.monotonic()
+        for item in items:
+            storage_config.validate_config(item)
+        cached = time.monotonic() - start
+        start = time.monotonic()
+        for item in items:
+            stype = storage_config.STORAGE_CONFIG_TYPES[item['type']]
+            jsonschema.validate(item, stype.schema)
+        uncached = time.monotonic() - start
+        print('validated %d single items: cached %.2fs, uncached %.2fs' %
+              (len(items), cached, uncached))
+
+
 class TestSelectConfigs(CiTestCase):
     def test_basic(self):
         id0 = {'a': 1, 'b': 2}
@@ -1,14 +1,20 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 from unittest import mock
+import os
 import shlex
+import stat
+import subprocess
+import threading
+import time
 
+from curtin import udev
 from curtin.udev import (
         udevadm_info,
         shlex_quote,
         )
 from curtin import util
-from .helpers import CiTestCase
+from .helpers import CiTestCase, skipUnlessBenchmark
 
 
 UDEVADM_INFO_QUERY = """\
@@ -116,3 +122,267 @@ class TestUdevInfo(CiTestCase):
             ['udevadm', 'info', '--query=property', '--export', mypath],
             capture=True)
         self.assertEqual({'SCSI_IDENT_TARGET_VENDOR': 'clusterid=92901'}, info)
+
+
+NVME_DEVPATH = '/devices/pci0000:00/0000:00:1c.4/0000:05:00.0/nvme/nvme0'
+NVME_UEVENT = """\
+MAJOR=259
+MINOR=0
+DEVNAME=nvme0n1
+DEVTYPE=disk
+"""
+NVME_UDEV_DATA = """\
+S:disk/by-id/nvme-eui.0025388b710116a1
+S:disk/by-id/nvme-n1
+L:0
+I:2026691
+E:ID_PART_TABLE_TYPE=gpt
+E:ID_PART_TABLE_UUID=ea0b9ddc-a114-4e01-b257-750d86e3a944
+E:ID_SERIAL=SAMSUNG MZVLB1T0HALR-000L7_S3TPNY0JB00151
+E:ID_SERIAL_SHORT=S3TPNY0JB00151
+G:systemd
+V:1
+"""
+
+
+class TestUdevDbInfo(CiTestCase):
+
+    def setUp(self):
+        super(TestUdevDbInfo, self).setUp()
+        self.sysfs = self.tmp_dir()
+        self.udev_data = self.tmp_dir()
+        self.add_patch('curtin.udev.SYSFS_ROOT', new=self.sysfs)
+        self.add_patch('curtin.udev.UDEV_DATA_DIR', new=self.udev_data)
+        self.add_patch('curtin.util.subp', 'm_subp')
+        self.m_subp.return_value = (UDEVADM_INFO_QUERY, '')
+        udev.clear_udev_db_cache()
+        self.addCleanup(udev.clear_udev_db_cache)
+        self.syspath = self.add_block_device(
+            '259:0', NVME_DEVPATH + '/nvme0n1', NVME_UEVENT, NVME_UDEV_DATA)
+
+    def add_block_device(self, devt, devpath, uevent, udev_data=None):
+        """Add a block device to the fake sysfs and udev database, return
+        its /sys/class/block path."""
+        devdir = self.sysfs + devpath
+        util.write_file(os.path.join(devdir, 'uevent'), uevent)
+        util.write_file(os.path.join(devdir, 'dev'), devt + '\n')
+        for (linkdir, name) in (('dev/block', devt),
+                                ('class/block', os.path.basename(devpath))):
+            util.ensure_dir(os.path.join(self.sysfs, linkdir))
+            os.symlink(devdir, os.path.join(self.sysfs, linkdir, name))
+        if udev_data is not None:
+            util.write_file(os.path.join(self.udev_data, 'b' + devt),
+                            udev_data)
+        return os.path.join(self.sysfs, 'class/block',
+                            os.path.basename(devpath))
+
+    def test_reads_udev_database(self):
+        """the udev database gives the dictionary of 'udevadm info'."""
+        self.assertEqual(INFO_DICT, udevadm_info(self.syspath))
+        self.assertEqual(0, self.m_subp.call_count)
+
+    def test_dev_path(self):
+        """a /dev path is looked up by its device number."""
+        with mock.patch('curtin.udev.os.stat') as m_stat:
+            m_stat.return_value = mock.Mock(st_mode=stat.S_IFBLK | 0o660,
+                                            st_rdev=os.makedev(259, 0))
+            self.assertEqual(INFO_DICT, udevadm_info('/dev/nvme0n1'))
+            m_stat.assert_called_with('/dev/nvme0n1')
+        self.assertEqual(0, self.m_subp.call_count)
+
+    def test_values_match_udevadm_export(self):
+        """values with spaces are split like the 'udevadm info' output."""
+        data = NVME_UDEV_DATA + "E:ID_MODEL=QEMU HARDDISK\nE:ID_FS_LABEL=\n"
+        syspath = self.add_block_device(
+            '8:0', '/devices/virtual/block/sda', NVME_UEVENT, data)
+        self.m_subp.return_value = (
+            UDEVADM_INFO_QUERY + "ID_MODEL='QEMU HARDDISK'\nID_FS_LABEL=\n",
+            '')
+        info = udevadm_info(syspath)
+        self.assertEqual('/devices/virtual/block/sda', info.pop('DEVPATH'))
+        expected = udevadm_info('/dev/sdz')
+        expected.pop('DEVPATH')
+        self.assertEqual(expected, info)
+        self.assertEqual(['QEMU HARDDISK'], info['ID_MODEL'])
+
+    def test_results_are_cached_until_settle(self):
+        info = udevadm_info(self.syspath)
+        info['DEVLINKS'].append('/dev/changed')
+        os.remove(os.path.join(self.udev_data, 'b259:0'))
+        self.assertEqual(INFO_DICT, udevadm_info(self.syspath))
+        self.assertEqual(0, self.m_subp.call_count)
+        udev.udevadm_settle()
+        self.m_subp.return_value = ('DEVNAME=/dev/nvme0n1\n', '')
+        self.assertEqual({'DEVNAME': '/dev/nvme0n1'},
+                         udevadm_info(self.syspath))
+
+    def test_cache_cleared_during_lookup(self):
+        """a clear from another thread between lookups is no error."""
+        class ClearingCache(dict):
+            def get(self, devt):
+                entry = super(ClearingCache, self).get(devt)
+                self.clear()
+                return entry
+
+        with mock.patch('curtin.udev._UDEV_DB_CACHE', new=ClearingCache()):
+            udevadm_info(self.syspath)
+            self.assertEqual(INFO_DICT, udevadm_info(self.syspath))
+
+    def test_no_udev_record_runs_udevadm(self):
+        syspath = self.add_block_device(
+            '8:16', '/devices/virtual/block/sdb', NVME_UEVENT)
+        self.assertEqual(INFO_DICT, udevadm_info(syspath))
+        self.m_subp.assert_called_with(
+            ['udevadm', 'info', '--query=property', '--export', syspath],
+            capture=True)
+
+    @skipUnlessBenchmark()
+    def test_benchmark_udev_database(self):
+        """Time reading the udev database against parsing the output of a
+        subprocess, with the cache cleared before every lookup."""
+        count = 500
+        export = self.tmp_path('export')
+        util.write_file(export, UDEVADM_INFO_QUERY)
+        start = time.monotonic()
+        for _ in range(count):
+            udev.clear_udev_db_cache()
+            udevadm_info(self.syspath)
+        native = time.monotonic() - start
+        self.m_subp.side_effect = lambda cmd, capture: (
+            subprocess.check_output(['cat', export]).decode(), '')
+        with mock.patch('curtin.udev._block_devt', return_value=None):
+            start = time.monotonic()
+            for _ in range(count):
+                udevadm_info(self.syspath)
+            forked = time.monotonic() - start
+        print('\n%d lookups: udev database %.3fs, subprocess %.3fs' %
+              (count, native, forked))
+
+
+class FakeMonitor(object):
+    """pyudev Monitor whose poll calls on_poll instead of waiting."""
+
+    def __init__(self, on_poll):
+        self.on_poll = on_poll
+        self.timeouts = []
+
+    def poll(self, timeout=None):
+        self.timeouts.append(timeout)
+        return self.on_poll()
+
+
+class TestWaitFor(CiTestCase):
+
+    def setUp(self):
+        super(TestWaitFor, self).setUp()
+        self.add_patch('curtin.udev._block_monitor', 'm_monitor',
+                       return_value=None)
+
+    def test_condition_true_returns_at_once(self):
+        self.assertEqual(0, udev.wait_for(lambda: True))
+        self.assertEqual(0, self.m_monitor.call_count)
+
+    def test_condition_true_clears_udev_db_cache(self):
+        generation = udev.udev_db_generation()
+        udev.wait_for(lambda: True)
+        self.assertEqual(generation + 1, udev.udev_db_generation())
+
+    def test_polls_with_growing_intervals(self):
+        results = iter([False, False, False, False, True])
+        with mock.patch('curtin.udev.time.sleep') as m_sleep:
+            udev.wait_for(lambda: next(results), timeout=10)
+        self.assertEqual(
+            [mock.call(0.01), mock.call(0.02), mock.call(0.04)],
+            m_sleep.call_args_list)
+
+    def test_timeout_raises_oserror(self):
+        with self.assertRaises(OSError) as context_manager:
+            udev.wait_for(lambda: False, timeout=0.05, description='thing')
+        self.assertIn('waiting for thing', str(context_manager.exception))
+
+    def test_checks_after_each_event(self):
+        events = []
+        monitor = FakeMonitor(lambda: events.append('event'))
+        self.m_monitor.return_value = monitor
+        udev.wait_for(lambda: len(events) == 2, timeout=10)
+        self.assertEqual(2, len(monitor.timeouts))
+        for timeout in monitor.timeouts:
+            self.assertLessEqual(timeout, udev.DEVICE_POLL_INTERVAL)
+
+    def test_clears_udev_db_cache(self):
+        generation = udev.udev_db_generation()
+        results = iter([False, True])
+        udev.wait_for(lambda: next(results), timeout=10)
+        self.assertEqual(generation + 1, udev.udev_db_generation())
+
+
+class TestWaitForDevice(CiTestCase):
+
+    def setUp(self):
+        super(TestWaitForDevice, self).setUp()
+        self.add_patch('curtin.udev._block_monitor', 'm_monitor',
+                       return_value=None)
+        self.path = self.tmp_path('dev')
+        self.udev_data = self.tmp_path('udev-data')
+        self.add_patch('curtin.udev.UDEV_DATA_DIR', 'm_data',
+                       new=self.udev_data)
+
+    def _after(self, delay, func, *args):
+        timer = threading.Timer(delay, func, args)
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+    def test_waits_for_device_to_appear(self):
+        self._after(0.05, util.write_file, self.path, '')
+        self.assertGreater(udev.wait_for_device(self.path, timeout=10), 0)
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_waits_for_device_to_be_removed(self):
+        util.write_file(self.path, '')
+        self._after(0.05, os.unlink, self.path)
+        udev.wait_for_device(self.path, present=False, timeout=10)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_timeout(self):
+        with self.assertRaises(OSError) as context_manager:
+            udev.wait_for_device(self.path, timeout=0.05)
+        self.assertEqual(
+            'Timeout exceeded waiting for %s to appear' % self.path,
+            str(context_manager.exception))
+
+    @mock.patch('curtin.udev._block_devt', return_value='8:1')
+    def test_initialized_waits_for_udev_database(self, m_devt):
+        util.write_file(self.path, '')
+        util.ensure_dir(self.udev_data)
+        self._after(0.05, util.write_file,
+                    os.path.join(self.udev_data, 'b8:1'), 'E:A=b')
+        self.assertGreater(
+            udev.wait_for_device(self.path, timeout=10, initialized=True), 0)
+
+    @mock.patch('curtin.udev._block_devt', return_value='8:1')
+    def test_initialized_without_udev(self, m_devt):
+        util.write_file(self.path, '')
+        self.assertEqual(
+            0, udev.wait_for_device(self.path, timeout=10, initialized=True))
+
+    @skipUnlessBenchmark()
+    def test_benchmark_removal_latency(self):
+        """Time noticing the removal of a file 50ms after starting to wait,
+        against the fixed 1, 3, 5, 7 second ladder wait_for_removal used."""
+        util.write_file(self.path, '')
+        self._after(0.05, os.unlink, self.path)
+        start = time.monotonic()
+        udev.wait_for_device(self.path, present=False, timeout=10)
+        waited = time.monotonic() - start
+        util.write_file(self.path, '')
+        self._after(0.05, os.unlink, self.path)
+        start = time.monotonic()
+        for wait in [1, 3, 5, 7]:
+            if not os.path.exists(self.path):
+                break
+            time.sleep(wait)
+        ladder = time.monotonic() - start
+        print('\nremoval noticed after: wait_for_device %.3fs, '
+              'sleep ladder %.3fs' % (waited, ladder))
+
+# vi: ts=4 expandtab syntax=python
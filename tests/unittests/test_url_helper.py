@@ -1,12 +1,77 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import filecmp
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import json
+import threading
+import time
 from unittest import mock
 
 from curtin import url_helper
 
-from .helpers import CiTestCase
+from .helpers import CiTestCase, skipUnlessBenchmark
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """Answer GET and POST with the request path, method and body, keeping
+    the connection open."""
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body, headers=None):
+        self.send_response(code)
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        body = b''
+        if self.headers.get('Content-Length'):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path == '/missing':
+            self._reply(404, b'not here')
+        elif self.path.startswith('/redirect'):
+            self._reply(302, b'', {'Location': '/moved'})
+        elif self.path == '/big':
+            self._reply(200, 100000 * b'x')
+        else:
+            self._reply(200, json.dumps(
+                {'path': self.path, 'method': self.command,
+                 'body': body.decode(),
+                 'type': self.headers.get('Content-Type')}).encode())
+        if self.server.close_after_reply:
+            # drop the connection without telling the client
+            self.close_connection = True
+
+    do_POST = do_GET
+
+
+class LocalServerTestCase(CiTestCase):
+
+    def setUp(self):
+        super(LocalServerTestCase, self).setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.server.daemon_threads = True
+        self.server.connections = set()
+        self.server.close_after_reply = False
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.01,), daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.pool = url_helper.ConnectionPool()
+        self.add_patch('curtin.url_helper.POOL', new=self.pool)
+        self.addCleanup(self.pool.clear)
 
 
 class TestDownload(CiTestCase):
@@ -77,6 +142,225 @@ class TestDownload(CiTestCase):
         self.assertTrue(filecmp.cmp(self.src_file, self.target_file),
                         "Downloaded file differed from source file.")
 
+    def _interrupted_reader(self, status):
+        """Return a fake UrlReader class that fails reading the source
+        after 5000 bytes and then answers with status."""
+        with open(self.src_file, "rb") as fp:
+            content = fp.read()
+        calls = []
+
+        class FakeReader(object):
+            def __init__(self, url, headers=None):
+                calls.append(headers)
+                self.size = len(content)
+                self.info = {}
+                if headers is None:
+                    self.fp = [content[:5000], None]
+                    self.status = 200
+                elif status == 206:
+                    offset = int(headers['Range'][6:-1])
+                    self.fp = [content[offset:]]
+                    self.status = status
+                else:
+                    self.fp = [content]
+                    self.status = status
+
+            def read(self, buflen):
+                if not self.fp:
+                    return b''
+                buf = self.fp.pop(0)
+                if buf is None:
+                    raise url_helper.UrlError(None, code=None)
+                return buf
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+        return FakeReader, calls
+
+    def test_download_interrupted_resumes(self):
+        """An interrupted download is resumed with a Range request."""
+        reader, calls = self._interrupted_reader(206)
+        with mock.patch('curtin.url_helper.UrlReader', new=reader):
+            url_helper.download("http://host/my-source", self.target_file,
+                                retries=1, retry_delay=0)
+        self.assertEqual([None, {'Range': 'bytes=5000-'}], calls)
+        self.assertTrue(filecmp.cmp(self.src_file, self.target_file))
+
+    def test_download_interrupted_range_unsupported(self):
+        """A server ignoring the Range request sends the whole file."""
+        reader, calls = self._interrupted_reader(200)
+        with mock.patch('curtin.url_helper.UrlReader', new=reader):
+            url_helper.download("http://host/my-source", self.target_file,
+                                retries=1, retry_delay=0)
+        self.assertEqual(2, len(calls))
+        self.assertTrue(filecmp.cmp(self.src_file, self.target_file))
+
+    def test_download_interrupted_no_retry(self):
+        reader, calls = self._interrupted_reader(206)
+        with mock.patch('curtin.url_helper.UrlReader', new=reader):
+            self.assertRaises(url_helper.UrlError, url_helper.download,
+                              "http://host/my-source", self.target_file)
+        self.assertEqual(1, len(calls))
+
+    @mock.patch('curtin.url_helper.UrlReader')
+    def test_download_connect_error_not_retried(self, urlreader_mock):
+        """Errors before any data was received other than 5xx are not
+        retried."""
+        urlreader_mock.side_effect = url_helper.UrlError(None, code=None)
+        self.assertRaises(url_helper.UrlError, url_helper.download,
+                          "http://host/my-source", self.target_file,
+                          retries=3, retry_delay=0)
+        self.assertEqual(1, urlreader_mock.call_count)
+
+
+class TestConnectionPool(LocalServerTestCase):
+
+    def test_connection_reused(self):
+        for i in range(5):
+            result = json.loads(url_helper.geturl(self.url + '/p%d' % i))
+            self.assertEqual('/p%d' % i, result['path'])
+        self.assertEqual(1, len(self.server.connections))
+        self.assertEqual(1, self.pool.connects)
+
+    def test_post_data(self):
+        result = json.loads(url_helper.geturl(self.url + '/event?a=1',
+                                              data={'key': 'value'}))
+        self.assertEqual('POST', result['method'])
+        self.assertEqual('/event?a=1', result['path'])
+        self.assertEqual({'key': 'value'}, json.loads(result['body']))
+        self.assertEqual('application/x-www-form-urlencoded',
+                         result['type'])
+
+    def test_http_error(self):
+        with self.assertRaises(url_helper.UrlError) as ctx:
+            url_helper.geturl(self.url + '/missing')
+        self.assertEqual(404, ctx.exception.code)
+        self.assertIn('http error: 404', str(ctx.exception))
+        # the error was read, the connection is reused
+        url_helper.geturl(self.url + '/ok')
+        self.assertEqual(1, self.pool.connects)
+
+    def test_redirect_followed(self):
+        result = json.loads(url_helper.geturl(self.url + '/redirect',
+                                              data=b'data'))
+        self.assertEqual({'path': '/moved', 'method': 'GET', 'body': '',
+                          'type': None}, result)
+
+    def test_reconnect_when_server_closed_idle_connection(self):
+        self.server.close_after_reply = True
+        for i in range(3):
+            url_helper.geturl(self.url + '/p%d' % i)
+        self.assertEqual(3, len(self.server.connections))
+
+    def test_partial_read_is_not_reused(self):
+        with url_helper.UrlReader(self.url + '/big') as reader:
+            self.assertEqual(100, len(reader.read(100)))
+        url_helper.geturl(self.url + '/ok')
+        self.assertEqual(2, self.pool.connects)
+
+    def test_download(self):
+        target = self.tmp_path('big')
+        for _ in range(2):
+            url_helper.download(self.url + '/big', target)
+        with open(target, 'rb') as fp:
+            self.assertEqual(100000 * b'x', fp.read())
+        self.assertEqual(1, self.pool.connects)
+
+    def test_idle_connections_bounded(self):
+        pool = url_helper.ConnectionPool(maxsize=1)
+        key = ('http', '127.0.0.1', 80)
+        conns = [mock.Mock(), mock.Mock()]
+        for conn in conns:
+            pool.put(key, conn)
+        conns[1].close.assert_called_with()
+        self.assertEqual((conns[0], True), pool.get(key))
+
+    def _pool_with_idle(self, error, on_send=False):
+        """Return a pool whose idle connection fails with error and the
+        new connection it opens next."""
+        pool = url_helper.ConnectionPool()
+        key = ('http', '127.0.0.1', 80)
+        idle = mock.Mock()
+        if on_send:
+            idle.request.side_effect = error
+        else:
+            idle.getresponse.side_effect = error
+        pool.put(key, idle)
+        new = mock.Mock()
+        return (pool, key, idle, new)
+
+    def test_sent_get_resent_on_new_connection(self):
+        (pool, key, idle, new) = self._pool_with_idle(
+            http.client.RemoteDisconnected('closed'))
+        with mock.patch('curtin.url_helper.http.client.HTTPConnection',
+                        return_value=new):
+            self.assertEqual(
+                (new, new.getresponse.return_value),
+                pool._request(key, 'GET', '/', None, {}))
+        idle.close.assert_called_with()
+
+    def test_sent_post_not_resent(self):
+        """the server may have acted on the POST it got already."""
+        (pool, key, idle, new) = self._pool_with_idle(
+            http.client.RemoteDisconnected('closed'))
+        with mock.patch('curtin.url_helper.http.client.HTTPConnection',
+                        return_value=new):
+            with self.assertRaises(http.client.RemoteDisconnected):
+                pool._request(key, 'POST', '/', b'data', {})
+        self.assertEqual(0, new.request.call_count)
+
+    def test_unsent_post_resent_on_new_connection(self):
+        (pool, key, idle, new) = self._pool_with_idle(
+            BrokenPipeError('closed'), on_send=True)
+        with mock.patch('curtin.url_helper.http.client.HTTPConnection',
+                        return_value=new):
+            pool._request(key, 'POST', '/', b'data', {})
+        new.request.assert_called_with('POST', '/', body=b'data', headers={})
+
+    @mock.patch('curtin.url_helper.urllib_request.urlopen')
+    def test_redirect_to_proxied_url_not_pooled(self, m_urlopen):
+        m_urlopen.return_value.read.return_value = b'proxied'
+        with mock.patch('curtin.url_helper._use_pool',
+                        side_effect=[True, False]):
+            self.assertEqual(b'proxied',
+                             url_helper.geturl(self.url + '/redirect'))
+        req = m_urlopen.call_args[0][0]
+        self.assertEqual(self.url + '/moved', req.full_url)
+        self.assertEqual('GET', req.get_method())
+
+    @mock.patch('curtin.url_helper.urllib_request.urlopen')
+    def test_proxy_not_pooled(self, m_urlopen):
+        m_urlopen.return_value.read.return_value = b'proxied'
+        with mock.patch.dict('os.environ', {'http_proxy': 'http://proxy:3128',
+                                            'no_proxy': ''}):
+            self.assertEqual(b'proxied', url_helper.geturl(self.url))
+        self.assertEqual(0, self.pool.connects)
+
+    @skipUnlessBenchmark()
+    def test_benchmark_requests(self):
+        """Compare requests/sec to a local keep-alive server with a new
+        connection per request and with the pool."""
+        count = 2000
+        url = self.url + '/event'
+
+        def urlopen_per_request(req):
+            return url_helper.urllib_request.urlopen(req)
+
+        rates = []
+        for opener in (urlopen_per_request, None):
+            with mock.patch('curtin.url_helper._urlopen',
+                            new=opener or url_helper._urlopen):
+                start = time.monotonic()
+                for _ in range(count):
+                    url_helper.geturl(url, data={'event': 'x'})
+                rates.append(count / (time.monotonic() - start))
+        print('\n%d POST requests: urlopen %.0f req/s, pooled %.0f req/s' %
+              (count, rates[0], rates[1]))
+
 
 class TestGetMaasVersion(CiTestCase):
     @mock.patch('curtin.url_helper.geturl')
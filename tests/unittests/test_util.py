@@ -7,6 +7,8 @@ import fcntl
 import os
 import stat
 from textwrap import dedent
+import threading
+import time
 
 from curtin import util
 from curtin import paths
@@ -683,6 +685,59 @@ class TestChrootableTargetMounts(CiTestCase):
         self.assertEqual(sorted(my_mounts), sorted(in_chroot.mounts))
 
 
+class TestChrootSession(CiTestCase):
+
+    def setUp(self):
+        super(TestChrootSession, self).setUp()
+        self.target = self.tmp_dir()
+        self.add_patch('curtin.util.do_mount', 'm_do_mount')
+        self.add_patch('curtin.util.do_umount', 'm_do_umount')
+        self.add_patch('curtin.util.subp', 'm_subp')
+        self.add_patch('curtin.util.is_uefi_bootable', 'm_uefi')
+        self.m_do_mount.return_value = True
+        self.m_uefi.return_value = False
+
+    def test_chrootable_target_reuses_session_mounts(self):
+        """ChrootableTarget inside a session does not mount or umount."""
+        with util.ChrootSession(self.target) as session:
+            self.assertEqual(4, self.m_do_mount.call_count)
+            for _ in range(3):
+                with util.ChrootableTarget(self.target) as chroot:
+                    self.assertEqual(session, chroot.session)
+                    self.assertEqual(1, session.users)
+            self.assertEqual(4, self.m_do_mount.call_count)
+            self.assertEqual(0, self.m_do_umount.call_count)
+            self.assertEqual(0, self.m_subp.call_count)
+        self.assertEqual(4, self.m_do_umount.call_count)
+        self.m_subp.assert_called_once_with(['udevadm', 'settle'])
+        self.assertEqual({'reused': 3, 'mount': 12, 'umount': 12,
+                          'settle': 3}, session.stats())
+
+    def test_nested_sessions_reuse_outer(self):
+        with util.ChrootSession(self.target) as outer:
+            with util.ChrootSession(self.target) as inner:
+                self.assertEqual(outer, inner)
+            self.assertEqual(0, self.m_do_umount.call_count)
+        self.assertEqual(4, self.m_do_umount.call_count)
+
+    def test_other_targets_and_mounts_not_reused(self):
+        with util.ChrootSession(self.target):
+            with util.ChrootableTarget(self.tmp_dir()) as chroot:
+                self.assertIsNone(chroot.session)
+            with util.ChrootableTarget(self.target,
+                                       mounts=['/media']) as chroot:
+                self.assertIsNone(chroot.session)
+        self.assertEqual(4 + 4 + 1, self.m_do_mount.call_count)
+
+    def test_session_torn_down_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with util.ChrootSession(self.target):
+                raise RuntimeError('failed')
+        self.assertEqual(4, self.m_do_umount.call_count)
+        with util.ChrootableTarget(self.target) as chroot:
+            self.assertIsNone(chroot.session)
+
+
 class TestChrootableTargetIsChrootBehavior(CiTestCase):
     """Test ChrootableTargets handle ischroot behavior correctly
 
@@ -980,67 +1035,34 @@ class TestWaitForRemoval(CiTestCase):
         with self.assertRaises(ValueError):
             util.wait_for_removal(None)
 
-    @mock.patch('curtin.util.time')
-    @mock.patch('curtin.util.os')
-    def test_wait_for_removal(self, mock_os, mock_time):
+    @mock.patch('curtin.udev.wait_for_device')
+    def test_wait_for_removal(self, m_wait):
         path = "/file/to/remove"
-        mock_os.path.exists.side_effect = iter([
-            True,    # File is not yet removed
-            False,   # File has  been removed
-        ])
-
         util.wait_for_removal(path)
+        m_wait.assert_called_with(path, present=False, timeout=16)
 
-        self.assertEqual(2, len(mock_os.path.exists.call_args_list))
-        self.assertEqual(1, len(mock_time.sleep.call_args_list))
-        mock_os.path.exists.assert_has_calls([
-            mock.call(path),
-            mock.call(path),
-        ])
-        mock_time.sleep.assert_has_calls([
-            mock.call(1),
-        ])
-
-    @mock.patch('curtin.util.time')
-    @mock.patch('curtin.util.os')
-    def test_wait_for_removal_timesout(self, mock_os, mock_time):
-        path = "/file/to/remove"
-        mock_os.path.exists.return_value = True
-
+    @mock.patch('curtin.udev.wait_for_device')
+    def test_wait_for_removal_timesout(self, m_wait):
+        m_wait.side_effect = OSError('Timeout exceeded')
         with self.assertRaises(OSError):
-            util.wait_for_removal(path)
-
-        self.assertEqual(5, len(mock_os.path.exists.call_args_list))
-        self.assertEqual(4, len(mock_time.sleep.call_args_list))
-        mock_os.path.exists.assert_has_calls(5 * [mock.call(path)])
-        mock_time.sleep.assert_has_calls([
-            mock.call(1),
-            mock.call(3),
-            mock.call(5),
-            mock.call(7),
-        ])
-
-    @mock.patch('curtin.util.time')
-    @mock.patch('curtin.util.os')
-    def test_wait_for_removal_custom_retry(self, mock_os, mock_time):
-        path = "/file/to/remove"
-        timeout = 100
-        mock_os.path.exists.side_effect = iter([
-            True,    # File is not yet removed
-            False,   # File has  been removed
-        ])
-
-        util.wait_for_removal(path, retries=[timeout])
+            util.wait_for_removal("/file/to/remove")
 
-        self.assertEqual(2, len(mock_os.path.exists.call_args_list))
-        self.assertEqual(1, len(mock_time.sleep.call_args_list))
-        mock_os.path.exists.assert_has_calls([
-            mock.call(path),
-            mock.call(path),
-        ])
-        mock_time.sleep.assert_has_calls([
-            mock.call(timeout),
-        ])
+    @mock.patch('curtin.udev.wait_for_device')
+    def test_wait_for_removal_custom_retry(self, m_wait):
+        path = "/file/to/remove"
+        util.wait_for_removal(path, retries=[100])
+        m_wait.assert_called_with(path, present=False, timeout=100)
+
+    def test_wait_for_removal_returns_when_removed(self):
+        path = self.tmp_path('file')
+        util.write_file(path, '')
+        timer = threading.Timer(0.05, os.unlink, [path])
+        timer.start()
+        self.addCleanup(timer.cancel)
+        start = time.monotonic()
+        util.wait_for_removal(path)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertFalse(os.path.exists(path))
 
 
 class TestGetEFIBootMGR(CiTestCase):
@@ -1288,9 +1310,9 @@ class TestLoadKernelModule(CiTestCase):
 class TestSanitizeSource(CiTestCase):
 
     # copied from curtin.util.sanitize_source
-    supported = ['tgz', 'dd-tgz', 'tbz', 'dd-tbz', 'txz', 'dd-txz', 'dd-tar',
-                 'dd-bz2', 'dd-gz', 'dd-xz', 'dd-raw', 'fsimage',
-                 'fsimage-layered']
+    supported = ['tgz', 'dd-tgz', 'tbz', 'dd-tbz', 'txz', 'dd-txz', 'tzst',
+                 'dd-tar', 'dd-tzst', 'dd-bz2', 'dd-gz', 'dd-xz', 'dd-zst',
+                 'dd-raw', 'fsimage', 'fsimage-layered']
     source_url = 'http://curtin.io/root-fs.foo'
     squashfs_source_path = "/media/filesystem.squashfs"
 